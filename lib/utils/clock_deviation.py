@@ -0,0 +1,92 @@
+"""
+The `clock_deviation` column of the joined metadata.
+
+`clock_deviation` is a per-clade molecular-clock QC metric: each sequence's
+divergence minus its clade's clock-expected divergence for its collection date.
+It only needs three columns -- `date`, `divergence`, `Nextstrain_clade` -- which
+:class:`ClockDeviation` keeps per row in compact arrays while the rows stream
+past, so the metadata itself is never held in memory.  Dates are read with
+the transforms' memoized parser, or looked up in the day ordinals the
+transforms wrote alongside the metadata (``--output-date-ordinals``).
+"""
+import math
+from array import array
+from datetime import datetime
+from typing import Dict, Iterator, Mapping, Optional
+
+from utils.transform import ISO_DATES
+
+CLADE_COLUMN = "Nextstrain_clade"
+CLOCK_DEVIATION_COLUMN = "clock_deviation"
+VALUE_MISSING_DATA = '?'
+
+rate_per_day = 0.0007 * 29903 / 365
+reference_day = datetime(2020, 1, 1).toordinal()
+
+
+def datestr_to_ordinal(x):
+    try:
+        ordinal = ISO_DATES.ordinal(x)
+    except:
+        return math.nan
+    return math.nan if ordinal is None else ordinal
+
+
+def isfloat(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+class ClockDeviation:
+    """
+    Collects each row's clade, date and divergence with :meth:`add`, then
+    computes every row's `clock_deviation` with :meth:`values`.
+    ``date_ordinals`` gives the day ordinals (or NaN) of known dates, e.g. from
+    :func:`~utils.transformpipeline.dates.read_date_ordinals`.
+    """
+    def __init__(self, date_ordinals: Optional[Mapping[str, float]] = None):
+        self.clade_codes: Dict[str, int] = {}
+        self.clades = array('l')
+        self.dates = array('d')
+        self.divergences = array('d')
+        # Dates repeat a lot; parse each distinct one once.
+        self._ordinals: Dict[str, float] = dict(date_ordinals or {})
+
+    def add(self, clade: str, date: str, divergence: str) -> None:
+        self.clades.append(self.clade_codes.setdefault(clade, len(self.clade_codes)))
+        ordinal = self._ordinals.get(date)
+        if ordinal is None:
+            ordinal = self._ordinals[date] = datestr_to_ordinal(date)
+        self.dates.append(ordinal)
+        self.divergences.append(float(divergence) if isfloat(divergence) else math.nan)
+
+    def __len__(self) -> int:
+        return len(self.clades)
+
+    def values(self) -> Iterator[str]:
+        """The `clock_deviation` of each row, in the order they were added,
+        as written to the TSV."""
+        import numpy as np
+        import pandas as pd
+
+        # The calculation of the former join-metadata-and-clades, unchanged.
+        clades = np.array(self.clades, dtype=int)
+        t = pd.Series(np.array(self.dates, dtype=float))
+        div_array = np.array(self.divergences, dtype=float)
+        offset_by_clade = {}
+        for code in self.clade_codes.values():
+            ind = clades == code
+            if ind.sum() > 100:
+                deviation = div_array[ind] - (t[ind] - reference_day) * rate_per_day
+                offset_by_clade[code] = np.mean(deviation[~np.isnan(deviation)])
+
+        offset = pd.Series(clades).apply(lambda x: offset_by_clade.get(x, 2.0))
+        clock_deviation = np.array(div_array - ((t - reference_day) * rate_per_day + offset), dtype=int)
+        # Match the former int->float upcast (nan assignment) so e.g. 5 renders as "5.0".
+        clock_deviation = clock_deviation.astype(float)
+        clock_deviation[np.isnan(div_array) | np.isnan(t)] = np.nan
+
+        return (VALUE_MISSING_DATA if np.isnan(v) else str(v) for v in clock_deviation)
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
+import re
 import regex
-import pandas as pd
-from datetime import datetime
-from typing import Optional, Set, Union
+from datetime import date, datetime
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, FrozenSet, Iterable, Optional, Set, Tuple, Union
+
+if TYPE_CHECKING:
+    # Only for annotations; importing pandas costs every script ~0.4 s.
+    import pandas as pd
 
 # Note: 'sequence' should NEVER appear in these lists!
 METADATA_COLUMNS = [  # Ordering of columns in the existing metadata.tsv in the ncov repo
@@ -14,7 +19,7 @@ METADATA_COLUMNS = [  # Ordering of columns in the existing metadata.tsv in the
 ]
 
 
-def titlecase(text: Union[str, pd._libs.missing.NAType],
+def titlecase(text: Union[str, 'pd._libs.missing.NAType'],
     articles: Set[str] = {}, abbrev: Set[str] = {}) -> Optional[str]:
     """
     Returns a title cased location name from the given location name
@@ -80,10 +85,108 @@ def format_date(date_string: str, expected_formats: set) -> str:
     >>> format_date("2020-01-15T00:00:00Z", expected_formats)
     '2020-01-15'
     """
-    for date_format in expected_formats:
-        try:
-            return datetime.strptime(date_string, date_format).strftime('%Y-%m-%d')
-        except ValueError:
-            continue
+    return _date_parser(frozenset(expected_formats)).format(date_string)
+
+
+ISO_DATE_FORMAT = '%Y-%m-%d'
+
+# Regexes for the common formats, with the digit counts strptime accepts for
+# each field (ASCII digits only; anything else is left to strptime).
+_FAST_PATHS = {
+    '%Y-%m-%d': re.compile(r'([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})'),
+    '%Y-%m-%dT%H:%M:%SZ': re.compile(r'([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})T([0-9]{1,2}):([0-9]{1,2}):([0-9]{1,2})Z'),
+    '%Y-%m-%dT%H:%M:%S': re.compile(r'([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})T([0-9]{1,2}):([0-9]{1,2}):([0-9]{1,2})'),
+}
+
+
+class DateParser:
+    """
+    Parses date strings in any of *expected_formats*, as :func:`format_date`
+    does, with a memo of the last *cache_size* distinct strings.
+
+    ``YYYY-MM-DD`` dates and the ISO 8601 timestamps ``YYYY-MM-DDTHH:MM:SS[Z]``
+    are matched by precompiled regexes (if their format is expected) instead of
+    trying each format with ``strptime``, which raises a ``ValueError`` per
+    miss.  Anything else, including values the regexes match but which aren't
+    a valid date, falls back to ``strptime``, so the results are the same.
+
+    >>> parser = DateParser({'%Y-%m-%d', '%Y-%m-%dT%H:%M:%SZ'})
+
+    >>> parser.parse("2020-1-15")
+    datetime.date(2020, 1, 15)
+
+    >>> parser.parse("2020-02-30") is None
+    True
+
+    >>> parser.standardize("2020-01-15T10:00:00Z")
+    ('2020-01-15', 737439)
+
+    >>> parser.standardize("2020-01")
+    ('2020-01', None)
+    """
+    def __init__(self, expected_formats: Iterable[str], cache_size: int = 1 << 16):
+        self.expected_formats = set(expected_formats)
+        self._fast_paths = [
+            pattern
+            for date_format, pattern in _FAST_PATHS.items()
+            if date_format in self.expected_formats
+        ]
+        self.parse = lru_cache(maxsize=cache_size)(self._parse)
+        self.standardize = lru_cache(maxsize=cache_size)(self._standardize)
+
+    def _parse(self, date_string: str) -> Optional[date]:
+        """The date of *date_string*, or None if it matches no expected format."""
+        for pattern in self._fast_paths:
+            match = pattern.fullmatch(date_string)
+            if match:
+                try:
+                    return datetime(*map(int, match.groups())).date()
+                except ValueError:
+                    break
+
+        for date_format in self.expected_formats:
+            try:
+                return datetime.strptime(date_string, date_format).date()
+            except ValueError:
+                continue
+        return None
+
+    def _standardize(self, date_string: str) -> Tuple[str, Optional[int]]:
+        """
+        Return *date_string* formatted as :func:`format_date` would, and the
+        day ordinal of that result read as a ``YYYY-MM-DD`` date (None if it
+        isn't one), for later stages to reuse.
+        """
+        parsed = self.parse(date_string)
+        if parsed is not None and parsed.year >= 1000:
+            return parsed.isoformat(), parsed.toordinal()
+
+        if parsed is None:
+            if ISO_DATE_FORMAT in self.expected_formats:
+                # not a YYYY-MM-DD date either
+                return date_string, None
+            formatted = date_string
+        else:
+            # strftime doesn't zero-pad years before 1000 on every platform
+            formatted = parsed.strftime(ISO_DATE_FORMAT)
+        return formatted, ISO_DATES.ordinal(formatted)
+
+    def format(self, date_string: str) -> str:
+        return self.standardize(date_string)[0]
+
+    def ordinal(self, date_string: str) -> Optional[int]:
+        """The day ordinal of *date_string*, or None if it isn't a date."""
+        parsed = self.parse(date_string)
+        return None if parsed is None else parsed.toordinal()
+
+
+ISO_DATES = DateParser({ISO_DATE_FORMAT})
+
+_date_parsers: Dict[FrozenSet[str], DateParser] = {}
+
 
-    return date_string
+def _date_parser(expected_formats: FrozenSet[str]) -> DateParser:
+    parser = _date_parsers.get(expected_formats)
+    if parser is None:
+        parser = _date_parsers[expected_formats] = DateParser(expected_formats)
+    return parser
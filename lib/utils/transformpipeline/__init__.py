@@ -1 +1,3 @@
 LINE_NUMBER_KEY = "__pipeline_lineno"
+# The dates StandardizeData parsed, as {column: [value, day ordinal or None]}
+PARSED_DATES_KEY = "__pipeline_dates"
@@ -103,7 +103,13 @@ class Filter(PipelineComponent):
     """A filter is a pipeline component that tests whether each value in the input
     stream should be in the output stream.  Implementations should implement
     `test_value`, which should return True if the value should be in the output stream.
+
+    A filter whose `test_value` only reads `LINE_NUMBER_KEY` sets
+    `line_number_only`, and can then run in `LineToJsonDataSource`'s `reject`,
+    before the records are decoded.
     """
+    line_number_only = False
+
     def process(self, iterator: Iterator[dict]) -> dict:
         while True:
             entry = next(iterator)
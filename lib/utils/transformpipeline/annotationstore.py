@@ -0,0 +1,255 @@
+"""
+Compact storage for curated ``(id, column, value)`` annotations.
+
+The accessions cross-reference holds millions of GISAID <-> GenBank pairs.
+Keeping them as a dict of lists of tuples costs several hundred bytes of
+Python objects per pair and seconds of startup.  :class:`CompactAnnotationStore`
+keeps the same data in a handful of flat arrays instead:
+
+* ids and values are UTF-8 encoded into two byte blobs, addressed by offset
+  arrays, so there is no Python object per entry;
+* column names are interned into a small table and stored per entry as a
+  2-byte code;
+* ids are found through an open-addressing hash table (``zlib.crc32``, so it
+  is stable across processes) held in an ``array``.
+
+A store can be saved to disk and loaded back with :meth:`CompactAnnotationStore.load`,
+which memory-maps the file so startup no longer depends on the number of
+annotations.
+"""
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+STORE_MAGIC = b"ANNSTO02"
+# magic, source digest, columns length, keys, entries, key blob length,
+# value blob length, hash slots
+_HEADER = struct.Struct("<8s32sQQQQQQ")
+
+# (name, typecode, per-key or per-entry count) of each array section, in
+# file order.  Entries for a key form a chain from _first_entry through
+# _next_entry, in insertion order.
+_SECTIONS = (
+    ("_key_offsets", "Q", "keys+1"),
+    ("_key_hashes", "I", "keys"),
+    ("_first_entry", "q", "keys"),
+    ("_last_entry", "q", "keys"),
+    ("_slots", "i", "slots"),
+    ("_entry_columns", "H", "entries"),
+    ("_next_entry", "q", "entries"),
+    ("_value_offsets", "Q", "entries+1"),
+)
+
+
+def _padding(length: int) -> int:
+    return -length % 8
+
+
+class CompactAnnotationStore:
+    """Annotations keyed by id, in insertion order per id.
+
+    Like the dict of lists it replaces, adding an annotation for an id resets
+    that id's use count, and :meth:`unused_keys` lists ids in the order they
+    were first added.
+    """
+    def __init__(self):
+        self.columns: List[str] = []
+        self._column_codes: Dict[str, int] = {}
+
+        self._key_blob = bytearray()
+        self._key_offsets = array("Q", [0])
+        self._key_hashes = array("I")
+        self._first_entry = array("q")
+        self._last_entry = array("q")
+        self._slots = array("i", [-1]) * 8
+        self.use_count = array("Q")
+
+        self._entry_columns = array("H")
+        self._next_entry = array("q")
+        self._value_blob = bytearray()
+        self._value_offsets = array("Q", [0])
+
+        self._read_only = False
+        self.source_digest = bytes(32)
+
+    def __len__(self) -> int:
+        return len(self._key_hashes)
+
+    @property
+    def entry_count(self) -> int:
+        return len(self._value_offsets) - 1
+
+    def _key_bytes(self, key_no: int) -> bytes:
+        return self._key_blob[self._key_offsets[key_no]:self._key_offsets[key_no + 1]]
+
+    def _find(self, key: bytes, key_hash: int) -> Tuple[int, int]:
+        """Return ``(key number or -1, hash slot)`` for ``key``."""
+        slots = self._slots
+        mask = len(slots) - 1
+        slot = key_hash & mask
+        while True:
+            key_no = slots[slot]
+            if key_no < 0:
+                return -1, slot
+            if self._key_hashes[key_no] == key_hash and self._key_bytes(key_no) == key:
+                return key_no, slot
+            slot = (slot + 1) & mask
+
+    def _grow_slots(self) -> None:
+        self._slots = slots = array("i", [-1]) * (2 * len(self._slots))
+        mask = len(slots) - 1
+        for key_no, key_hash in enumerate(self._key_hashes):
+            slot = key_hash & mask
+            while slots[slot] >= 0:
+                slot = (slot + 1) & mask
+            slots[slot] = key_no
+
+    def _thaw(self) -> None:
+        """Copy a loaded (memory-mapped) store into mutable arrays."""
+        for name, typecode, _ in _SECTIONS:
+            setattr(self, name, array(typecode, getattr(self, name)))
+        self._key_blob = bytearray(self._key_blob)
+        self._value_blob = bytearray(self._value_blob)
+        self._read_only = False
+
+    def add(self, key: str, column: str, value: str) -> None:
+        if self._read_only:
+            self._thaw()
+
+        key_bytes = key.encode("utf-8")
+        key_hash = zlib.crc32(key_bytes)
+        key_no, slot = self._find(key_bytes, key_hash)
+        entry_no = self.entry_count
+        if key_no < 0:
+            key_no = len(self)
+            self._key_blob += key_bytes
+            self._key_offsets.append(len(self._key_blob))
+            self._key_hashes.append(key_hash)
+            self._first_entry.append(entry_no)
+            self._last_entry.append(entry_no)
+            self.use_count.append(0)
+            self._slots[slot] = key_no
+            if 2 * len(self) > len(self._slots):
+                self._grow_slots()
+        else:
+            self._next_entry[self._last_entry[key_no]] = entry_no
+            self._last_entry[key_no] = entry_no
+            self.use_count[key_no] = 0
+
+        column_code = self._column_codes.get(column)
+        if column_code is None:
+            column_code = self._column_codes[column] = len(self.columns)
+            self.columns.append(column)
+
+        self._entry_columns.append(column_code)
+        self._next_entry.append(-1)
+        self._value_blob += value.encode("utf-8")
+        self._value_offsets.append(len(self._value_blob))
+
+    def lookup(self, key: str) -> Optional[List[Tuple[str, str]]]:
+        """Return the ``(column, value)`` annotations for ``key`` in insertion
+        order and count the use, or return None if there are none."""
+        key_bytes = key.encode("utf-8")
+        key_no, _ = self._find(key_bytes, zlib.crc32(key_bytes))
+        if key_no < 0:
+            return None
+
+        self.use_count[key_no] += 1
+        columns, offsets, blob = self.columns, self._value_offsets, self._value_blob
+        annotations = []
+        entry_no = self._first_entry[key_no]
+        while entry_no >= 0:
+            annotations.append((
+                columns[self._entry_columns[entry_no]],
+                str(blob[offsets[entry_no]:offsets[entry_no + 1]], "utf-8"),
+            ))
+            entry_no = self._next_entry[entry_no]
+        return annotations
+
+    def keys(self) -> Iterator[str]:
+        """Yield every id, in the order they were first added."""
+        for key_no in range(len(self)):
+            yield str(self._key_bytes(key_no), "utf-8")
+
+    def unused_keys(self) -> List[str]:
+        return [
+            str(self._key_bytes(key_no), "utf-8")
+            for key_no, use_count in enumerate(self.use_count)
+            if use_count == 0
+        ]
+
+    def save(self, path: str, source_digest: bytes = bytes(32)) -> None:
+        """Write the store to ``path``.  ``source_digest`` (32 bytes, e.g. a
+        SHA-256) identifies what it was built from; see
+        :meth:`read_source_digest`."""
+        columns = "\n".join(self.columns).encode("utf-8")
+        # Write beside and rename, so a store that is memory-mapped from
+        # `path` is never truncated underneath its reader.
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(_HEADER.pack(
+                STORE_MAGIC, source_digest, len(columns), len(self), self.entry_count,
+                len(self._key_blob), len(self._value_blob), len(self._slots),
+            ))
+            sections = [columns, self._key_blob, self._value_blob]
+            sections += [getattr(self, name) for name, _, _ in _SECTIONS]
+            for section in sections:
+                section = bytes(section)
+                fh.write(section)
+                fh.write(bytes(_padding(len(section))))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def read_source_digest(cls, path: str) -> Optional[bytes]:
+        """Return the source digest saved in ``path``, or None if it is not a
+        readable store."""
+        try:
+            with open(path, "rb") as fh:
+                magic, digest, *_ = _HEADER.unpack(fh.read(_HEADER.size))
+        except (OSError, struct.error):
+            return None
+        return digest if magic == STORE_MAGIC else None
+
+    @classmethod
+    def load(cls, path: str) -> "CompactAnnotationStore":
+        """Memory-map a store written by :meth:`save`.  It is read-only until
+        the first :meth:`add`, which copies it into memory."""
+        with open(path, "rb") as fh:
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, digest, columns_length, key_count, entry_count,
+         key_blob_length, value_blob_length, slot_count) = _HEADER.unpack_from(mapped)
+        if magic != STORE_MAGIC:
+            raise ValueError(f"{path} is not an annotation store")
+
+        view = memoryview(mapped)
+        position = _HEADER.size
+
+        def take(length):
+            nonlocal position
+            section = view[position:position + length]
+            position += length + _padding(length)
+            return section
+
+        store = cls()
+        store.source_digest = digest
+        columns = str(take(columns_length), "utf-8")
+        store.columns = columns.split("\n") if columns_length else []
+        store._column_codes = {column: code for code, column in enumerate(store.columns)}
+        store._key_blob = take(key_blob_length)
+        store._value_blob = take(value_blob_length)
+
+        counts = {
+            "keys": key_count, "keys+1": key_count + 1, "slots": slot_count,
+            "entries": entry_count, "entries+1": entry_count + 1,
+        }
+        for name, typecode, count in _SECTIONS:
+            setattr(store, name, take(counts[count] * array(typecode).itemsize).cast(typecode))
+
+        store.use_count = array("Q", [0]) * key_count
+        store._read_only = True
+        return store
@@ -0,0 +1,415 @@
+"""
+Checkpoints for resuming a failed transform run instead of rerunning it.
+
+A full GISAID or GenBank transform takes hours, and a crash near the end (the
+disk filling up during the sort, running out of memory in the FASTA pass)
+used to mean starting over from the NDJSON.  With ``--checkpoint-dir``, a
+:class:`Checkpoints` records in that directory how far the run got: at the
+end of the pipeline and its spill (:data:`SPILLED`), of the sort
+(:data:`SORTED`) and of the dedup and metadata write (:data:`WRITTEN`), and
+every ``--checkpoint-interval`` seconds while spilling (:data:`SPILLING`).
+With ``--resume``, a run continues from the last checkpoint:
+
+* while spilling, from the NDJSON line after the last spilled record, by
+  seeking to the byte offset where it ends, with the same line numbers; the
+  files the pipeline adds to (the spill, raw metadata, problem data, messages
+  and NDJSON index) are cut back to their sizes at the checkpoint;
+* after a phase, by skipping it and reading what it left in the directory.
+
+Each checkpoint records the sizes of the files in the directory, the
+diagnostics counts (see :mod:`.diagnostics`) and the progress of the NDJSON
+index, and is only resumed by a run with the same options and input files
+(:func:`checkpoint_fingerprint`); otherwise the run starts over.  The use
+counts of curated annotations and geographic rules are not restored, as
+nothing is written from them.
+
+The outputs are written in the directory (:meth:`Checkpoints.stage_args`)
+and only moved into place by :meth:`Checkpoints.finish`, so that a workflow
+removing the outputs of a failed job can't remove what a resumed run needs.
+The pipeline's messages are kept there too, and printed after the pipeline.
+The outputs of a resumed run are identical to those of an uninterrupted one.
+
+Without ``--checkpoint-dir`` the checkpoints are disabled and every method
+does what the scripts did before, so scripts use them unconditionally.
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import time
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO
+
+from . import LINE_NUMBER_KEY
+from .dedup import KeptStrainNames
+from .diagnostics import DIAGNOSTICS
+from .externalsort import sort_spill_file, spill_to_file, spill_to_sorted_tempfile
+from .ndjsonindex import NdjsonIndexBuilder
+from .patch import file_stamp
+
+
+SPILLING, SPILLED, SORTED, WRITTEN = PHASES = ("spilling", "spilled", "sorted", "written")
+
+# Options that may differ between a run and its resumption.
+RESUMABLE_OPTIONS = {
+    "checkpoint_dir", "checkpoint_interval", "resume",
+    "memory_report", "memory_budget", "memory_budget_action", "memory_sample_interval",
+    "diagnostics_summary", "biosample_index",
+}
+
+
+class ResumableLines:
+    """The lines of the text file ``fh`` from byte ``offset`` on, like
+    iterating it would give, remembering where the most recent ones end so a
+    checkpoint can resume after any record still in the pipeline.
+
+    With an ``index_builder``, the lines are read through it and it records
+    where they end.  ``first_line`` is the line number of the line at
+    ``offset``.
+    """
+    def __init__(self, fh: TextIO, offset: int = 0, first_line: int = 1,
+                 index_builder: Optional[NdjsonIndexBuilder] = None, history: int = 1 << 17):
+        self.fh = fh
+        self.offset = offset
+        self.first_line = first_line
+        self.index_builder = index_builder
+        # (line number, end offset) of the lines read, some ahead of the
+        # pipeline (see ReadAhead)
+        self._ends = deque(maxlen=history)
+
+    def __iter__(self) -> Iterator[str]:
+        self.fh.buffer.seek(self.offset)
+        if self.index_builder:
+            yield from self.index_builder.recorded_lines(self.fh)
+            return
+        line_number, end = self.first_line, self.offset
+        for line in self.fh.buffer:
+            end += len(line)
+            self._ends.append((line_number, end))
+            line_number += 1
+            text = line.decode(self.fh.encoding)
+            # as text-mode (universal newlines) reading would
+            yield text[:-2] + "\n" if text.endswith("\r\n") else text
+
+    def end_of(self, line_number: int) -> Optional[int]:
+        """The byte offset at which line ``line_number`` ends, or None if it
+        is no longer (or not yet) known."""
+        if self.index_builder:
+            offsets = self.index_builder.line_offsets
+            return offsets[line_number] if line_number < len(offsets) else None
+        while self._ends and self._ends[0][0] < line_number:
+            self._ends.popleft()
+        if self._ends and self._ends[0][0] == line_number:
+            return self._ends[0][1]
+        return None
+
+
+class Checkpoints:
+    """The checkpoints of a run in ``directory``, resumed if ``resume`` and
+    made for the same ``fingerprint``; disabled (doing what the scripts did
+    without checkpoints) if ``directory`` is None."""
+    STATE_FILE = "checkpoint.json"
+    SPILL_FILE = "spill.tsv"
+    SORTED_FILE = "sorted.tsv"
+    MESSAGES_FILE = "messages.log"
+    KEPT_FILE = "kept-strains.tsv"
+    INDEX_KEYS_FILE = "ndjson-index-keys.tsv"
+    INDEX_OFFSETS_FILE = "ndjson-index-offsets.bin"
+
+    def __init__(self, directory: Optional[str] = None, fingerprint: Optional[dict] = None,
+                 resume: bool = False, interval: float = 600.0):
+        self.directory = directory
+        # as read back from the state file
+        self.fingerprint = json.loads(json.dumps(fingerprint, default=str))
+        self.interval = interval
+        self.phase: Optional[str] = None
+        self.state: dict = {}
+        self.lines: Optional[ResumableLines] = None
+        self._outputs: Dict[str, str] = {}
+        self._last_save = time.monotonic()
+        if self.enabled:
+            self._start(resume)
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _start(self, resume: bool) -> None:
+        if resume and self._restore():
+            DIAGNOSTICS.add_summary(self.state["diagnostics"])
+            print(f"Resuming from the {self.phase!r} checkpoint in {self.directory}.", file=sys.stderr)
+            return
+        if resume:
+            print(f"No checkpoint of a run with these inputs and options in {self.directory}; starting over.",
+                  file=sys.stderr)
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+
+    def _restore(self) -> bool:
+        try:
+            with open(self.path(self.STATE_FILE), "r", encoding="utf-8") as state_fh:
+                saved = json.load(state_fh)
+        except (FileNotFoundError, ValueError):
+            return False
+        if saved.get("fingerprint") != self.fingerprint:
+            return False
+
+        files = saved["state"]["files"]
+        for name, size in files.items():
+            path = self.path(name)
+            if not os.path.isfile(path) or os.path.getsize(path) < size:
+                return False
+        # Drop whatever was written after the checkpoint.
+        for name in os.listdir(self.directory):
+            path = self.path(name)
+            if name in files:
+                with open(path, "r+b") as fh:
+                    fh.truncate(files[name])
+            elif name != self.STATE_FILE:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+
+        self.phase, self.state = saved["phase"], saved["state"]
+        return True
+
+    def reached(self, phase: str) -> bool:
+        """Whether the run being resumed got to the end of ``phase``."""
+        return self.phase is not None and PHASES.index(self.phase) >= PHASES.index(phase)
+
+    @property
+    def resuming_spill(self) -> bool:
+        """Whether the pipeline continues a spill, adding to its outputs."""
+        return self.phase == SPILLING
+
+    def due(self) -> bool:
+        return time.monotonic() - self._last_save >= self.interval
+
+    def save(self, phase: str, discard: Iterable[str] = (), **state) -> None:
+        """Record that the run got to ``phase`` (its end, but for
+        :data:`SPILLING`), with ``state`` and the sizes of the files in the
+        directory, which must have been flushed.  Then remove the files
+        ``discard``, which a resumed run no longer needs."""
+        if not self.enabled:
+            return
+        discard = {os.path.basename(path) for path in discard}
+        state["diagnostics"] = DIAGNOSTICS.summary()
+        state["files"] = {
+            name: os.path.getsize(self.path(name))
+            for name in os.listdir(self.directory)
+            if name != self.STATE_FILE and name not in discard and os.path.isfile(self.path(name))
+        }
+        state_path = self.path(self.STATE_FILE)
+        with open(f"{state_path}.tmp", "w", encoding="utf-8") as state_fh:
+            json.dump({"fingerprint": self.fingerprint, "phase": phase, "state": state}, state_fh)
+        os.replace(f"{state_path}.tmp", state_path)
+        self.phase, self.state = phase, state
+        self._last_save = time.monotonic()
+
+        for name in discard:
+            if os.path.exists(self.path(name)):
+                os.unlink(self.path(name))
+
+    def stage_args(self, args: argparse.Namespace, names: List[str]) -> argparse.Namespace:
+        """``args`` with the output paths of options ``names`` moved into the
+        directory, until :meth:`finish` moves the outputs into place."""
+        if not self.enabled:
+            return args
+        staged = argparse.Namespace(**vars(args))
+        for name in names:
+            final_path = getattr(args, name)
+            if final_path is not None:
+                setattr(staged, name, self.stage(f"{name}-{os.path.basename(str(final_path))}", final_path))
+        return staged
+
+    def stage(self, name: str, final_path: str) -> str:
+        """The path in the directory at which to write the output
+        ``final_path``, named ``name``; ``final_path`` itself if disabled."""
+        if not self.enabled:
+            return final_path
+        path = self.path(name)
+        self._outputs[path] = str(final_path)
+        return path
+
+    def input_lines(self, fh: TextIO, index_builder: Optional[NdjsonIndexBuilder] = None) -> Iterable[str]:
+        """The lines of the NDJSON ``fh`` to run the pipeline on (read through
+        ``index_builder`` if given): those after the checkpoint when resuming
+        a spill.  Number them from :attr:`first_line`."""
+        if not self.enabled:
+            return index_builder.recorded_lines(fh) if index_builder else fh
+        offset, first_line = 0, 1
+        if self.resuming_spill:
+            offset, first_line = self.state["offset"], self.state["line"] + 1
+            if index_builder:
+                index_builder.restore_progress(self.state["index"], self.path(self.INDEX_OFFSETS_FILE))
+        self.lines = ResumableLines(fh, offset, first_line, index_builder)
+        return self.lines
+
+    @property
+    def first_line(self) -> Optional[int]:
+        """The line number of the first of :meth:`input_lines` for
+        ``LineToJsonDataSource``, or None from the start of the file."""
+        return self.state["line"] + 1 if self.resuming_spill else None
+
+    @property
+    def index_keys_path(self) -> Optional[str]:
+        """The ``keys_path`` of the NDJSON index builder."""
+        return self.path(self.INDEX_KEYS_FILE) if self.enabled else None
+
+    @contextlib.contextmanager
+    def messages(self):
+        """Keep what the pipeline prints to stdout in the directory, for
+        :meth:`print_messages`."""
+        if not self.enabled:
+            yield
+            return
+        with open(self.path(self.MESSAGES_FILE), "a" if self.resuming_spill else "w", encoding="utf-8") as messages_fh, \
+             contextlib.redirect_stdout(messages_fh):
+            try:
+                yield
+            finally:
+                DIAGNOSTICS.flush()
+
+    def print_messages(self) -> None:
+        """Print the pipeline's messages kept by :meth:`messages`."""
+        if self.enabled and os.path.exists(self.path(self.MESSAGES_FILE)):
+            with open(self.path(self.MESSAGES_FILE), "r", encoding="utf-8") as messages_fh:
+                shutil.copyfileobj(messages_fh, sys.stdout)
+
+    def spill(self, records: Iterable[dict], id_key: str, output_dir: str, flush: Iterable = (),
+              index_builder: Optional[NdjsonIndexBuilder] = None) -> str:
+        """Spill ``records`` like ``spill_to_tempfile`` and return the spill's
+        path.  Checkpointed, the spill is in the directory, a resumed spill
+        adds to it, and a :data:`SPILLING` checkpoint is saved every
+        :attr:`interval` seconds, once the ``flush`` objects (the pipeline's
+        other outputs) and ``index_builder`` were flushed up to the last
+        spilled record.  Otherwise, the spill is sorted as it goes (see
+        ``spill_to_sorted_tempfile``), leaving :meth:`sort` nothing to do."""
+        if not self.enabled:
+            return spill_to_sorted_tempfile(records, id_key, output_dir)
+
+        def checkpoint(record, spill):
+            if not self.due():
+                return
+            line_number = record[LINE_NUMBER_KEY]
+            offset = self.lines.end_of(line_number)
+            if offset is None:
+                return
+            spill.flush()
+            for output in flush:
+                output.flush()
+            DIAGNOSTICS.flush()
+            sys.stdout.flush()
+            index = None
+            if index_builder:
+                index = index_builder.save_progress(line_number, self.path(self.INDEX_OFFSETS_FILE))
+            self.save(SPILLING, line=line_number, offset=offset, index=index)
+
+        spill_path = self.path(self.SPILL_FILE)
+        spill_to_file(records, id_key, spill_path, append=self.resuming_spill, after_record=checkpoint)
+        return spill_path
+
+    @property
+    def spill_path(self) -> Optional[str]:
+        """The spill left by the run resumed, sorted if it got to
+        :data:`SORTED`, or None."""
+        if self.reached(SORTED):
+            return self.path(self.SORTED_FILE)
+        if self.reached(SPILLED):
+            return self.path(self.SPILL_FILE)
+        return None
+
+    def sort(self, spill_path: str) -> str:
+        """Sort the spill at ``spill_path`` like ``sort_spill_file`` and
+        return the sorted file's path.  Checkpointed, the spill is sorted into
+        another file, so a failed sort can be resumed, and :data:`SORTED`
+        saved; otherwise :meth:`spill` already sorted it."""
+        if not self.enabled:
+            return spill_path
+        sorted_path = self.path(self.SORTED_FILE)
+        sort_spill_file(spill_path, sorted_path)
+        self.save(SORTED, discard=[spill_path])
+        return sorted_path
+
+    def tmp_dir(self, output_dir: str) -> str:
+        """Where to write temporary files: the directory if checkpointed, so
+        that resuming removes those of the failed run, else ``output_dir``."""
+        return self.directory if self.enabled else output_dir
+
+    def kept_strain_names(self, output_dir: str) -> KeptStrainNames:
+        """The ``KeptStrainNames`` to add the kept records to, or those kept
+        by the run resumed after :data:`WRITTEN`."""
+        if not self.enabled:
+            return KeptStrainNames(output_dir)
+        if self.reached(WRITTEN):
+            return KeptStrainNames.load(self.path(self.KEPT_FILE))
+        return KeptStrainNames(path=self.path(self.KEPT_FILE))
+
+    def written(self, kept: KeptStrainNames, sorted_path: str) -> None:
+        """Record the end of the dedup and metadata write, after which the
+        sorted spill at ``sorted_path`` is removed."""
+        if not self.enabled:
+            os.unlink(sorted_path)
+            return
+        kept.finish()
+        self.save(WRITTEN, discard=[sorted_path])
+
+    def discard(self, path: Optional[str]) -> None:
+        """Remove the temporary file ``path`` of a failed run, unless
+        checkpointed."""
+        if not self.enabled and path and os.path.exists(path):
+            os.unlink(path)
+
+    def finish(self) -> None:
+        """Move the outputs into place and remove the checkpoints, once the
+        run is done."""
+        if not self.enabled:
+            return
+        for path, final_path in self._outputs.items():
+            if os.path.exists(path):
+                shutil.move(path, final_path)
+        shutil.rmtree(self.directory)
+
+
+def checkpoint_fingerprint(args: argparse.Namespace, inputs: List[str]) -> dict:
+    """The options in ``args`` and the size and mtime of the files of its
+    options ``inputs``, which a run must share with the run it resumes."""
+    return {
+        "options": {
+            name: value
+            for name, value in sorted(vars(args).items())
+            if name not in RESUMABLE_OPTIONS
+        },
+        "inputs": {name: file_stamp(getattr(args, name)) for name in inputs},
+    }
+
+
+def add_checkpoint_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group("checkpoints")
+    group.add_argument("--checkpoint-dir",
+        help="Optional directory in which to checkpoint the run at the end of each phase and\n"
+             "every --checkpoint-interval seconds of the pipeline, for --resume.  The outputs\n"
+             "are written there too, and moved into place at the end of the run.")
+    group.add_argument("--checkpoint-interval", type=float, default=600.0,
+        help="Seconds between the checkpoints of the pipeline (default: 600).")
+    group.add_argument("--resume", action="store_true",
+        help="Continue the run checkpointed in --checkpoint-dir, if it had the same inputs and\n"
+             "options; otherwise start over.")
+
+
+def checkpoints_from_args(args: argparse.Namespace, inputs: List[str]) -> Checkpoints:
+    """The :class:`Checkpoints` requested by :func:`add_checkpoint_arguments`'s
+    options, for a run reading the files of the options ``inputs``."""
+    return Checkpoints(
+        args.checkpoint_dir,
+        checkpoint_fingerprint(args, inputs),
+        resume=args.resume,
+        interval=args.checkpoint_interval,
+    )
@@ -1,7 +1,9 @@
 import json
-from typing import Iterable
+from typing import Iterable, List, Optional
 
-from ._base import DataSource, DataSourceIterator, PipelineException
+from . import LINE_NUMBER_KEY
+from ._base import DataSource, DataSourceIterator, Filter, PipelineException
+from .threadedio import ReadAhead
 
 
 class LineToJsonIterator(DataSourceIterator):
@@ -18,11 +20,72 @@ class LineToJsonIterator(DataSourceIterator):
         raise PipelineException(f"Error parsing line:\n{self.last_line}")
 
 
+class NumberedLineToJsonIterator(LineToJsonIterator):
+    """Numbers the lines from `first_line`, reporting the number of the line
+    being processed in its errors; `line_number` is that of the next line."""
+    def __init__(self, lines: Iterable[str], first_line: int):
+        super().__init__(lines)
+        self.line_number = first_line
+
+    def __next__(self) -> dict:
+        self.last_line = next(self.lines_iter)
+        self.line_number += 1
+        entry = json.loads(self.last_line)
+        entry[LINE_NUMBER_KEY] = self.line_number - 1
+        return entry
+
+    def raise_exception(self, exc: Exception) -> bool:
+        raise PipelineException(f"Error parsing line {self.line_number - 1}:\n{self.last_line}")
+
+
+class RejectingLineToJsonIterator(NumberedLineToJsonIterator):
+    """Decodes the lines that none of the `reject` filters reject from their
+    line number alone, numbered from `first_line`."""
+    def __init__(self, lines: Iterable[str], first_line: int, reject: List[Filter]):
+        super().__init__(lines, first_line)
+        self.tests = [component.test_value for component in reject]
+
+    def __next__(self) -> dict:
+        numbered = {}
+        while True:
+            self.last_line = next(self.lines_iter)
+            numbered[LINE_NUMBER_KEY] = self.line_number
+            self.line_number += 1
+            for test in self.tests:
+                if not test(numbered):
+                    break
+            else:
+                entry = json.loads(self.last_line)
+                entry[LINE_NUMBER_KEY] = self.line_number - 1
+                return entry
+
+
 class LineToJsonDataSource(DataSource):
     """This data source takes an iterable of json lines (i.e., ndjson) and produces
-    an iterator of parsed objects."""
-    def __init__(self, lines: Iterable[str]):
+    an iterator of parsed objects.  With `read_ahead`, the lines are read in a
+    background thread (see `ReadAhead`) so reading and decompression overlap
+    the pipeline.  With `first_line`, for lines that don't start the file, each
+    object carries its line number in the file under `LINE_NUMBER_KEY`, which
+    `StandardizeData` keeps.
+
+    The `reject` filters, which must only read the line number (see
+    `Filter.line_number_only`), are tested in order on each line before it is
+    decoded: the lines one of them rejects are skipped undecoded, and the
+    others decoded and numbered as with `first_line` (1 by default)."""
+    def __init__(self, lines: Iterable[str], read_ahead: bool = False, first_line: Optional[int] = None,
+                 reject: Iterable[Filter] = ()):
         self.lines = lines
+        self.read_ahead = read_ahead
+        self.first_line = first_line
+        self.reject = list(reject)
+        for component in self.reject:
+            if not component.line_number_only:
+                raise ValueError(f"{type(component).__name__} can't test records before they are decoded")
 
     def __iter__(self) -> DataSourceIterator:
-        return LineToJsonIterator(self.lines)
+        lines = ReadAhead(self.lines) if self.read_ahead else self.lines
+        if self.reject:
+            return RejectingLineToJsonIterator(lines, self.first_line or 1, self.reject)
+        if self.first_line is not None:
+            return NumberedLineToJsonIterator(lines, self.first_line)
+        return LineToJsonIterator(lines)
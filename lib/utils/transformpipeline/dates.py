@@ -0,0 +1,67 @@
+"""
+Dates parsed once, by ``StandardizeData``, and reused downstream.
+
+``StandardizeData`` parses each record's date fields with its schema's
+:class:`~utils.transform.DateParser` and keeps the result on the record under
+:data:`PARSED_DATES_KEY`: each date's standardized value and its day ordinal
+(as a ``YYYY-MM-DD`` date, or None).  :func:`date_ordinal` hands later stages
+(e.g. ``MaskBadCollectionDate``) the ordinal without parsing again, as long as
+the value wasn't changed since, e.g. by an annotation.
+
+:class:`DateOrdinalsWriter` writes the ordinal of every distinct ``date`` of
+the metadata to a small sidecar TSV, which the clock deviation reads
+(:func:`read_date_ordinals`) instead of parsing every date of the joined
+metadata again.
+"""
+import csv
+import math
+from typing import Dict, Optional
+
+from utils.transform import ISO_DATES
+from . import PARSED_DATES_KEY
+
+
+def date_ordinal(entry: dict, column: str) -> Optional[int]:
+    """The day ordinal of ``entry[column]`` read as a ``YYYY-MM-DD`` date, or
+    None if it isn't one."""
+    value = entry[column]
+    parsed = entry.get(PARSED_DATES_KEY)
+    if parsed is not None and column in parsed:
+        parsed_value, ordinal = parsed[column]
+        if parsed_value == value:
+            return ordinal
+    return ISO_DATES.ordinal(value)
+
+
+class DateOrdinalsWriter:
+    """Collects the distinct values of a date ``column`` of the written
+    records with their day ordinals, and writes them as a TSV of ``date`` and
+    ``ordinal`` (empty for values that aren't dates)."""
+    def __init__(self, path: str, column: str = 'date'):
+        self.path = path
+        self.column = column
+        self.ordinals: Dict[str, Optional[int]] = {}
+
+    def add(self, entry: dict) -> None:
+        value = entry[self.column]
+        if value not in self.ordinals:
+            self.ordinals[value] = date_ordinal(entry, self.column)
+
+    def write(self) -> None:
+        with open(self.path, 'w', encoding='utf-8', newline='') as sidecar_fh:
+            writer = csv.writer(sidecar_fh, delimiter='\t', lineterminator='\n')
+            writer.writerow(['date', 'ordinal'])
+            for value, ordinal in self.ordinals.items():
+                writer.writerow([value, '' if ordinal is None else ordinal])
+
+
+def read_date_ordinals(path: str) -> Dict[str, float]:
+    """Read a :class:`DateOrdinalsWriter` sidecar as ``{date: ordinal}``, with
+    NaN for values that aren't dates."""
+    with open(path, 'r', encoding='utf-8', newline='') as sidecar_fh:
+        rows = csv.reader(sidecar_fh, delimiter='\t')
+        next(rows)
+        return {
+            value: float(ordinal) if ordinal else math.nan
+            for value, ordinal in rows
+        }
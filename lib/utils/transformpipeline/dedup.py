@@ -0,0 +1,193 @@
+"""
+Compact bookkeeping for deduplicating sorted records by strain.
+
+After the external sort (see :mod:`.externalsort`) the records of a strain
+are adjacent, best first, so deduplicating only needs to compare each record
+with the previous one (:func:`keep_first_per_strain`) instead of keeping a set
+of every strain.  What the later passes need to know about the kept records
+is kept compact, or on disk, so that it no longer grows with the corpus in
+Python objects:
+
+* :class:`KeptStrainNames` selects the kept records for the FASTA pass with a
+  :class:`LineNumberBitmap` and reads their strain names back from a sidecar
+  file sorted by line number;
+* :class:`GroupsByKey` groups values (e.g. strains by BioSample accession)
+  with an external sort.
+"""
+import json
+import os
+import tempfile
+from operator import itemgetter
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from . import LINE_NUMBER_KEY
+from .externalsort import format_keyed_line, sort_keyed_lines_file, sort_line_numbered_file
+
+
+_NO_STRAIN = object()
+
+
+def keep_first_per_strain(records: Iterable, strain_of: Callable = itemgetter('strain')) -> Iterator:
+    """Yield the first of each run of ``records`` with the same strain, for
+    records sorted (or at least grouped) by strain."""
+    previous = _NO_STRAIN
+    for record in records:
+        strain = strain_of(record)
+        if strain != previous:
+            previous = strain
+            yield record
+
+
+class LineNumberBitmap:
+    """A set of line numbers kept as one bit per line."""
+    def __init__(self):
+        self._bits = bytearray()
+        self._count = 0
+
+    def add(self, line_number: int) -> None:
+        byte, bit = divmod(line_number, 8)
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(max(byte + 1 - len(self._bits), len(self._bits))))
+        if not self._bits[byte] >> bit & 1:
+            self._bits[byte] |= 1 << bit
+            self._count += 1
+
+    def __contains__(self, line_number: int) -> bool:
+        byte, bit = divmod(line_number, 8)
+        return byte < len(self._bits) and bool(self._bits[byte] >> bit & 1)
+
+    def __len__(self) -> int:
+        return self._count
+
+
+def _open_sidecar(output_dir: Optional[str], suffix: str):
+    return tempfile.NamedTemporaryFile(
+        mode="w", encoding="utf-8", newline="\n", suffix=suffix,
+        dir=output_dir or ".", delete=False,
+    )
+
+
+class KeptStrainNames:
+    """The line numbers and (possibly renamed) strain names of the records
+    kept by the dedup, for writing the FASTA in input order.
+
+    :attr:`line_numbers` selects the kept records (e.g. with a
+    ``LineNumberFilter``) and :meth:`with_names` pairs them, in line number
+    order, with their names from a sidecar file in ``output_dir``, or at
+    ``path``.  Call :meth:`close` to remove the sidecar (unless at ``path``,
+    from which :meth:`load` reads the kept records back).
+    """
+    def __init__(self, output_dir: Optional[str] = None, path: Optional[str] = None):
+        self.line_numbers = LineNumberBitmap()
+        if path:
+            self._sidecar = open(path, "w", encoding="utf-8", newline="\n")
+        else:
+            self._sidecar = _open_sidecar(output_dir, ".strains.tsv")
+        self.path = self._sidecar.name
+        self._keep_sidecar = bool(path)
+
+    @classmethod
+    def load(cls, path: str) -> "KeptStrainNames":
+        """The kept records of a sidecar at ``path``, completed with
+        :meth:`finish`."""
+        kept = cls.__new__(cls)
+        kept.line_numbers = LineNumberBitmap()
+        kept.path = path
+        kept._sidecar = None
+        kept._keep_sidecar = True
+        for line_number, _ in kept.in_line_order():
+            kept.line_numbers.add(line_number)
+        return kept
+
+    def add(self, line_number: int, strain: str) -> None:
+        self.line_numbers.add(line_number)
+        self._sidecar.write(f"{line_number}\t{strain}\n")
+
+    def finish(self) -> None:
+        """End adding records, and sort the sidecar by line number."""
+        if self._sidecar is not None and not self._sidecar.closed:
+            self._sidecar.close()
+            sort_line_numbered_file(self.path)
+
+    def in_line_order(self) -> Iterator[Tuple[int, str]]:
+        """Yield ``(line number, strain name)`` of the kept records by line
+        number.  Ends adding records."""
+        self.finish()
+        with open(self.path, "r", encoding="utf-8") as sidecar:
+            for line in sidecar:
+                line_number, _, strain = line.rstrip("\n").partition("\t")
+                yield int(line_number), strain
+
+    def with_names(self, records: Iterable[dict]) -> Iterator[Tuple[dict, str]]:
+        """Pair the kept ``records``, in line number order, with their strain
+        names."""
+        names = self.in_line_order()
+        for record in records:
+            line_number, strain = next(names, (None, None))
+            if record[LINE_NUMBER_KEY] != line_number:
+                raise ValueError(f"Record at line {record[LINE_NUMBER_KEY]} was not kept, or is out of order")
+            yield record, strain
+
+    def close(self) -> None:
+        if self._sidecar is not None:
+            self._sidecar.close()
+        if not self._keep_sidecar and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class GroupsByKey:
+    """Group values by key on disk, like a dict of lists filled in order.
+
+    :meth:`groups` yields each key's values in the order they were added, and
+    the keys in the order they were first added, through two external sorts.
+    Keys must not contain tabs or newlines.
+    """
+    def __init__(self, output_dir: Optional[str] = None):
+        self.output_dir = output_dir
+        self._count = 0
+        self._spill = _open_sidecar(output_dir, ".groups.tsv")
+
+    def add(self, key: str, value: str) -> None:
+        self._spill.write(format_keyed_line(key, self._count, value))
+        self._count += 1
+
+    def groups(self, min_size: int = 1) -> Iterator[Tuple[str, List[str]]]:
+        """Yield ``(key, values)`` of the keys with at least ``min_size``
+        values.  Ends adding values."""
+        self._spill.close()
+        sort_keyed_lines_file(self._spill.name)
+
+        # Re-sort the groups by the position of their first value, one line
+        # per group, so they come out in first-added order.
+        by_first = _open_sidecar(self.output_dir, ".groups.tsv")
+        try:
+            with by_first, open(self._spill.name, "r", encoding="utf-8") as sorted_values:
+                for first, key, values in self._read_groups(sorted_values):
+                    if len(values) >= min_size:
+                        by_first.write(format_keyed_line("", first, [key, values]))
+            sort_keyed_lines_file(by_first.name)
+
+            with open(by_first.name, "r", encoding="utf-8") as sorted_groups:
+                for line in sorted_groups:
+                    key, values = json.loads(line.split("\t", 2)[2])
+                    yield key, values
+        finally:
+            os.unlink(by_first.name)
+
+    @staticmethod
+    def _read_groups(lines: Iterable[str]) -> Iterator[Tuple[int, str, List[str]]]:
+        group_key, first, values = None, None, []
+        for line in lines:
+            key, position, value = line.split("\t", 2)
+            if key != group_key:
+                if group_key is not None:
+                    yield first, group_key, values
+                group_key, first, values = key, int(position), []
+            values.append(json.loads(value))
+        if group_key is not None:
+            yield first, group_key, values
+
+    def close(self) -> None:
+        self._spill.close()
+        if os.path.exists(self._spill.name):
+            os.unlink(self._spill.name)
@@ -0,0 +1,162 @@
+"""
+The messages the transforms emit about individual records.
+
+Stages used to ``print()`` a line per affected record (redundant annotations,
+divisions inferred from strain names, unparsable geography, ...), which the
+workflow captures as ``flagged-annotations`` and uploads to Slack.  They now
+:meth:`~Diagnostics.emit` them, by category, to the :data:`DIAGNOSTICS`
+channel, which
+
+* counts every category and keeps its first few messages as samples;
+* buffers the lines it writes, so millions of messages cost a write per
+  :data:`BUFFER_LINES` lines rather than one each;
+* writes them in one of :data:`FORMATS`: ``text``, the former per-record lines
+  (the default, so ``flagged-annotations`` is unchanged); ``jsonl``, an object
+  with the category and message per line; or ``summary``, only each
+  category's count and samples once the run is done;
+* optionally writes its counts and samples as a JSON summary
+  (``--diagnostics-summary``).
+
+Lines go to ``sys.stdout`` as of the time they were emitted, so redirecting
+stdout still works; the buffer is written out whenever stdout changes, when
+:meth:`~Diagnostics.flush` is called (e.g. by ``TagLineNumber`` before each
+record, so the partitions' line-numbered logs stay correct) and at exit.
+Scripts call :func:`finish_diagnostics` once their pipelines are done.
+"""
+import argparse
+import atexit
+import json
+import os
+import sys
+from typing import Dict, List, Optional, TextIO
+
+
+FORMATS = ("text", "jsonl", "summary")
+
+# Samples kept per category, and lines buffered before writing them.
+SAMPLES = 10
+BUFFER_LINES = 1024
+
+
+class Diagnostics:
+    """A channel of per-record messages; see the module documentation."""
+    def __init__(self, format: str = "text", samples: int = SAMPLES, buffer_lines: int = BUFFER_LINES):
+        self.configure(format, samples, buffer_lines)
+        self.counts: Dict[str, int] = {}
+        self.samples: Dict[str, List[str]] = {}
+        self._buffer: List[str] = []
+        self._stream: Optional[TextIO] = None
+
+    def configure(self, format: str = "text", samples: int = SAMPLES, buffer_lines: int = BUFFER_LINES) -> None:
+        if format not in FORMATS:
+            raise ValueError(f"Unknown diagnostics format {format!r}; expected one of {', '.join(FORMATS)}")
+        self.format = format
+        self.max_samples = samples
+        self.buffer_lines = max(1, buffer_lines)
+
+    def emit(self, category: str, message: str) -> None:
+        """Record ``message`` under ``category`` and, unless the format is
+        ``summary``, queue its line for stdout."""
+        count = self.counts.get(category, 0)
+        self.counts[category] = count + 1
+        if count < self.max_samples:
+            self.samples.setdefault(category, []).append(message)
+
+        if self.format == "summary":
+            return
+        stream = sys.stdout
+        if stream is not self._stream:
+            self.flush()
+            self._stream = stream
+        if self.format == "text":
+            self._buffer.append(f"{message}\n")
+        else:
+            self._buffer.append(json.dumps({"category": category, "message": message}) + "\n")
+        if len(self._buffer) >= self.buffer_lines:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write out the buffered lines."""
+        if self._buffer:
+            self._stream.write("".join(self._buffer))
+            self._buffer.clear()
+
+    def summary(self) -> dict:
+        """The count and samples of each category, as written by
+        :meth:`write_summary`."""
+        return {
+            category: {"count": count, "samples": self.samples.get(category, [])}
+            for category, count in self.counts.items()
+        }
+
+    def take_summary(self) -> dict:
+        """:meth:`summary`, and start counting again, e.g. for a partition
+        whose summary is merged back with :meth:`add_summary` later."""
+        summary = self.summary()
+        self.counts = {}
+        self.samples = {}
+        return summary
+
+    def add_summary(self, summary: dict) -> None:
+        """Count the categories of a :meth:`summary` as if emitted here."""
+        for category, recorded in summary.items():
+            self.counts[category] = self.counts.get(category, 0) + recorded["count"]
+            samples = self.samples.setdefault(category, [])
+            samples.extend(recorded["samples"][:max(0, self.max_samples - len(samples))])
+
+    def write_summary(self, path: str) -> None:
+        summary = self.summary()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as summary_fh:
+            json.dump({
+                "script": os.path.basename(sys.argv[0]),
+                "messages": sum(self.counts.values()),
+                "categories": summary,
+            }, summary_fh, indent=1)
+        os.replace(tmp_path, path)
+
+    def print_summary(self, file: Optional[TextIO] = None) -> None:
+        """Print each category's count and samples, for the ``summary``
+        format."""
+        file = file or sys.stdout
+        for category, recorded in self.summary().items():
+            print(f"{category}: {recorded['count']} messages", file=file)
+            for sample in recorded["samples"]:
+                print(f"    {sample}", file=file)
+
+
+# The channel the transforms emit to, configured by the scripts'
+# add_diagnostics_arguments() options.
+DIAGNOSTICS = Diagnostics()
+
+atexit.register(DIAGNOSTICS.flush)
+
+
+def add_diagnostics_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group("diagnostics")
+    group.add_argument("--diagnostics-format", choices=FORMATS, default="text",
+        help="How to print the messages about individual records to stdout (default: text):\n\t"
+             "text: one line per message, as they are emitted\n\t"
+             "jsonl: one JSON object with its category and message per line\n\t"
+             "summary: only the number of messages of each category and a few samples, at the end")
+    group.add_argument("--diagnostics-samples", type=int, default=SAMPLES,
+        help=f"Messages of each category kept as samples for the summaries (default: {SAMPLES}).")
+    group.add_argument("--diagnostics-summary",
+        help="Optional path at which to write a JSON summary of the messages of each category.")
+
+
+def configure_diagnostics(args: argparse.Namespace) -> Diagnostics:
+    """Configure :data:`DIAGNOSTICS` with :func:`add_diagnostics_arguments`'s
+    options."""
+    DIAGNOSTICS.configure(args.diagnostics_format, args.diagnostics_samples)
+    return DIAGNOSTICS
+
+
+def finish_diagnostics(args: argparse.Namespace) -> None:
+    """Write out the buffered messages and the summaries requested by
+    :func:`add_diagnostics_arguments`'s options."""
+    DIAGNOSTICS.flush()
+    if args.diagnostics_format == "summary":
+        DIAGNOSTICS.print_summary()
+    if args.diagnostics_summary:
+        DIAGNOSTICS.write_summary(args.diagnostics_summary)
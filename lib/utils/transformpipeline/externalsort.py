@@ -7,16 +7,105 @@ pulling every record into a list and calling ``sorted()`` -- which, at
 production scale (~9M records), was the dominant driver of each rule's peak
 memory.  These helpers stream the records through an external ``sort`` that
 spills to disk instead, so peak memory stays flat regardless of corpus size.
+Spill files are written behind by a background thread (see
+:class:`~.threadedio.WriteBehindFile`), so the pipeline keeps producing records
+while earlier ones reach the disk.  :func:`spill_to_sorted_tempfile` spills
+into buckets by strain and sorts each bucket's files in parallel as soon as
+they are complete, so most of the sorting overlaps the pipeline, then
+merges them.  With a memory budget (see
+:class:`~.memory.MemoryPlan`), ``sort`` gets a buffer of its share of it, and
+spill files small enough for that share are sorted in memory, in the same
+order, without spilling them again.
 """
+import heapq
 import json
 import os
+import re
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from . import LINE_NUMBER_KEY
+from .memory import MEMORY_PLAN
+from .threadedio import WriteBehindFile
 
 
-def spill_to_sorted_tempfile(records, id_key, output_dir):
+# The keys of a spill line's (strain, length, id, line-number) fields.  The
+# line number is unique per record, so they are a total order and sort
+# stability is irrelevant.
+SPILL_KEY_ARGS = ["-k1,1", "-k2,2nr", "-k3,3", "-k4,4n"]
+
+# The buckets spill_to_sorted_tempfile() partitions records into by strain,
+# and the size at which a bucket's file is sealed and sorted.
+SPILL_BUCKETS = 8
+SEGMENT_BYTES = 256 << 20
+
+
+def _open_spill_file(output_dir):
+    return tempfile.NamedTemporaryFile(
+        mode="w", encoding="utf-8", newline="\n", suffix=".presort.tsv",
+        dir=output_dir or ".", delete=False,
+    )
+
+
+def _sort_in_place(path, key_args, output_path=None, what="spill file", concurrent=1):
+    # LC_ALL=C makes sort compare bytewise, which matches Python's code-point
+    # ordering over UTF-8 key fields.  Files that fit the memory plan's sort
+    # share (split among the ``concurrent`` sorts) are sorted in memory
+    # instead, in the same order.
+    key = _in_memory_sort_key(key_args)
+    if key is not None and MEMORY_PLAN.sort_in_memory(what, os.path.getsize(path), concurrent):
+        _sort_in_memory(path, key, output_path or path)
+        return
+    subprocess.run(
+        ["sort", "-t", "\t", *MEMORY_PLAN.sort_args(concurrent), *key_args, "-o", output_path or path, path],
+        check=True,
+        env={**os.environ, "LC_ALL": "C"},
+    )
+
+
+_KEY_ARG = re.compile(r"-k(\d+),\1(n?r?)$")
+
+
+def _in_memory_sort_key(key_args):
+    """A key ordering the lines of a file as ``LC_ALL=C sort -t '\t'`` with
+    ``key_args`` would, or None for keys it doesn't mirror.  Lines whose keys
+    compare equal are ordered bytewise, like sort's last-resort comparison."""
+    fields = []
+    for key_arg in key_args:
+        match = _KEY_ARG.match(key_arg)
+        if match is None or match.group(2) == "r":
+            return None
+        fields.append((int(match.group(1)) - 1, match.group(2)))
+    last_field = max(field for field, _ in fields)
+
+    def key(line):
+        values = line.rstrip(b"\n").split(b"\t", last_field + 1)
+        values += [b""] * (last_field + 1 - len(values))
+        return (
+            *(
+                values[field] if not flags
+                else -_sort_numeric(values[field]) if flags == "nr"
+                else _sort_numeric(values[field])
+                for field, flags in fields
+            ),
+            line,
+        )
+    return key
+
+
+def _sort_in_memory(path, key, output_path):
+    with open(path, "rb") as unsorted:
+        lines = unsorted.readlines()
+    if lines and not lines[-1].endswith(b"\n"):
+        lines[-1] += b"\n"
+    lines.sort(key=key)
+    with open(output_path, "wb") as sorted_out:
+        sorted_out.writelines(lines)
+
+
+def spill_to_sorted_tempfile(records, id_key, output_dir, buckets=SPILL_BUCKETS, jobs=None,
+                             segment_bytes=SEGMENT_BYTES):
     """Stream ``records`` to a temp file and sort it on disk.
 
     Sorts by ``(strain asc, length desc, id_key asc, line-number asc)`` -- the
@@ -27,34 +116,227 @@ def spill_to_sorted_tempfile(records, id_key, output_dir):
     Each record becomes a line of five tab-separated fields: the four sort keys
     followed by the record as a JSON blob.  ``json.dumps`` escapes any tabs or
     newlines inside the record, so the blob is always a single safe field.
+
+    Rather than one ``sort`` over the whole spill once the pipeline is done,
+    the records are spilled into ``buckets`` files by a hash of their strain.
+    A bucket's file is sealed once it holds ``segment_bytes`` (a new one
+    taking its place) or the records run out, and sorted as soon as it is
+    sealed, up to ``jobs`` (by default, a CPU per bucket) at once, while the
+    pipeline goes on.  The sorted files are then merged into the one returned,
+    in the order a single sort gives.  With one job, the spill is sorted with
+    a single sort once complete instead.
     """
-    sort_tmp = tempfile.NamedTemporaryFile(
-        mode="w", encoding="utf-8", newline="\n", suffix=".presort.tsv",
-        dir=output_dir or ".", delete=False,
+    jobs = jobs or min(buckets, os.cpu_count() or 1)
+    if jobs <= 1:
+        # Nothing to sort in parallel: the merge would only add to one sort.
+        spill_path = spill_to_tempfile(records, id_key, output_dir)
+        sort_spill_file(spill_path)
+        return spill_path
+
+    spills = [None] * buckets
+    sizes = [0] * buckets
+    paths, sorts = [], []
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            def seal(bucket):
+                spill, spills[bucket] = spills[bucket], None
+                spill.close()
+                sorts.append(pool.submit(_sort_in_place, spill.name, SPILL_KEY_ARGS,
+                                         what="spill bucket", concurrent=jobs))
+
+            try:
+                for record in records:
+                    line = _spill_line(record, id_key)
+                    bucket = hash(record['strain']) % buckets
+                    spill = spills[bucket]
+                    if spill is None:
+                        spill = spills[bucket] = WriteBehindFile(_open_spill_file(output_dir))
+                        paths.append(spill.name)
+                        sizes[bucket] = 0
+                    spill.write(line)
+                    sizes[bucket] += len(line)
+                    if sizes[bucket] >= segment_bytes:
+                        seal(bucket)
+                for bucket, spill in enumerate(spills):
+                    if spill is not None:
+                        seal(bucket)
+            finally:
+                for spill in spills:
+                    if spill is not None:
+                        spill.close()
+            for sort in sorts:
+                sort.result()
+        sorted_path = paths[0] if len(paths) == 1 else _merge_spill_files(paths, output_dir)
+    except BaseException:
+        for path in paths:
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+    for path in paths:
+        if path != sorted_path:
+            os.unlink(path)
+    return sorted_path
+
+
+def _merge_spill_files(paths, output_dir):
+    """Merge the sorted spill files ``paths`` into a new temp file with
+    ``sort --merge``, which orders them as a single sort would, and return
+    its path."""
+    sort_tmp = _open_spill_file(output_dir)
+    sort_tmp.close()
+    if not paths:
+        return sort_tmp.name
+    try:
+        subprocess.run(
+            ["sort", "-m", "-t", "\t", *MEMORY_PLAN.sort_args(), *SPILL_KEY_ARGS, "-o", sort_tmp.name, *paths],
+            check=True,
+            env={**os.environ, "LC_ALL": "C"},
+        )
+    except BaseException:
+        os.unlink(sort_tmp.name)
+        raise
+    return sort_tmp.name
+
+
+def _spill_line(record, id_key):
+    return (
+        f"{record['strain']}\t{record['length']}\t"
+        f"{record[id_key]}\t{record[LINE_NUMBER_KEY]}\t"
+        f"{json.dumps(record, default=str)}\n"
     )
-    with sort_tmp:
+
+
+def spill_to_tempfile(records, id_key, output_dir):
+    """Stream ``records`` to an unsorted spill file for
+    :func:`sort_spill_file`, and return its path."""
+    sort_tmp = _open_spill_file(output_dir)
+    try:
+        with WriteBehindFile(sort_tmp) as spill:
+            for record in records:
+                spill.write(_spill_line(record, id_key))
+    except BaseException:
+        os.unlink(sort_tmp.name)
+        raise
+    return sort_tmp.name
+
+
+def spill_to_file(records, id_key, path, append=False, after_record=None):
+    """Stream ``records`` to the spill file ``path`` like
+    :func:`spill_to_tempfile`, appending to it if ``append``.
+
+    ``after_record(record, spill)``, if given, is called once each record was
+    written to ``spill`` (a :class:`~.threadedio.WriteBehindFile`, which
+    ``spill.flush()`` writes out), e.g. to checkpoint the spill.
+    """
+    with WriteBehindFile(open(path, "a" if append else "w", encoding="utf-8", newline="\n")) as spill:
         for record in records:
-            sort_tmp.write(
-                f"{record['strain']}\t{record['length']}\t"
-                f"{record[id_key]}\t{record[LINE_NUMBER_KEY]}\t"
-                f"{json.dumps(record, default=str)}\n"
-            )
+            spill.write(_spill_line(record, id_key))
+            if after_record is not None:
+                after_record(record, spill)
 
-    # LC_ALL=C makes sort compare bytewise, which matches Python's code-point
-    # ordering over the UTF-8 strain/id fields.  The (strain, length, id,
-    # line-number) tuple is a total order (line number is unique per record), so
-    # sort stability is irrelevant.
-    subprocess.run(
-        ["sort", "-t", "\t", "-k1,1", "-k2,2nr", "-k3,3", "-k4,4n",
-         "-o", sort_tmp.name, sort_tmp.name],
-        check=True,
-        env={**os.environ, "LC_ALL": "C"},
-    )
+
+def sort_spill_file(path, output_path=None):
+    """Sort a file written by :func:`spill_to_tempfile` in place, or into
+    ``output_path``.  Unlinks the sorted file (``path`` if in place) if
+    sorting fails."""
+    try:
+        _sort_in_place(path, SPILL_KEY_ARGS, output_path)
+    except BaseException:
+        if os.path.exists(output_path or path):
+            os.unlink(output_path or path)
+        raise
+
+
+def spill_keyed_lines_to_sorted_tempfile(lines, output_dir):
+    """Stream pre-formatted spill ``lines`` to a temp file and sort it on disk.
+
+    Each line must be ``key<TAB>line-number<TAB>JSON blob<NEWLINE>`` (see
+    :func:`format_keyed_line`).  Sorting by ``(key asc, line-number asc)``
+    reproduces a stable in-memory ``sorted(records, key=...)`` over the records
+    in input order.  Taking pre-formatted lines lets callers serialise records
+    in worker processes.  Returns the path to the sorted temp file; read it
+    back with :func:`read_sorted_records` and unlink it when done.
+    """
+    sort_tmp = _open_spill_file(output_dir)
+    try:
+        with WriteBehindFile(sort_tmp) as spill:
+            spill.writelines(lines)
+
+        sort_keyed_lines_file(sort_tmp.name)
+    except BaseException:
+        os.unlink(sort_tmp.name)
+        raise
     return sort_tmp.name
 
 
+def sort_keyed_lines_file(path):
+    """Sort a file of :func:`format_keyed_line` lines in place, by
+    ``(key asc, line-number asc)``."""
+    _sort_in_place(path, ["-k1,1", "-k2,2n"], what="keyed lines")
+
+
+def sort_line_numbered_file(path):
+    """Sort a file of ``line-number<TAB>text`` lines with unique line numbers
+    in place, by line number."""
+    _sort_in_place(path, ["-k1,1n"], what="line-numbered lines")
+
+
+def format_keyed_line(key, line_number, record):
+    """Format one ``record`` for :func:`spill_keyed_lines_to_sorted_tempfile`."""
+    return f"{key}\t{line_number}\t{json.dumps(record, default=str)}\n"
+
+
 def read_sorted_records(path):
-    """Yield the records written by :func:`spill_to_sorted_tempfile`, in order."""
+    """Yield the records written by :func:`spill_to_sorted_tempfile` or
+    :func:`spill_keyed_lines_to_sorted_tempfile`, in order.
+
+    The JSON blob is always the last field and never contains a raw tab.
+    """
     with open(path, "r", encoding="utf-8") as sorted_in:
         for line in sorted_in:
-            yield json.loads(line.split("\t", 4)[4])
+            yield json.loads(line.rpartition("\t")[2])
+
+
+_LEADING_NUMBER = re.compile(r"\s*(-?\d*\.?\d+)")
+_LEADING_NUMBER_BYTES = re.compile(rb"\s*(-?\d*\.?\d+)")
+
+
+def _sort_numeric(field):
+    # `sort -n` compares a field's leading number, and treats none as zero.
+    match = (_LEADING_NUMBER_BYTES if isinstance(field, bytes) else _LEADING_NUMBER).match(field)
+    return float(match.group(1)) if match else 0.0
+
+
+def _spill_sort_key(line):
+    # Slice out the key fields rather than split off the (long) JSON blob too.
+    length_at = line.index("\t") + 1
+    id_at = line.index("\t", length_at) + 1
+    line_number_at = line.index("\t", id_at) + 1
+    end = line.index("\t", line_number_at)
+    return (
+        line[:length_at - 1].encode("utf-8"),
+        -_sort_numeric(line[length_at:id_at - 1]),
+        line[id_at:line_number_at - 1].encode("utf-8"),
+        int(line[line_number_at:end]),
+    )
+
+
+def record_sort_key(record, id_key):
+    """The key :func:`spill_to_sorted_tempfile` orders ``record`` by, for
+    ordering a few records in memory the same way."""
+    return _spill_sort_key(
+        f"{record['strain']}\t{record['length']}\t{record[id_key]}\t{record[LINE_NUMBER_KEY]}\t"
+    )
+
+
+def merge_sorted_records(paths):
+    """Yield the records of several files sorted by
+    :func:`spill_to_sorted_tempfile` (or subsets of their lines), merged into
+    the order a single sort over all of them would give."""
+    files = [open(path, "r", encoding="utf-8") for path in paths]
+    try:
+        for line in heapq.merge(*files, key=_spill_sort_key):
+            yield json.loads(line.rpartition("\t")[2])
+    finally:
+        for fh in files:
+            fh.close()
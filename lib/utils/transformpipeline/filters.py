@@ -1,8 +1,9 @@
 from typing import Container , List, Dict
-import csv
 
 from . import LINE_NUMBER_KEY
 from ._base import Filter
+from .threadedio import WriteBehindFile
+from .tsvwriter import dict_writer, flush_writer
 
 
 class SequenceLengthFilter(Filter):
@@ -14,6 +15,8 @@ class SequenceLengthFilter(Filter):
 
 
 class LineNumberFilter(Filter):
+    line_number_only = True
+
     def __init__(self, line_numbers: Container[int]):
         self.line_numbers = line_numbers
 
@@ -24,20 +27,25 @@ class LineNumberFilter(Filter):
 class GenbankProblematicFilter(Filter):
     """
     Find records that are missing geographic regions or country to exclude them
-    from the final output and print them out separately for manual curation.
+    from the final output and print them out separately for manual curation,
+    in a background thread if `write_behind`, adding to the file if `append`.
     """
     def __init__(self, fileName: str ,
                  columns : List[str] ,
                  restval : str = '?' ,
                  extrasaction : str ='ignore' ,
                  delimiter : str = ',',
-                 dict_writer_kwargs : Dict[str,str] = {} ):
+                 dict_writer_kwargs : Dict[str,str] = {} ,
+                 write_behind : bool = False ,
+                 append : bool = False ):
 
         self.printProblem = fileName !=''
         if self.printProblem:
-            self.OUT = open( fileName , 'wt')
+            self.OUT = open( fileName , 'at' if append else 'wt')
+            if write_behind:
+                self.OUT = WriteBehindFile(self.OUT)
 
-            self.writer = csv.DictWriter(
+            self.writer = dict_writer(
                 self.OUT,
                 columns,
                 restval=restval,
@@ -45,12 +53,22 @@ class GenbankProblematicFilter(Filter):
                 delimiter=delimiter,
                 **dict_writer_kwargs
             )
-            self.writer.writeheader()
+            if not append:
+                self.writer.writeheader()
 
-    def __del__(self):
+    def flush(self):
+        if self.printProblem:
+            flush_writer(self.writer)
+            self.OUT.flush()
+
+    def close(self):
         if self.printProblem:
+            flush_writer(self.writer)
             self.OUT.close()
 
+    def __del__(self):
+        self.close()
+
 
     def test_value(self, inp: dict) -> bool:
 
@@ -0,0 +1,138 @@
+"""
+Fuse a ``|`` chain of pipeline components into generated per-record functions.
+
+Each stage of an unfused chain is a :class:`ChainedPipelineComponentIterator`,
+so every record is pulled through one ``__next__`` frame, one ``process``
+frame and one ``try`` block per stage.  :func:`compile_pipeline` rewrites the
+chain so that each run of consecutive :class:`Transformer` and :class:`Filter`
+stages becomes a single :class:`FusedComponent`, whose ``process`` is one
+generated loop calling every ``transform_value``/``test_value`` inline:
+
+    pipeline = compile_pipeline(
+        LineToJsonDataSource(fh) | RenameAndAddColumns() | SequenceLengthFilter(15000)
+    )
+
+The fused chain gives identical results, including errors: an exception in a
+stage is still handed to the data source's ``raise_exception``, so
+:class:`LineToJsonIterator` still reports the offending line.  Components that
+override ``process`` themselves are left as they are, between fused runs.
+"""
+from itertools import count
+from typing import List, Tuple
+
+from ._base import (
+    ChainedPipelineComponent,
+    DataSource,
+    Filter,
+    PipelineComponent,
+    PipelineException,
+    Transformer,
+)
+
+
+# Every stage mirrors ChainedPipelineComponentIterator.__next__: StopIteration
+# and PipelineException pass straight through, anything else is delegated to
+# the data source, and a stage whose error the data source swallows yields
+# None to the stages after it.
+_TRANSFORM_STAGE = """\
+        try:
+            entry = transform_{i}(entry)
+        except (StopIteration, PipelineException):
+            raise
+        except Exception as ex:
+            if iterator.raise_exception(ex):
+                raise
+            entry = None
+"""
+
+_FILTER_STAGE = """\
+        try:
+            if not test_{i}(entry):
+                continue
+        except (StopIteration, PipelineException):
+            raise
+        except Exception as ex:
+            if iterator.raise_exception(ex):
+                raise
+            entry = None
+"""
+
+
+def is_fusable(component: PipelineComponent) -> bool:
+    """Return True if ``component`` only customizes ``transform_value`` or
+    ``test_value``, so its ``process`` can be inlined."""
+    if isinstance(component, Transformer):
+        return type(component).process is Transformer.process
+    if isinstance(component, Filter):
+        return type(component).process is Filter.process
+    return False
+
+
+class FusedComponent(PipelineComponent):
+    """A pipeline component equivalent to ``stages[0] | stages[1] | ...`` for a
+    run of fusable transformers and filters."""
+    _ids = count()
+
+    def __init__(self, stages: List[PipelineComponent]):
+        if not all(is_fusable(stage) for stage in stages):
+            raise ValueError("FusedComponent only fuses Transformers and Filters that do not override process")
+        self.stages = list(stages)
+        self.source = self._generate_source()
+        namespace = {"PipelineException": PipelineException}
+        for i, stage in enumerate(self.stages):
+            if isinstance(stage, Transformer):
+                namespace[f"transform_{i}"] = stage.transform_value
+            else:
+                namespace[f"test_{i}"] = stage.test_value
+        filename = f"<fused pipeline {next(FusedComponent._ids)}>"
+        exec(compile(self.source, filename, "exec"), namespace)
+        # An instance attribute, so ChainedPipelineComponentIterator calls the
+        # generated function directly.  Popping it from its own globals avoids
+        # a reference cycle that would delay freeing (and closing) the stages.
+        self.process = namespace.pop("process")
+
+    def _generate_source(self) -> str:
+        lines = [
+            "def process(iterator):",
+            "    while True:",
+            "        entry = next(iterator)",
+        ]
+        for i, stage in enumerate(self.stages):
+            lines.append(f"        # {type(stage).__name__}")
+            template = _TRANSFORM_STAGE if isinstance(stage, Transformer) else _FILTER_STAGE
+            lines.append(template.format(i=i).rstrip("\n"))
+        lines.append("        return entry")
+        return "\n".join(lines) + "\n"
+
+    def __repr__(self) -> str:
+        return f"FusedComponent({', '.join(type(stage).__name__ for stage in self.stages)})"
+
+
+def _unchain(pipeline: DataSource) -> Tuple[DataSource, List[PipelineComponent]]:
+    """Split a chain into its root data source and its components, in order."""
+    components = []
+    while isinstance(pipeline, ChainedPipelineComponent):
+        components.append(pipeline.pipe_component)
+        pipeline = pipeline.data_source
+    components.reverse()
+    return pipeline, components
+
+
+def compile_pipeline(pipeline: DataSource) -> DataSource:
+    """Return a chain equivalent to ``pipeline`` with each run of fusable
+    stages replaced by one :class:`FusedComponent`."""
+    source, components = _unchain(pipeline)
+
+    fused: DataSource = source
+    run: List[PipelineComponent] = []
+    for component in components:
+        if is_fusable(component):
+            run.append(component)
+            continue
+        if run:
+            fused = ChainedPipelineComponent(fused, FusedComponent(run))
+            run = []
+        fused = ChainedPipelineComponent(fused, component)
+    if run:
+        fused = ChainedPipelineComponent(fused, FusedComponent(run))
+    return fused
@@ -0,0 +1,410 @@
+"""
+Opt-in memory accounting for the ingest scripts.
+
+Peak memory is what limits how far the transforms scale, so a
+:class:`MemoryReport` records where it goes: a background thread samples the
+process's resident set size (RSS) while the script runs, each phase of the
+script (loading inputs, the pipeline, the sort, ...) records its peak RSS, and
+the large structures it names with :meth:`MemoryReport.track` are sized at the
+end of the phase.  The report is written as JSON, next to the Snakemake
+benchmark files when run by the workflow, after every phase.
+
+Each phase can be given a budget of peak RSS in MiB; a phase over its budget
+prints a warning or, with ``--memory-budget-action fail``, raises
+:class:`MemoryBudgetExceeded` once the report is written.
+
+Without ``--memory-report`` the report is disabled and every method is a
+no-op, so scripts use it unconditionally.
+
+The budget of every phase is also the script's overall memory budget, which
+the :data:`MEMORY_PLAN` splits among the things whose size the scripts choose
+(see :class:`MemoryPlan`): the ``sort`` buffer, how far input is read ahead
+and output written behind, cache capacities, and whether a spill file is
+sorted in memory or by ``sort``.  Scripts without these options, and the
+workflow (its ``memory_budget`` config), set it with the
+:data:`MEMORY_BUDGET_ENV` environment variable instead.
+"""
+import argparse
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from array import array
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+MIB = 1 << 20
+
+# Containers with more items than this are sized from their first
+# SAMPLE_ITEMS items, which keeps sizing a set of millions of strains quick.
+SAMPLE_ITEMS = 100_000
+
+
+# The environment variable giving a script's overall memory budget in MiB,
+# when it isn't given with --memory-budget MIB.
+MEMORY_BUDGET_ENV = "INGEST_MEMORY_BUDGET"
+
+# The share of the overall budget each use of memory the scripts plan gets.
+PLAN_SHARES = {
+    # the `sort` buffer, or sorting a spill file in memory
+    "sort": 0.5,
+    # the input lines read ahead of a pipeline, per input
+    "read ahead": 0.125,
+    # the output written behind a pipeline, per output
+    "write behind": 0.03125,
+    # the batches of lines in flight in the worker processes
+    "batches": 0.125,
+    # caches of decoded rows
+    "cache": 0.0625,
+}
+
+# Sorting in memory holds the lines read, their keys and the list of them;
+# the file must fit in the sort share this many times over.
+IN_MEMORY_SORT_OVERHEAD = 2
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    pass
+
+
+def current_rss() -> Optional[int]:
+    """The resident set size of this process in bytes, or None if unknown."""
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss(who: str = "self") -> Optional[int]:
+    """Peak RSS in bytes of this process (``who="self"``) or of its largest
+    finished child process (``who="children"``), e.g. ``sort``.  A forked
+    child's peak includes the pages it shared with this process until it
+    exec'd."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+
+def _mib(size: Optional[int]) -> Optional[float]:
+    return None if size is None else round(size / MIB, 1)
+
+
+def _items(obj) -> Optional[Iterator]:
+    if isinstance(obj, dict):
+        return (item for pair in obj.items() for item in pair)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return iter(obj)
+    return None
+
+
+def estimate_size(obj) -> Dict[str, object]:
+    """Estimate the bytes of Python heap ``obj`` holds: the object itself,
+    the contents of containers and the attributes of instances, each object
+    counted once.  Memory-mapped data (e.g. a loaded annotation store) is not
+    counted; it shows up in the RSS as it is read.
+
+    Returns ``{"bytes": ..., "items": ..., "estimated": ...}``, where
+    ``estimated`` says if any container was sized from a sample of its items.
+    """
+    seen = set()
+    estimated = False
+
+    def size_of(obj) -> float:
+        nonlocal estimated
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        size = sys.getsizeof(obj)
+        if isinstance(obj, (str, bytes, bytearray, int, float, bool, array, memoryview)) or obj is None:
+            return size
+
+        items = _items(obj)
+        if items is not None:
+            count = len(obj) * (2 if isinstance(obj, dict) else 1)
+            sample = list(islice(items, SAMPLE_ITEMS))
+            sampled = sum(size_of(item) for item in sample)
+            if len(sample) < count:
+                estimated = True
+                sampled = sampled * count / len(sample)
+            return size + sampled
+
+        attributes = getattr(obj, "__dict__", None)
+        if attributes is not None:
+            size += size_of(attributes)
+        for slot in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, slot):
+                size += size_of(getattr(obj, slot))
+        return size
+
+    size = size_of(obj)
+    return {
+        "bytes": int(size),
+        "items": len(obj) if hasattr(obj, "__len__") else None,
+        "estimated": estimated,
+    }
+
+
+def parse_budget(value: str) -> Tuple[str, float]:
+    """Parse a ``PHASE=MIB`` budget, or ``MIB`` for every phase (``"*"``).
+
+    >>> parse_budget("pipeline=4096")
+    ('pipeline', 4096.0)
+    >>> parse_budget("8192")
+    ('*', 8192.0)
+    """
+    phase, _, mib = value.rpartition("=")
+    try:
+        return phase or "*", float(mib)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid memory budget {value!r}, expected PHASE=MIB or MIB")
+
+
+def budget_from_environment() -> Optional[float]:
+    """The overall memory budget in MiB given by :data:`MEMORY_BUDGET_ENV`,
+    if any."""
+    value = os.environ.get(MEMORY_BUDGET_ENV, "").strip()
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"invalid {MEMORY_BUDGET_ENV}={value!r}, expected MiB")
+
+
+class MemoryPlan:
+    """
+    Splits a script's overall memory budget of ``budget_mib`` among its uses
+    of memory (see :data:`PLAN_SHARES`), and records the choices it made.
+
+    Each method returns what the code used before, its default, when there is
+    no budget, so the scripts behave as they did unless given one.  With a
+    budget, each choice is printed to stderr the first time it is made and
+    kept in :attr:`choices` for the memory report.
+    """
+    def __init__(self, budget_mib: Optional[float] = None):
+        self.configure(budget_mib)
+
+    def configure(self, budget_mib: Optional[float]) -> None:
+        self.budget_mib = budget_mib
+        self.choices: Dict[str, object] = {}
+
+    def share(self, use: str) -> Optional[int]:
+        """The bytes of the budget for ``use``, one of :data:`PLAN_SHARES`,
+        or None without a budget."""
+        if self.budget_mib is None:
+            return None
+        return int(self.budget_mib * MIB * PLAN_SHARES[use])
+
+    def choose(self, what: str, choice):
+        """Record ``choice`` for ``what``, printing it the first time."""
+        if self.choices.get(what, self) != choice:
+            print(f"memory plan ({self.budget_mib:g} MiB budget): {what}: {choice}", file=sys.stderr)
+        self.choices[what] = choice
+        return choice
+
+    def items(self, what: str, use: str, item_bytes: int, default: int, minimum: int = 1) -> int:
+        """How many items of about ``item_bytes`` to hold for ``what``, e.g.
+        chunks of lines, batches or cached rows: as many as ``use``'s share
+        fits, at least ``minimum`` and at most ``default`` -- more than the
+        code held before gains nothing -- or ``default`` without a budget."""
+        share = self.share(use)
+        if share is None:
+            return default
+        return self.choose(what, max(minimum, min(default, share // max(1, item_bytes))))
+
+    def cache_entries(self, what: str, entry_bytes: int, default: int) -> int:
+        """The capacity of a cache of ``what``, each entry about
+        ``entry_bytes``: as many as the cache share fits, which may be more
+        than ``default``."""
+        share = self.share("cache")
+        if share is None:
+            return default
+        return self.choose(f"{what} cache entries", share // max(1, entry_bytes))
+
+    def sort_in_memory(self, what: str, size: int, concurrent: int = 1) -> bool:
+        """Whether to sort the ``size`` bytes of ``what`` in memory rather
+        than with an external ``sort``: only with a budget whose sort share,
+        split among ``concurrent`` sorts, holds it (see
+        :data:`IN_MEMORY_SORT_OVERHEAD`)."""
+        share = self.share("sort")
+        if share is None:
+            return False
+        in_memory = size * IN_MEMORY_SORT_OVERHEAD <= share // max(1, concurrent)
+        self.choose(f"sort {what}", "in memory" if in_memory else "with sort")
+        return in_memory
+
+    def sort_args(self, concurrent: int = 1) -> List[str]:
+        """The options giving an external ``sort`` its buffer size, one of
+        ``concurrent`` sorts' share."""
+        share = self.share("sort")
+        if share is None:
+            return []
+        mib = self.choose("sort buffer MiB", max(1, share // max(1, concurrent) // MIB))
+        return ["-S", f"{mib}M"]
+
+    def report(self) -> dict:
+        return {"budget_mib": self.budget_mib, "choices": self.choices}
+
+
+# The plan of the running script, configured by memory_report_from_args() or,
+# in scripts without add_memory_arguments() options, from MEMORY_BUDGET_ENV.
+MEMORY_PLAN = MemoryPlan(budget_from_environment())
+
+
+class MemoryReport:
+    """Samples RSS and records per-phase memory use to the JSON file
+    ``path``; disabled (a no-op) if ``path`` is None.
+
+    ``budgets`` maps phase names (or ``"*"``, for the others) to a peak RSS
+    in MiB, and ``budget_action`` is ``"warn"`` or ``"fail"``.
+    """
+    def __init__(self, path: Optional[str] = None, sample_interval: float = 0.5,
+                 budgets: Optional[Dict[str, float]] = None, budget_action: str = "warn"):
+        self.path = path
+        self.sample_interval = sample_interval
+        self.budgets = budgets or {}
+        self.budget_action = budget_action
+        self.phases: List[dict] = []
+        self.samples: List[List[float]] = []
+        self._tracked: Dict[str, object] = {}
+        self._phase_peak = 0
+        self._start = time.monotonic()
+        self._stopped = threading.Event()
+        self._thread = None
+        if self.enabled:
+            self._thread = threading.Thread(target=self._sample, name="memory-report", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def _take_sample(self) -> Optional[int]:
+        rss = current_rss()
+        if rss is not None:
+            self.samples.append([round(time.monotonic() - self._start, 3), _mib(rss)])
+            self._phase_peak = max(self._phase_peak, rss)
+        return rss
+
+    def _sample(self) -> None:
+        while not self._stopped.wait(self.sample_interval):
+            self._take_sample()
+
+    def track(self, name: str, obj):
+        """Size ``obj`` as ``name`` at the end of the current phase.  Returns
+        ``obj``, which is only referenced until then."""
+        if self.enabled:
+            self._tracked[name] = obj
+        return obj
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Record the memory use of the ``with`` block as phase ``name``."""
+        if not self.enabled:
+            yield self
+            return
+
+        start = time.monotonic()
+        self._phase_peak = 0
+        self._take_sample()
+        yield self
+        end_rss = self._take_sample()
+
+        structures = {
+            structure: estimate_size(obj)
+            for structure, obj in self._tracked.items()
+        }
+        self._tracked.clear()
+
+        budget = self.budgets.get(name, self.budgets.get("*"))
+        peak_mib = _mib(self._phase_peak or None)
+        over_budget = budget is not None and peak_mib is not None and peak_mib > budget
+        self.phases.append({
+            "name": name,
+            "start_seconds": round(start - self._start, 3),
+            "seconds": round(time.monotonic() - start, 3),
+            "peak_rss_mib": peak_mib,
+            "end_rss_mib": _mib(end_rss),
+            "max_rss_mib": _mib(max_rss()),
+            "children_max_rss_mib": _mib(max_rss("children")),
+            "budget_mib": budget,
+            "over_budget": over_budget,
+            "structures": structures,
+        })
+        self.write()
+
+        if over_budget:
+            message = f"phase {name!r} peaked at {peak_mib} MiB RSS, over its budget of {budget} MiB"
+            if self.budget_action == "fail":
+                raise MemoryBudgetExceeded(message)
+            print(f"WARNING: {message}", file=sys.stderr)
+
+    def write(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        report = {
+            "script": os.path.basename(sys.argv[0]),
+            "argv": sys.argv,
+            "sample_interval": self.sample_interval,
+            "max_rss_mib": _mib(max_rss()),
+            "plan": MEMORY_PLAN.report(),
+            "phases": self.phases,
+            "samples": self.samples,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as report_fh:
+            json.dump(report, report_fh, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def close(self) -> None:
+        """Stop sampling and write the final report."""
+        if not self.enabled or self._stopped.is_set():
+            return
+        atexit.unregister(self.close)
+        self._stopped.set()
+        self._thread.join()
+        self._take_sample()
+        self.write()
+
+
+def add_memory_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group("memory accounting")
+    group.add_argument("--memory-report",
+        help="Optional path at which to write a JSON report of RSS over time, the peak RSS of\n"
+             "each phase and the sizes of its large structures.")
+    group.add_argument("--memory-budget", action="append", default=[], type=parse_budget, metavar="[PHASE=]MIB",
+        help="Peak RSS budget in MiB of a phase, or of every phase without PHASE= (repeatable).\n"
+             "Only checked with --memory-report.  The budget of every phase (by default\n"
+             f"${MEMORY_BUDGET_ENV}) is also the script's overall budget, which it splits among\n"
+             "its sort buffer, read-ahead and write-behind buffers and caches, and which\n"
+             "decides whether it sorts in memory.  Without one, their defaults are used.")
+    group.add_argument("--memory-budget-action", choices=["warn", "fail"], default="warn",
+        help="What to do when a phase exceeds its budget (default: warn).")
+    group.add_argument("--memory-sample-interval", type=float, default=0.5,
+        help="Seconds between RSS samples (default: 0.5).")
+
+
+def memory_report_from_args(args: argparse.Namespace) -> MemoryReport:
+    """The :class:`MemoryReport` requested by :func:`add_memory_arguments`'s
+    options, after configuring the :data:`MEMORY_PLAN` with their overall
+    budget."""
+    budgets = dict(args.memory_budget)
+    if "*" not in budgets and MEMORY_PLAN.budget_mib is not None:
+        budgets["*"] = MEMORY_PLAN.budget_mib
+    MEMORY_PLAN.configure(budgets.get("*"))
+    return MemoryReport(
+        args.memory_report,
+        sample_interval=args.memory_sample_interval,
+        budgets=budgets,
+        budget_action=args.memory_budget_action,
+    )
@@ -0,0 +1,266 @@
+"""
+Persistent byte-offset index over an NDJSON file such as ``gisaid.ndjson``.
+
+The raw NDJSON caches are several GB, so any targeted look at a few records
+(re-emitting one, checking why a strain was dropped, feeding a side process)
+would otherwise scan the whole file.  An :class:`NdjsonIndex` maps each
+record's line number (:data:`LINE_NUMBER_KEY`, counting from 1) to the byte
+offset and length of its line, and each accession to its line numbers, so a
+record is one seek away.  :class:`IndexedNdjsonDataSource` feeds any subset
+of records into a pipeline that way.
+
+Indexes are built either by a separate scan with :func:`build_ndjson_index`
+or, for free, while a transform reads the file: wrap its input with
+:meth:`NdjsonIndexBuilder.recorded_lines`, add a :class:`RecordIndexKeys`
+stage after ``StandardizeData`` and :meth:`~NdjsonIndexBuilder.save` at the
+end.  Like :mod:`.tsvindex`, an index records the size and mtime of the file
+it was built from and is rejected once the file changes.
+"""
+import json
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from . import LINE_NUMBER_KEY
+from ._base import DataSource, DataSourceIterator, Transformer
+from .datasource import LineToJsonIterator
+from .externalsort import spill_keyed_lines_to_sorted_tempfile
+
+
+INDEX_MAGIC = b"NDJIDX01"
+# magic, NDJSON size, NDJSON mtime (ns), number of records, number of keys,
+# key blob length
+_HEADER = struct.Struct("<8sQQQQQ")
+
+
+def default_index_path(ndjson_path: str) -> str:
+    return f"{ndjson_path}.idx"
+
+
+def _ndjson_stamp(ndjson_path: str) -> Tuple[int, int]:
+    stat = os.stat(ndjson_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class NdjsonIndexBuilder:
+    """Collects line offsets and accessions for an :class:`NdjsonIndex`.
+
+    Accessions are spilled to an unnamed temporary file in ``tmp_dir`` (or to
+    ``keys_path``, appending to it) and sorted on disk when saving, so
+    building needs little memory.  :meth:`save_progress` and
+    :meth:`restore_progress` let a checkpointed run resume building.
+    """
+    def __init__(self, tmp_dir: Optional[str] = None, keys_path: Optional[str] = None):
+        self.tmp_dir = tmp_dir
+        if tmp_dir:
+            os.makedirs(tmp_dir, exist_ok=True)
+        self.line_offsets = array("Q", [0])
+        if keys_path:
+            self._keys = open(keys_path, "a+", encoding="utf-8", newline="\n")
+        else:
+            self._keys = tempfile.TemporaryFile("w+", encoding="utf-8", newline="\n", dir=tmp_dir)
+        self._saved_offsets = 0
+
+    def add_line(self, length: int) -> None:
+        """Record the next line of the file, ``length`` bytes long including
+        its newline."""
+        self.line_offsets.append(self.line_offsets[-1] + length)
+
+    def add_key(self, key: str, line_number: int) -> None:
+        if "\t" in key or "\n" in key:
+            return
+        self._keys.write(f"{key}\t{line_number}\t\n")
+
+    def recorded_lines(self, fh: TextIO) -> Iterator[str]:
+        """Yield the lines of the text file ``fh`` like iterating it would,
+        recording their byte offsets."""
+        for line in fh.buffer:
+            self.add_line(len(line))
+            text = line.decode(fh.encoding)
+            # as text-mode (universal newlines) reading would
+            yield text[:-2] + "\n" if text.endswith("\r\n") else text
+
+    def save_progress(self, line_number: int, offsets_path: str) -> dict:
+        """Write the offsets recorded up to line ``line_number`` to
+        ``offsets_path`` (adding to what the last call wrote) and the keys
+        added so far to ``keys_path``, for :meth:`restore_progress`."""
+        self._keys.flush()
+        count = line_number + 1
+        with open(offsets_path, "r+b" if self._saved_offsets else "wb") as offsets_fh:
+            offsets_fh.seek(self._saved_offsets * self.line_offsets.itemsize)
+            # a copy: the reading thread may be adding offsets
+            self.line_offsets[self._saved_offsets:count].tofile(offsets_fh)
+            offsets_fh.truncate()
+        self._saved_offsets = count
+        return {"lines": line_number}
+
+    def restore_progress(self, progress: dict, offsets_path: str) -> None:
+        """Continue from a :meth:`save_progress` of a builder with the same
+        ``keys_path``, whose files hold no more than was saved then; the next
+        line recorded is line ``progress["lines"] + 1``."""
+        count = progress["lines"] + 1
+        self.line_offsets = array("Q")
+        with open(offsets_path, "rb") as offsets_fh:
+            self.line_offsets.fromfile(offsets_fh, count)
+        self._saved_offsets = count
+
+    def save(self, index_path: str, ndjson_path: str) -> None:
+        size, mtime_ns = _ndjson_stamp(ndjson_path)
+        if self.line_offsets[-1] != size:
+            raise ValueError(f"Only {self.line_offsets[-1]} of the {size} bytes of {ndjson_path} were indexed")
+
+        self._keys.seek(0)
+        sorted_path = spill_keyed_lines_to_sorted_tempfile(self._keys, self.tmp_dir)
+        key_offsets = array("Q", [0])
+        key_line_numbers = array("Q")
+        blob = bytearray()
+        try:
+            with open(sorted_path, "r", encoding="utf-8") as sorted_keys:
+                for line in sorted_keys:
+                    key, line_number, _ = line.split("\t", 2)
+                    blob += key.encode("utf-8")
+                    key_offsets.append(len(blob))
+                    key_line_numbers.append(int(line_number))
+        finally:
+            os.unlink(sorted_path)
+
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "wb") as index_fh:
+            index_fh.write(_HEADER.pack(
+                INDEX_MAGIC, size, mtime_ns, len(self.line_offsets) - 1, len(key_line_numbers), len(blob)))
+            self.line_offsets.tofile(index_fh)
+            key_offsets.tofile(index_fh)
+            key_line_numbers.tofile(index_fh)
+            index_fh.write(blob)
+        os.replace(tmp_path, index_path)
+
+
+class RecordIndexKeys(Transformer):
+    """Add each record's ``key_columns`` values to an :class:`NdjsonIndexBuilder`.
+    Place it after ``StandardizeData``, which sets the record's line number."""
+    def __init__(self, builder: NdjsonIndexBuilder, key_columns: List[str]):
+        self.builder = builder
+        self.key_columns = key_columns
+
+    def transform_value(self, entry: dict) -> dict:
+        for column in self.key_columns:
+            if entry.get(column):
+                self.builder.add_key(entry[column], entry[LINE_NUMBER_KEY])
+        return entry
+
+
+def build_ndjson_index(ndjson_path: str, key_fields: List[str], index_path: Optional[str] = None) -> str:
+    """Scan ``ndjson_path`` and write an index of the raw ``key_fields`` of
+    its records (e.g. ``covv_accession_id``) to ``index_path`` (default: next to
+    the file).  Returns the index path."""
+    index_path = index_path or default_index_path(ndjson_path)
+    builder = NdjsonIndexBuilder(tmp_dir=os.path.dirname(os.path.abspath(index_path)))
+    with open(ndjson_path, "r", encoding="utf-8") as ndjson_fh:
+        for line_number, line in enumerate(builder.recorded_lines(ndjson_fh), 1):
+            record = json.loads(line)
+            for field in key_fields:
+                if record.get(field):
+                    builder.add_key(str(record[field]), line_number)
+    builder.save(index_path, ndjson_path)
+    return index_path
+
+
+class NdjsonIndex:
+    """A read-only, memory-mapped view of an NDJSON file through its index."""
+    def __init__(self, ndjson_path: str, index_path: Optional[str] = None):
+        self.ndjson_path = str(ndjson_path)
+        self.index_path = str(index_path or default_index_path(self.ndjson_path))
+
+        with open(self.index_path, "rb") as index_fh:
+            self._index = mmap.mmap(index_fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, mtime_ns, records, keys, blob_length = _HEADER.unpack_from(self._index)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{self.index_path} is not an NDJSON index")
+        if (size, mtime_ns) != _ndjson_stamp(self.ndjson_path):
+            raise ValueError(f"{self.index_path} is out of date with {self.ndjson_path}")
+
+        view = memoryview(self._index)
+        position = _HEADER.size
+
+        def take(count, typecode):
+            nonlocal position
+            section = view[position:position + 8 * count].cast(typecode)
+            position += 8 * count
+            return section
+
+        self._line_offsets = take(records + 1, "Q")
+        self._key_offsets = take(keys + 1, "Q")
+        self._key_line_numbers = take(keys, "Q")
+        self._key_blob = view[position:position + blob_length]
+
+        with open(self.ndjson_path, "rb") as ndjson_fh:
+            self._ndjson = mmap.mmap(ndjson_fh.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self._line_offsets) - 1
+
+    def span(self, line_number: int) -> Tuple[int, int]:
+        """Return the ``(byte offset, length)`` of the record at ``line_number``."""
+        if not 1 <= line_number <= len(self):
+            raise IndexError(f"No record at line {line_number}")
+        start = self._line_offsets[line_number - 1]
+        return start, self._line_offsets[line_number] - start
+
+    def read_line(self, line_number: int) -> str:
+        offset, length = self.span(line_number)
+        return str(self._ndjson[offset:offset + length], "utf-8")
+
+    def _key(self, position: int) -> bytes:
+        return bytes(self._key_blob[self._key_offsets[position]:self._key_offsets[position + 1]])
+
+    def line_numbers(self, key: str) -> List[int]:
+        """Return the line numbers of the records indexed under ``key``."""
+        target = key.encode("utf-8")
+        lo, hi = 0, len(self._key_line_numbers)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        while lo < len(self._key_line_numbers) and self._key(lo) == target:
+            found.append(self._key_line_numbers[lo])
+            lo += 1
+        return found
+
+    def close(self) -> None:
+        for section in (self._line_offsets, self._key_offsets, self._key_line_numbers, self._key_blob):
+            section.release()
+        self._index.close()
+        if isinstance(self._ndjson, mmap.mmap):
+            self._ndjson.close()
+
+
+class IndexedNdjsonIterator(LineToJsonIterator):
+    def __init__(self, index: NdjsonIndex, line_numbers: Iterable[int]):
+        super().__init__(())
+        self.index = index
+        self.line_numbers_iter = iter(line_numbers)
+
+    def __next__(self) -> dict:
+        line_number = next(self.line_numbers_iter)
+        self.last_line = self.index.read_line(line_number)
+        entry = json.loads(self.last_line)
+        entry[LINE_NUMBER_KEY] = line_number
+        return entry
+
+
+class IndexedNdjsonDataSource(DataSource):
+    """This data source reads the records at ``line_numbers`` (in that order)
+    by seeking through ``index``.  Each record carries its line number in the
+    full file under :data:`LINE_NUMBER_KEY`, which ``StandardizeData`` keeps."""
+    def __init__(self, index: NdjsonIndex, line_numbers: Iterable[int]):
+        self.index = index
+        self.line_numbers = line_numbers
+
+    def __iter__(self) -> DataSourceIterator:
+        return IndexedNdjsonIterator(self.index, self.line_numbers)
@@ -0,0 +1,55 @@
+"""
+Order-preserving, bounded parallel map for the transform scripts.
+
+``multiprocessing.Pool.imap`` eagerly drains its input into the task queue,
+so feeding it a multi-GB NDJSON file holds the whole file in memory.  These
+helpers keep only a fixed number of batches in flight instead, so peak memory
+stays flat regardless of input size while output order matches input order.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def numbered_batches(items: Iterable[T], size: int, start: int = 1) -> Iterator[Tuple[int, List[T]]]:
+    """Yield ``(number of first item, batch)`` for consecutive batches of
+    at most ``size`` items, numbering items from ``start``."""
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield start, batch
+        start += len(batch)
+
+
+def ordered_parallel_map(
+        func: Callable[[T], R],
+        items: Iterable[T],
+        jobs: int,
+        max_pending: Optional[int] = None,
+) -> Iterator[R]:
+    """Yield ``func(item)`` for each of ``items``, in input order, using up to
+    ``jobs`` worker processes.
+
+    At most ``max_pending`` (default ``2 * jobs``) items are submitted but not
+    yet yielded at any time.  With ``jobs <= 1`` this is a plain in-process
+    ``map``.  ``func`` must be picklable (i.e. a module-level function).
+    """
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+
+    max_pending = max_pending or 2 * jobs
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,317 @@
+"""
+Helpers for running a transform as independent partitions (map/reduce).
+
+The transforms deduplicate by ``strain``, so records routed to partitions by a
+hash of their final strain can be curated, sorted and deduplicated by each
+partition on its own, on any node.  Outputs that must come out in input order
+are written per partition with each line prefixed by the record's line
+number (:data:`LINE_NUMBER_KEY`), and merged back by it with
+:func:`merge_line_numbered`; see :func:`.externalsort.merge_sorted_records` for
+the sorted metadata.  CSV side outputs (which may hold quoted newlines)
+instead carry the line number as their first column and are merged with
+:func:`merge_line_numbered_rows`.
+
+A transform describes its pipeline as a :class:`PartitionedTransform`, which
+:func:`run_partitioned` runs locally, or :func:`map_partitions`,
+:func:`run_partition` and :func:`reduce_partitions` step by step.
+"""
+import contextlib
+import csv
+import heapq
+import json
+import os
+import shutil
+import sys
+import tempfile
+import zlib
+from abc import abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Callable, Iterable, Iterator, List, Optional, TextIO
+
+from . import LINE_NUMBER_KEY
+from ._base import DataSource, Transformer
+from .datasource import LineToJsonDataSource
+from .dedup import KeptStrainNames, keep_first_per_strain
+from .diagnostics import DIAGNOSTICS
+from .externalsort import merge_sorted_records, spill_to_sorted_tempfile
+from .filters import LineNumberFilter
+from .fusion import compile_pipeline
+from .ndjsonindex import NdjsonIndexBuilder
+from .tsvwriter import TsvWriter
+
+
+def partition_of(key: str, partitions: int) -> int:
+    """Return the partition (``0 <= n < partitions``) of ``key``, the same in
+    every process and on every node."""
+    return zlib.crc32(key.encode("utf-8")) % partitions
+
+
+def partition_path(directory: str, partition: int, suffix: str) -> str:
+    return os.path.join(directory, f"partition-{partition:04d}{suffix}")
+
+
+class LineNumberTaggedWriter:
+    """A text stream that writes each complete line to ``fh`` prefixed by
+    ``line_number<TAB>``, for output printed while processing a record (e.g.
+    redirected ``stdout``).  Set :attr:`line_number` before each record, e.g.
+    with :class:`TagLineNumber`."""
+    def __init__(self, fh: TextIO):
+        self.fh = fh
+        self.line_number = 0
+        self._pending = ""
+
+    def write(self, text: str) -> int:
+        *lines, self._pending = (self._pending + text).split("\n")
+        for line in lines:
+            self.fh.write(f"{self.line_number}\t{line}\n")
+        return len(text)
+
+    def flush(self) -> None:
+        self.fh.flush()
+
+    def close(self) -> None:
+        if self._pending:
+            self.write("\n")
+
+
+class TagLineNumber(Transformer):
+    """Point a :class:`LineNumberTaggedWriter` at each record as it passes,
+    having written out the diagnostics of the record before."""
+    def __init__(self, writer: LineNumberTaggedWriter):
+        self.writer = writer
+
+    def transform_value(self, entry: dict) -> dict:
+        DIAGNOSTICS.flush()
+        self.writer.line_number = entry[LINE_NUMBER_KEY]
+        return entry
+
+
+def _line_numbered_lines(path: str) -> Iterator[tuple]:
+    with open(path, "r", encoding="utf-8", newline="") as fh:
+        for line in fh:
+            line_number, _, rest = line.partition("\t")
+            yield int(line_number), rest
+
+
+def merge_line_numbered(paths: Iterable[str]) -> Iterator[str]:
+    """Merge files of ``line_number<TAB>text`` lines, each in line number
+    order, and yield the texts in line number order."""
+    streams: List[Iterator[tuple]] = [_line_numbered_lines(path) for path in paths]
+    for _, text in heapq.merge(*streams, key=lambda item: item[0]):
+        yield text
+
+
+def _line_numbered_rows(path: str, delimiter: str) -> Iterator[list]:
+    with open(path, "r", encoding="utf-8", newline="") as fh:
+        rows = csv.reader(fh, delimiter=delimiter)
+        next(rows, None)  # header
+        yield from rows
+
+
+def merge_line_numbered_rows(paths: Iterable[str], delimiter: str = "\t") -> Iterator[list]:
+    """Merge CSV files whose first column is the line number, each in line
+    number order, and yield their rows without it in line number order.  The
+    header row of each file is skipped."""
+    streams = [_line_numbered_rows(path, delimiter) for path in paths]
+    for row in heapq.merge(*streams, key=lambda row: int(row[0])):
+        yield row[1:]
+
+
+class PartitionedTransform:
+    """
+    The pipeline of a transform, split where records are routed to
+    partitions, for its parsed ``args``: ``partitions``, ``partition_dir``,
+    ``jobs``, ``ndjson_index``, ``output_metadata``, ``output_fasta``,
+    ``sorted_fasta`` and ``newline``.
+    """
+    #: the column of the input's record ids, by which sorted records are tied
+    id_key: str
+    metadata_columns: List[str]
+
+    def __init__(self, args):
+        self.args = args
+
+    @property
+    @abstractmethod
+    def input_path(self) -> str:
+        """The NDJSON input."""
+        pass
+
+    @abstractmethod
+    def standardized_records(self, lines: Iterable[str], index_builder: Optional[NdjsonIndexBuilder]) -> DataSource:
+        """The records of the NDJSON ``lines`` up to the length filter, with
+        their keys recorded in ``index_builder`` if given."""
+        pass
+
+    @abstractmethod
+    def final_strain(self) -> Callable[[dict], str]:
+        """A function giving the strain a standardized record has once
+        curated, which it is routed by."""
+        pass
+
+    @abstractmethod
+    def curate(self, records: DataSource, raw_metadata) -> DataSource:
+        """The standardized ``records`` curated up to sorting, written as raw
+        metadata by the ``raw_metadata`` stage on the way."""
+        pass
+
+    @abstractmethod
+    def raw_metadata_writer(self, path: str, columns: List[str]):
+        """The stage writing the ``columns`` of the raw metadata to ``path``."""
+        pass
+
+    @abstractmethod
+    def write_metadata(self, records: Iterable[dict], fasta_fh: TextIO) -> None:
+        """Write the outputs of the kept, sorted ``records``, and with
+        ``sorted_fasta`` their sequences to ``fasta_fh``."""
+        pass
+
+
+def map_partitions(transform: PartitionedTransform) -> None:
+    """Route the standardized records to partition NDJSON files by strain."""
+    args = transform.args
+    final_strain = transform.final_strain()
+
+    os.makedirs(args.partition_dir, exist_ok=True)
+    partition_files = [
+        open(partition_path(args.partition_dir, partition, '.ndjson'), 'wt', encoding='utf-8')
+        for partition in range(args.partitions)
+    ]
+    index_builder = None
+    if args.ndjson_index:
+        index_builder = NdjsonIndexBuilder(tmp_dir=os.path.dirname(os.path.abspath(args.ndjson_index)))
+    try:
+        with open(transform.input_path, "r") as input_fh:
+            lines = index_builder.recorded_lines(input_fh) if index_builder else input_fh
+            for entry in compile_pipeline(transform.standardized_records(lines, index_builder)):
+                partition = partition_of(final_strain(entry), args.partitions)
+                partition_files[partition].write(json.dumps(entry, default=str) + '\n')
+    finally:
+        for partition_fh in partition_files:
+            partition_fh.close()
+
+    if index_builder:
+        index_builder.save(args.ndjson_index, transform.input_path)
+
+
+def run_partition(transform: PartitionedTransform, partition: int) -> None:
+    """
+    Curate, sort and dedup one partition written by `map_partitions`.  Writes
+    its kept records (still sorted), its raw metadata and messages tagged with
+    line numbers, the summary of its messages and, unless ``sorted_fasta``,
+    its line-numbered sequences.
+    """
+    args = transform.args
+
+    def path(suffix):
+        return partition_path(args.partition_dir, partition, suffix)
+
+    # Count this partition's messages on their own; reduce_partitions adds
+    # them up.
+    earlier_diagnostics = DIAGNOSTICS.take_summary()
+
+    with open(path('.log'), 'wt', encoding='utf-8') as log_fh:
+        log = LineNumberTaggedWriter(log_fh)
+        raw_metadata = transform.raw_metadata_writer(path('.raw.tsv'), [LINE_NUMBER_KEY, *transform.metadata_columns])
+        with open(path('.ndjson'), 'r', encoding='utf-8') as partition_fh, contextlib.redirect_stdout(log):
+            pipeline = transform.curate(
+                LineToJsonDataSource(partition_fh, read_ahead=True) | TagLineNumber(log),
+                raw_metadata,
+            )
+            sort_tmp_path = spill_to_sorted_tempfile(
+                compile_pipeline(pipeline),
+                id_key=transform.id_key,
+                output_dir=args.partition_dir,
+            )
+            DIAGNOSTICS.flush()
+        raw_metadata.close()
+        log.close()
+    with open(path('.diagnostics.json'), 'wt', encoding='utf-8') as diagnostics_fh:
+        json.dump(DIAGNOSTICS.take_summary(), diagnostics_fh)
+    DIAGNOSTICS.add_summary(earlier_diagnostics)
+
+    # Dedup without decoding: the first field of each sorted line is the strain.
+    kept = KeptStrainNames(args.partition_dir)
+    try:
+        with open(sort_tmp_path, 'r', encoding='utf-8') as sorted_in, \
+             open(path('.kept.tsv'), 'wt', encoding='utf-8') as kept_out:
+            for line in keep_first_per_strain(sorted_in, lambda line: line.partition('\t')[0]):
+                strain, _, _, line_number, _ = line.split('\t', 4)
+                kept_out.write(line)
+                kept.add(int(line_number), strain)
+        os.unlink(sort_tmp_path)
+
+        if not args.sorted_fasta:
+            with open(path('.ndjson'), 'r', encoding='utf-8') as partition_fh, \
+                 open(path('.fasta.tsv'), 'wt', encoding='utf-8') as fasta_out:
+                for entry, strain_name in kept.with_names(compile_pipeline(
+                        LineToJsonDataSource(partition_fh)
+                        | LineNumberFilter(kept.line_numbers)
+                )):
+                    fasta_out.write(f"{entry[LINE_NUMBER_KEY]}\t{strain_name}\t{entry['sequence']}\n")
+    finally:
+        kept.close()
+        if os.path.exists(sort_tmp_path):
+            os.unlink(sort_tmp_path)
+
+
+def reduce_partitions(transform: PartitionedTransform) -> None:
+    """Merge the outputs of every `run_partition` into the outputs of a
+    single run, in the same order."""
+    args = transform.args
+
+    def paths(suffix):
+        return [partition_path(args.partition_dir, partition, suffix) for partition in range(args.partitions)]
+
+    with open(args.output_metadata + '.raw', 'wt') as raw_fh:
+        raw_csv = TsvWriter(raw_fh, lineterminator=args.newline)
+        raw_csv.writerow(transform.metadata_columns)
+        raw_csv.writerows(merge_line_numbered_rows(paths('.raw.tsv')))
+        raw_csv.flush()
+
+    for message in merge_line_numbered(paths('.log')):
+        sys.stdout.write(message)
+    for diagnostics_path in paths('.diagnostics.json'):
+        with open(diagnostics_path, 'r', encoding='utf-8') as diagnostics_fh:
+            DIAGNOSTICS.add_summary(json.load(diagnostics_fh))
+
+    with open(args.output_fasta, "wt", newline=args.newline) as fasta_fh:
+        transform.write_metadata(keep_first_per_strain(merge_sorted_records(paths('.kept.tsv'))), fasta_fh)
+
+        if not args.sorted_fasta:
+            for line in merge_line_numbered(paths('.fasta.tsv')):
+                strain_name, _, sequence = line.rstrip('\n').partition('\t')
+                fasta_fh.write(f">{strain_name}\n")
+                fasta_fh.write(f"{sequence}\n")
+
+
+def run_partitioned(transform: PartitionedTransform, memory) -> None:
+    """Run every step locally, with ``jobs`` worker processes standing in for
+    the nodes that would run the partitions."""
+    args = transform.args
+    keep_partitions = args.partition_dir is not None
+    if not keep_partitions:
+        args.partition_dir = tempfile.mkdtemp(
+            prefix=f'{os.path.basename(sys.argv[0])}-partitions.',
+            dir=os.path.dirname(os.path.abspath(args.output_metadata)),
+        )
+    try:
+        with memory.phase('map'):
+            map_partitions(transform)
+        # The partitions' memory use is reported as children_max_rss_mib
+        # when they run in worker processes.
+        with memory.phase('partitions'):
+            # Nothing buffered may be copied into the worker processes.
+            DIAGNOSTICS.flush()
+            if args.jobs > 1:
+                with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+                    list(executor.map(run_partition, repeat(transform), range(args.partitions)))
+            else:
+                for partition in range(args.partitions):
+                    run_partition(transform, partition)
+        with memory.phase('reduce'):
+            reduce_partitions(transform)
+    finally:
+        if not keep_partitions:
+            shutil.rmtree(args.partition_dir)
@@ -0,0 +1,350 @@
+"""
+Patch a transform's previous outputs after a change to the curated
+annotations or geographic location rules, instead of rerunning it.
+
+Curators usually change a few lines of ``gisaid_annotations.tsv`` or
+``gisaid_geoLocationRules.tsv``, which can only change the records those lines
+touch, and only in the last stages of the GISAID transform
+(``ApplyUserGeoLocationSubstitutionRules``, ``MergeUserAnnotatedMetadata`` and
+``FillDefaultLocationData``):
+
+* :func:`changed_annotation_ids` compares the old and new annotations id by
+  id, through their reverse index from id to annotations;
+* :class:`LocationRuleChanges` tells whether the old and new rules map a
+  ``(region, country, division, location)`` tuple of the raw metadata (written
+  before the rules are applied) differently;
+* the affected records are re-read by seeking through an
+  :class:`~.ndjsonindex.NdjsonIndex` and recomputed, and :func:`rewrite_rows`
+  replaces their rows in the outputs.
+
+A change that could alter which record wins the dedup by strain, i.e. an old
+or new annotation of one of :func:`dedup_columns`, can't be patched and needs
+a full run.  :class:`PatchState` keeps a copy of the annotations and rules the
+outputs were made with, together with a fingerprint of the other inputs and
+the outputs, so a patch is only ever applied to the outputs of the run it
+describes.
+
+A transform describes its pipeline as a :class:`PatchableTransform`, whose
+outputs :func:`patch_outputs` patches and :func:`save_patch_state` records.
+"""
+import contextlib
+import csv
+import io
+import json
+import os
+import shutil
+import sys
+from abc import abstractmethod
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from ._base import DataSource
+from .externalsort import record_sort_key
+from .fusion import compile_pipeline
+from .ndjsonindex import IndexedNdjsonDataSource, NdjsonIndex
+from .transforms import UserProvidedAnnotations, UserProvidedGeoLocationSubstitutionRules
+from .tsvwriter import TsvDictWriter
+
+
+LOCATION_COLUMNS = ['region', 'country', 'division', 'location']
+
+
+def dedup_columns(id_key: str) -> Set[str]:
+    """The columns the transforms sort and dedup records by."""
+    return {'strain', 'length', id_key}
+
+
+def file_stamp(path: Optional[str]) -> Optional[List[int]]:
+    """``[size, mtime in ns]`` of ``path``, or None if there is no such file."""
+    if not path or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class PatchState:
+    """Copies of the curated inputs of the last run, and its fingerprint, kept
+    in ``directory``."""
+    STATE_FILE = "state.json"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def snapshot(self, name: str) -> Optional[str]:
+        """Path of the copy of input ``name``, or None if the last run had none."""
+        path = os.path.join(self.directory, name)
+        return path if os.path.exists(path) else None
+
+    def fingerprint(self) -> Optional[dict]:
+        """The fingerprint saved by the last run, or None if there was none."""
+        try:
+            with open(os.path.join(self.directory, self.STATE_FILE), "r", encoding="utf-8") as state_fh:
+                return json.load(state_fh)["fingerprint"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def save(self, snapshots: Mapping[str, Optional[str]], fingerprint: dict) -> None:
+        """Record a run: copy each input of ``snapshots`` (name to path, or to
+        None if the run had no such input) and save ``fingerprint``."""
+        os.makedirs(self.directory, exist_ok=True)
+        state_path = os.path.join(self.directory, self.STATE_FILE)
+        # Forget the last run first, so a failure below can't leave a state
+        # that mixes two runs.
+        if os.path.exists(state_path):
+            os.unlink(state_path)
+
+        for name, path in snapshots.items():
+            snapshot_path = os.path.join(self.directory, name)
+            if path:
+                shutil.copyfile(path, snapshot_path)
+            elif os.path.exists(snapshot_path):
+                os.unlink(snapshot_path)
+
+        with open(f"{state_path}.tmp", "w", encoding="utf-8") as state_fh:
+            json.dump({"fingerprint": fingerprint}, state_fh)
+        os.replace(f"{state_path}.tmp", state_path)
+
+
+def changed_annotation_ids(old: UserProvidedAnnotations, new: UserProvidedAnnotations) -> Set[str]:
+    """Return the ids whose annotations differ between ``old`` and ``new``."""
+    changed = set()
+    for record_id in {*old.ids(), *new.ids()}:
+        if old.get_user_annotations(record_id) != new.get_user_annotations(record_id):
+            changed.add(record_id)
+    return changed
+
+
+def annotated_columns(annotations: UserProvidedAnnotations, ids: Iterable[str]) -> Set[str]:
+    """Return the columns ``annotations`` sets on any of ``ids``."""
+    return {
+        column
+        for record_id in ids
+        for column, _ in annotations.get_user_annotations(record_id)
+    }
+
+
+def rule_arrivals(rules: UserProvidedGeoLocationSubstitutionRules) -> Dict[Tuple[str, str, str, str], Tuple[str, str, str, str]]:
+    return {
+        start: tuple(rules.entries[start[0]][start[1]][start[2]][start[3]])
+        for start in rules.use_count
+    }
+
+
+class LocationRuleChanges:
+    """Tells whether two sets of geographic location rules map a location
+    tuple differently.  Answers are kept per tuple, so asking for each record
+    of a run costs one rule lookup per distinct location."""
+    def __init__(self, old: UserProvidedGeoLocationSubstitutionRules, new: UserProvidedGeoLocationSubstitutionRules):
+        self.old = old
+        self.new = new
+        old_arrivals, new_arrivals = rule_arrivals(old), rule_arrivals(new)
+        self.changed_rules = {
+            start
+            for start in old_arrivals.keys() | new_arrivals.keys()
+            if old_arrivals.get(start) != new_arrivals.get(start)
+        }
+        self._affected: Dict[Tuple[str, str, str, str], bool] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.changed_rules)
+
+    def affects(self, location: Tuple[str, str, str, str]) -> bool:
+        if not self.changed_rules:
+            return False
+        affected = self._affected.get(location)
+        if affected is None:
+            # Rules chain and fall back to wildcards, so compare where each
+            # set of rules takes the location rather than which rules match.
+            affected = tuple(self.old.get_user_rules(location)) != tuple(self.new.get_user_rules(location))
+            self._affected[location] = affected
+        return affected
+
+
+def ids_with_changed_locations(raw_metadata_path: str, id_key: str, changes: LocationRuleChanges) -> Set[str]:
+    """Return the ids of the rows of the raw metadata TSV (as written before
+    the rules are applied) whose location ``changes`` affect."""
+    ids = set()
+    if not changes:
+        return ids
+    with open(raw_metadata_path, "r", encoding="utf-8", newline="") as raw_fh:
+        for row in csv.DictReader(raw_fh, delimiter="\t"):
+            if changes.affects(tuple(row[column] for column in LOCATION_COLUMNS)):
+                ids.add(row[id_key])
+    return ids
+
+
+def find_rows(path: str, id_key: str, ids: Set[str]) -> Dict[int, Tuple[str, str]]:
+    """Return ``{row number: (id, strain)}`` of the rows of the TSV at
+    ``path`` whose ``id_key`` is in ``ids``, numbering data rows from 0."""
+    found = {}
+    with open(path, "r", encoding="utf-8", newline="") as tsv_fh:
+        rows = csv.reader(tsv_fh, delimiter="\t")
+        header = next(rows)
+        id_index, strain_index = header.index(id_key), header.index('strain')
+        for row_number, row in enumerate(rows):
+            if row[id_index] in ids:
+                found[row_number] = (row[id_index], row[strain_index])
+    return found
+
+
+def rewrite_rows(path: str, replacements: Mapping[int, dict], columns: List[str],
+                 lineterminator: str, restval: str = '?') -> None:
+    """Replace data rows (numbered from 0) of the TSV at ``path``, written by
+    a :class:`~.tsvwriter.TsvDictWriter` with ``columns``, ``restval`` and
+    ``lineterminator``, by the records in ``replacements``.  Other rows are
+    written back as they were."""
+    tmp_path = f"{path}.tmp"
+    with open(path, "r", encoding="utf-8", newline="") as in_fh, \
+         open(tmp_path, "w", encoding="utf-8", newline="") as out_fh:
+        rows = csv.reader(in_fh, delimiter="\t")
+        writer = TsvDictWriter(out_fh, columns, restval=restval, lineterminator=lineterminator)
+        writer.writevalues(next(rows))
+        for row_number, row in enumerate(rows):
+            if row_number in replacements:
+                writer.writerow(replacements[row_number])
+            else:
+                writer.writevalues(row)
+        writer.flush()
+    os.replace(tmp_path, path)
+
+
+class PatchableTransform:
+    """
+    The pipeline of a transform whose outputs can be patched, for its parsed
+    ``args``: ``annotations``, ``geo_location_rules``, ``accessions``,
+    ``ndjson_index``, ``output_metadata``, ``output_fasta``, ``sorted_fasta``
+    and ``newline``.
+    """
+    #: the column of the input's record ids, by which sorted records are tied
+    id_key: str
+    #: the names of the copies of ``annotations`` and ``geo_location_rules``
+    #: kept in the :class:`PatchState`
+    annotations_snapshot: str
+    geo_rules_snapshot: str
+
+    def __init__(self, args):
+        self.args = args
+
+    @property
+    @abstractmethod
+    def input_path(self) -> str:
+        """The NDJSON input."""
+        pass
+
+    @abstractmethod
+    def row_outputs(self) -> List[Tuple[str, List[str]]]:
+        """The path and columns of each TSV output with a row per record, the
+        metadata first."""
+        pass
+
+    @abstractmethod
+    def load_annotations(self, path: Optional[str]) -> UserProvidedAnnotations:
+        pass
+
+    @abstractmethod
+    def load_geo_rules(self, path: Optional[str]) -> UserProvidedGeoLocationSubstitutionRules:
+        pass
+
+    @abstractmethod
+    def recompute(self, source: DataSource, annotations: UserProvidedAnnotations,
+                  geo_rules: UserProvidedGeoLocationSubstitutionRules) -> DataSource:
+        """The records of ``source``, read from the input, standardized and
+        curated with ``annotations`` and ``geo_rules`` up to sorting."""
+        pass
+
+
+def run_fingerprint(transform: PatchableTransform) -> dict:
+    """Everything but the curated annotations and geo rules that a run's
+    outputs depend on, and the outputs themselves."""
+    args = transform.args
+    metadata, *other_rows = (path for path, _ in transform.row_outputs())
+    return {
+        'input': file_stamp(transform.input_path),
+        'ndjson_index': file_stamp(args.ndjson_index),
+        'accessions': file_stamp(args.accessions),
+        'outputs': [
+            file_stamp(path)
+            for path in (metadata, metadata + '.raw', *other_rows, args.output_fasta)
+        ],
+        'options': [args.sorted_fasta, args.newline],
+    }
+
+
+def save_patch_state(transform: PatchableTransform, state: PatchState) -> None:
+    state.save(
+        {
+            transform.annotations_snapshot: transform.args.annotations,
+            transform.geo_rules_snapshot: transform.args.geo_location_rules,
+        },
+        run_fingerprint(transform),
+    )
+
+
+def patch_outputs(transform: PatchableTransform, state: PatchState) -> bool:
+    """
+    Apply the changes to the curated annotations and geo rules since the run
+    recorded in ``state`` to its outputs, recomputing only the records they
+    affect.  Returns False, having changed nothing, if that isn't possible.
+    """
+    def cannot_patch(reason):
+        print(f"Cannot patch the previous outputs ({reason}); running the full transform.", file=sys.stderr)
+        return False
+
+    args = transform.args
+    id_key = transform.id_key
+    if not args.ndjson_index:
+        return cannot_patch("--patch requires --ndjson-index")
+    if state.fingerprint() != run_fingerprint(transform):
+        return cannot_patch("no previous run with these inputs, options and outputs was recorded")
+
+    annotations = transform.load_annotations(args.annotations)
+    old_annotations = transform.load_annotations(state.snapshot(transform.annotations_snapshot))
+    changed_ids = changed_annotation_ids(old_annotations, annotations)
+    dedup_changes = (
+        annotated_columns(old_annotations, changed_ids) | annotated_columns(annotations, changed_ids)
+    ) & dedup_columns(id_key)
+    if dedup_changes:
+        return cannot_patch(f"annotations of {', '.join(sorted(dedup_changes))} changed, which can change the dedup by strain")
+
+    geo_rules = transform.load_geo_rules(args.geo_location_rules)
+    with contextlib.redirect_stdout(io.StringIO()):
+        # its warnings were printed by the last run
+        old_geo_rules = transform.load_geo_rules(state.snapshot(transform.geo_rules_snapshot))
+    location_changes = LocationRuleChanges(old_geo_rules, geo_rules)
+    affected_ids = changed_ids | ids_with_changed_locations(
+        args.output_metadata + '.raw', id_key, location_changes)
+
+    rows = find_rows(args.output_metadata, id_key, affected_ids)
+    try:
+        index = NdjsonIndex(transform.input_path, args.ndjson_index)
+    except ValueError as error:
+        return cannot_patch(error)
+
+    try:
+        # Recompute every record of the affected ids, and keep the one that
+        # sorts first for each (id, strain) in the outputs, as the dedup did.
+        wanted = set(rows.values())
+        line_numbers = sorted({
+            line_number
+            for record_id, _ in wanted
+            for line_number in index.line_numbers(record_id)
+        })
+        recomputed = {}
+        for entry in compile_pipeline(transform.recompute(IndexedNdjsonDataSource(index, line_numbers),
+                                                          annotations, geo_rules)):
+            key = (entry[id_key], entry['strain'])
+            if key in wanted and (
+                    key not in recomputed
+                    or record_sort_key(entry, id_key) < record_sort_key(recomputed[key], id_key)
+            ):
+                recomputed[key] = entry
+    finally:
+        index.close()
+
+    if not wanted <= recomputed.keys():
+        return cannot_patch("some of the previous records could not be found again")
+
+    replacements = {row_number: recomputed[key] for row_number, key in rows.items()}
+    for path, columns in transform.row_outputs():
+        rewrite_rows(path, replacements, columns, args.newline)
+    print(f"Patched {len(replacements)} records of the previous outputs.", file=sys.stderr)
+    return True
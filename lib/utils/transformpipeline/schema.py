@@ -0,0 +1,71 @@
+"""
+Field schemas of the transform sources: which of their fields hold dates.
+
+``StandardizeData`` used to NFC-normalize and strip every string of every
+record, including the ~30 kB ``sequence``, into a new dict merged back into
+the record.  :meth:`FieldSchema.standardize_strings` still normalizes and
+strips every string, but ASCII text is already in Normalization Form C, and
+``str.isascii`` is a flag check in CPython, so ASCII values -- almost all of
+them, sequences included -- are only stripped, and the record is updated in
+place.  The results are identical to normalizing everything.
+
+A schema's date fields are then reformatted to ISO 8601 with its
+``date_formats`` and kept parsed on the record (see :mod:`.dates`).
+"""
+import unicodedata
+from typing import Iterable
+
+from utils.transform import DateParser
+from . import PARSED_DATES_KEY
+
+
+def normalize_text(value: str) -> str:
+    """Strip ``value`` and convert it to Unicode Normalization Form C."""
+    if value.isascii():
+        return value.strip()
+    return unicodedata.normalize('NFC', value).strip()
+
+
+class FieldSchema:
+    """The fields of one source's records, after renaming
+    (``RenameAndAddColumns``), that hold dates, parsed with
+    ``date_formats``."""
+    def __init__(self, date_fields: Iterable[str], date_formats: Iterable[str] = ()):
+        self.date_fields = tuple(date_fields)
+        self.date_formats = set(date_formats)
+        self.dates = DateParser(self.date_formats)
+
+    def standardize_strings(self, entry: dict) -> None:
+        """Strip and NFC-normalize the string values of ``entry`` in place."""
+        for key, value in entry.items():
+            if isinstance(value, str):
+                entry[key] = normalize_text(value)
+
+    def standardize_dates(self, entry: dict, required: bool = False) -> None:
+        """Reformat the date fields of ``entry`` to ISO 8601 dates,
+        keeping their day ordinals under :data:`PARSED_DATES_KEY`.  Missing
+        fields are skipped, or raise a ``KeyError`` if ``required``."""
+        parsed = {}
+        for column in self.date_fields:
+            if required or column in entry:
+                value, ordinal = self.dates.standardize(entry[column])
+                entry[column] = value
+                parsed[column] = [value, ordinal]
+        if parsed:
+            entry[PARSED_DATES_KEY] = parsed
+
+
+GISAID_SCHEMA = FieldSchema(
+    ['date', 'date_submitted', 'date_updated'],
+    date_formats={'%Y-%m-%d', '%Y-%m-%dT%H:%M:%SZ'},
+)
+
+GENBANK_SCHEMA = FieldSchema(
+    ['date', 'date_submitted', 'date_updated'],
+    date_formats={'%Y-%m-%d', '%Y-%m-%dT%H:%M:%SZ'},
+)
+
+RKI_SCHEMA = FieldSchema(
+    ['date', 'date_submitted'],
+    date_formats={'%Y-%m-%d', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M:%S %z', '%Y-%m-%dT%H:%M:%S'},
+)
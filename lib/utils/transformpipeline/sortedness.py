@@ -0,0 +1,114 @@
+"""
+Sortedness contracts: sidecars saying that a TSV is sorted by a key column.
+
+The transforms write their metadata in ``LC_ALL=C`` strain order, yet
+``join-metadata-and-clades`` used to sort it again before merge-joining it
+with the Nextclade results, as it can't tell such a file from any other.  A
+producer that knows its output is sorted calls :func:`write_sort_contract`
+once the file is complete, which checks that the file's keys are strictly
+increasing bytewise (sorted, and unique) and if so writes a sidecar next to
+it, ``<path>.sorted.json``, recording the key column, the collation (``C``),
+and the file's size and modification time.
+
+A consumer calls :func:`has_sort_contract`, which only accepts a sidecar for
+the same key and collation whose size and modification time match the file as
+it is now, so a file rewritten since is sorted again.  That is a cheap check
+rather than a proof (a sidecar copied along with a different file could pass
+it), so as the consumer reads the rows it checks their order once more with
+:func:`ensure_increasing`, which raises :class:`UnsortedInputError` at the
+first key out of order, for it to fall back to sorting.
+"""
+import json
+import os
+from typing import Iterable, Iterator, List
+
+
+CONTRACT_SUFFIX = ".sorted.json"
+# The collation of the keys' order: bytewise on their UTF-8 encoding, i.e.
+# `LC_ALL=C sort` (and Python's ordering of str).
+COLLATION = "C"
+
+
+class UnsortedInputError(ValueError):
+    pass
+
+
+def contract_path(path: str) -> str:
+    return f"{path}{CONTRACT_SUFFIX}"
+
+
+def _file_stamp(path: str) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _is_increasing(path: str, key: str) -> bool:
+    """Whether the TSV ``path``'s rows' ``key`` fields are strictly
+    increasing bytewise."""
+    with open(path, "rb") as fh:
+        columns = fh.readline().rstrip(b"\r\n").split(b"\t")
+        try:
+            key_index = columns.index(key.encode("utf-8"))
+        except ValueError:
+            return False
+
+        previous = None
+        for line in fh:
+            fields = line.rstrip(b"\r\n").split(b"\t", key_index + 1)
+            value = fields[key_index] if key_index < len(fields) else b""
+            # A quoted key isn't compared as written (by `sort`) the way it
+            # reads (by csv), so such files are left to be sorted.
+            if b'"' in value or (previous is not None and value <= previous):
+                return False
+            previous = value
+    return True
+
+
+def write_sort_contract(path: str, key: str) -> bool:
+    """Write the sidecar of the TSV ``path`` saying that it is sorted by its
+    ``key`` column, if it is, and return whether it is.  A sidecar left from
+    an earlier version of the file is removed if it no longer is."""
+    sidecar = contract_path(path)
+    if not _is_increasing(path, key):
+        if os.path.exists(sidecar):
+            os.unlink(sidecar)
+        return False
+
+    tmp_path = f"{sidecar}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as contract_fh:
+        json.dump({
+            "key": key,
+            "collation": COLLATION,
+            "unique": True,
+            **_file_stamp(path),
+        }, contract_fh, indent=1)
+    os.replace(tmp_path, sidecar)
+    return True
+
+
+def has_sort_contract(path: str, key: str) -> bool:
+    """Whether the TSV ``path`` has a sidecar saying that it is sorted by its
+    ``key`` column, with unique keys, which matches the file as it is now."""
+    try:
+        with open(contract_path(path), encoding="utf-8") as contract_fh:
+            contract = json.load(contract_fh)
+        return (
+            contract.get("key") == key
+            and contract.get("collation") == COLLATION
+            and contract.get("unique") is True
+            and {"size": contract.get("size"), "mtime_ns": contract.get("mtime_ns")} == _file_stamp(path)
+        )
+    except (OSError, ValueError, AttributeError):
+        return False
+
+
+def ensure_increasing(rows: Iterable[List[str]], key_index: int, path: str) -> Iterator[List[str]]:
+    """Yield ``rows``, raising :class:`UnsortedInputError` at the first whose
+    ``key_index`` field isn't greater than the one before it."""
+    previous = None
+    for row in rows:
+        key = row[key_index]
+        if previous is not None and key <= previous:
+            raise UnsortedInputError(f"{path} is not sorted by unique keys: {key!r} after {previous!r}")
+        previous = key
+        yield row
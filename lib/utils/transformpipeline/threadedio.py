@@ -0,0 +1,200 @@
+"""
+Overlap pipeline I/O with the transform work using background threads.
+
+Reading (and decompressing) the NDJSON input and writing the side outputs and
+sort spill otherwise happen in the same thread as the transforms, so every
+disk or decompression stall adds directly to the run time.  The file reads and
+writes release the GIL, so a thread per file is enough to overlap them:
+
+* :class:`ReadAhead` iterates an iterable of lines in a background thread,
+  handing them over in chunks;
+* :class:`WriteBehindFile` is a write-only file object that hands chunks of
+  writes to a background thread.
+
+Both pass chunks through a bounded queue, so a stalled consumer (or disk)
+applies backpressure and caps memory at a few chunks, and both keep order: one
+producer, one consumer, first in first out.  An error in the background thread
+is re-raised in the caller's thread.
+"""
+import atexit
+import queue
+import threading
+from typing import Iterable, Iterator, List, Optional, TextIO
+
+from .memory import MEMORY_PLAN
+
+
+_DONE = object()
+
+# The size assumed of a line read ahead, for the memory plan: most input lines
+# are NDJSON records with a ~30 kB sequence.
+LINE_BYTES = 32 * 1024
+
+
+class _Failure:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def _put_unless_stopped(chunks: queue.Queue, item, stopped: threading.Event) -> bool:
+    while not stopped.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _read_ahead(lines: Iterator[str], chunk_size: int, chunks: queue.Queue, stopped: threading.Event) -> None:
+    try:
+        while True:
+            chunk = [line for _, line in zip(range(chunk_size), lines)]
+            if not chunk:
+                break
+            if not _put_unless_stopped(chunks, chunk, stopped):
+                return
+        _put_unless_stopped(chunks, _DONE, stopped)
+    except BaseException as exc:
+        _put_unless_stopped(chunks, _Failure(exc), stopped)
+
+
+class ReadAhead(Iterator[str]):
+    """Iterate ``lines`` in a background thread, at most ``max_chunks`` chunks
+    of ``chunk_size`` lines ahead of the consumer (by default 16, or fewer if
+    the memory plan's read-ahead share holds fewer)."""
+    def __init__(self, lines: Iterable[str], max_chunks: Optional[int] = None, chunk_size: int = 1024):
+        if max_chunks is None:
+            max_chunks = MEMORY_PLAN.items("read-ahead chunks", "read ahead", chunk_size * LINE_BYTES, 16)
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._chunk: Iterator[str] = iter(())
+        self._finished = False
+        self._stopped = threading.Event()
+        # The thread only holds the queue and the stop flag, so dropping the
+        # ReadAhead stops it (see __del__).
+        self._thread = threading.Thread(
+            target=_read_ahead,
+            args=(iter(lines), chunk_size, self._queue, self._stopped),
+            name="read-ahead",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def __next__(self) -> str:
+        for line in self._chunk:
+            return line
+        if self._finished:
+            raise StopIteration
+        chunk = self._queue.get()
+        if chunk is _DONE or isinstance(chunk, _Failure):
+            self._finished = True
+            self._thread.join()
+            if chunk is _DONE:
+                raise StopIteration
+            raise chunk.exc
+        self._chunk = iter(chunk)
+        return next(self._chunk)
+
+    def close(self) -> None:
+        """Stop reading ahead, e.g. when abandoning the iteration early."""
+        self._finished = True
+        self._stopped.set()
+        self._thread.join()
+
+    def __del__(self):
+        self._stopped.set()
+
+
+class WriteBehindFile:
+    """Wrap the text file ``fh`` so that writes are performed by a background
+    thread, in chunks of about ``chunk_size`` characters with at most
+    ``max_chunks`` chunks pending (by default 8, or fewer if the memory plan's
+    write-behind share holds fewer).
+
+    Closing the wrapper waits for pending writes and closes ``fh``; a write
+    error is raised by the next :meth:`write`, :meth:`flush` or :meth:`close`.
+    Files still open at interpreter exit are closed then.
+    """
+    def __init__(self, fh: TextIO, max_chunks: Optional[int] = None, chunk_size: int = 1 << 20):
+        if max_chunks is None:
+            max_chunks = MEMORY_PLAN.items("write-behind chunks", "write behind", chunk_size, 8)
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self._buffer: List[str] = []
+        self._buffered = 0
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._error = None
+        self.closed = False
+        self._thread = threading.Thread(target=self._write, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @property
+    def name(self):
+        return self.fh.name
+
+    def _write(self) -> None:
+        while True:
+            chunk = self._queue.get()
+            if chunk is _DONE:
+                return
+            if isinstance(chunk, threading.Event):
+                chunk.set()
+            elif self._error is None:
+                try:
+                    self.fh.write(chunk)
+                except BaseException as exc:
+                    self._error = exc
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _hand_off(self) -> None:
+        if self._buffer:
+            self._queue.put("".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def write(self, text: str) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        self._raise_error()
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.chunk_size:
+            self._hand_off()
+        return len(text)
+
+    def writelines(self, lines: Iterable[str]) -> None:
+        for line in lines:
+            self.write(line)
+
+    def flush(self) -> None:
+        """Wait until everything written so far has reached ``fh``."""
+        self._hand_off()
+        written = threading.Event()
+        self._queue.put(written)
+        written.wait()
+        self._raise_error()
+        self.fh.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        try:
+            self._hand_off()
+            self._queue.put(_DONE)
+            self._thread.join()
+            self._raise_error()
+        finally:
+            self.fh.close()
+
+    def __enter__(self) -> "WriteBehindFile":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
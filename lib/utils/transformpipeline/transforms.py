@@ -1,18 +1,32 @@
 import csv
+import hashlib
+import os
+import pickle
 import re
-import unicodedata
 import json
 from collections import defaultdict
-from typing import Any, Collection, List, MutableMapping, Sequence, Tuple , Dict , Union
-import pandas as pd
-from datetime import datetime
+from functools import lru_cache
+from typing import Collection, Iterator, List, Mapping, MutableMapping, Optional, Sequence, Tuple , Dict , Union
 
 
-from utils.transform import format_date, titlecase
+from utils.transform import titlecase
 from . import LINE_NUMBER_KEY
 from ._base import Transformer
+from .annotationstore import CompactAnnotationStore
+from .dates import date_ordinal
+from .diagnostics import DIAGNOSTICS
+from .schema import GISAID_SCHEMA, RKI_SCHEMA, FieldSchema
+from .threadedio import WriteBehindFile
+from .tsvwriter import dict_writer, flush_writer
 
 
+def _file_sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
 class UserProvidedGeoLocationSubstitutionRules:
     """ this class represents patterns of substitutions in the localisation data of entries """
@@ -144,8 +158,9 @@ class UserProvidedGeoLocationSubstitutionRules:
                     continueApply = False
                 arrival = newArrival
             if rules_applied > 1000 :
-                print("ERROR : more than 1000 geographic location rules applied on the same entry. There might be cyclicity in your rules")
-                print("\tfaulty entry",start)
+                DIAGNOSTICS.emit("geographic location rule cycle", "ERROR : more than 1000 geographic location rules applied on the same entry. There might be cyclicity in your rules")
+                DIAGNOSTICS.emit("geographic location rule cycle", f"\tfaulty entry {start}")
+                DIAGNOSTICS.flush()
                 exit(1)
 
 
@@ -168,33 +183,81 @@ class UserProvidedGeoLocationSubstitutionRules:
 
 
 class UserProvidedAnnotations:
-    def __init__(self):
-        self.entries: MutableMapping[str, List[Tuple[str, Any]]] = defaultdict(list)
-        self.use_count: MutableMapping[str, int] = dict()
+    """
+    Curated ``(column, value)`` annotations keyed by record id (e.g. a GISAID
+    EPI_ISL or GenBank accession), kept in a :class:`CompactAnnotationStore`.
+    """
+    def __init__(self, store: CompactAnnotationStore = None):
+        self.store = store if store is not None else CompactAnnotationStore()
 
     def add_user_annotation(
             self,
             gisaid_epi_isl: str,
             key: str,
-            value: Any,
+            value: str,
     ) -> None:
-        self.entries[gisaid_epi_isl].append((key, value))
-        self.use_count[gisaid_epi_isl] = 0
+        self.store.add(gisaid_epi_isl, key, value)
 
-    def get_user_annotations(self, gisaid_epi_isl: str) -> Sequence[Tuple[str, Any]]:
-        annotations = self.entries.get(gisaid_epi_isl, None)
+    def get_user_annotations(self, gisaid_epi_isl: str) -> Sequence[Tuple[str, str]]:
+        annotations = self.store.lookup(gisaid_epi_isl)
         if annotations is not None:
-            self.use_count[gisaid_epi_isl] += 1
             return annotations
         else:
             return []
 
     def get_unused_annotations(self) -> Collection[str]:
-        return [
-            gisaid_epi_isl
-            for gisaid_epi_isl, use_count in self.use_count.items()
-            if use_count == 0
-        ]
+        return self.store.unused_keys()
+
+    def ids(self) -> Iterator[str]:
+        """Yield every annotated id, in the order they were first added."""
+        return self.store.keys()
+
+    @classmethod
+    def from_accessions_tsv(
+            cls,
+            path: str,
+            id_column: str,
+            value_column: str,
+            cache_path: str = None,
+    ) -> 'UserProvidedAnnotations':
+        """
+        Read a TSV cross-referencing accessions between databases (e.g.
+        `all_accessions.tsv.gz`) as annotations that set *value_column* on
+        records whose id is in *id_column*.
+
+        If *cache_path* is given, the built store is saved there and reused
+        by later calls for as long as the TSV's contents and the requested
+        columns are unchanged.
+        """
+        digest = None
+        if cache_path:
+            digest = hashlib.sha256(f"{id_column}\t{value_column}\t".encode())
+            digest.update(_file_sha256(path).encode())
+            digest = digest.digest()
+            if CompactAnnotationStore.read_source_digest(cache_path) == digest:
+                return cls(CompactAnnotationStore.load(cache_path))
+
+        from xopen import xopen
+
+        annotations = cls()
+        with xopen(path, "r") as accessions_fh:
+            rows = csv.reader(accessions_fh, delimiter='\t')
+            header = next(rows, [])
+            id_index, value_index = header.index(id_column), header.index(value_column)
+            min_length = max(id_index, value_index) + 1
+            for row in rows:
+                if not row:
+                    continue
+                if len(row) < min_length:
+                    # Applied with their missing fields empty, as they were
+                    # when read with csv.DictReader
+                    row += [''] * (min_length - len(row))
+                annotations.add_user_annotation(row[id_index], value_column, row[value_index])
+
+        if cache_path:
+            annotations.store.save(cache_path, digest)
+
+        return annotations
 
 
 class RenameAndAddColumns(Transformer):
@@ -238,11 +301,15 @@ class StandardizeData(Transformer):
     2. Strip whitespace and convert to Unicode Normalization Form C for all strings.
     3. Standardize date formats.
     4. Abbreviate and remove whitespace from strain names
-    5. Add a line number.
+    5. Add a line number, unless the record already has one.
+
+    The source's *schema* (see :mod:`.schema`) gives its date fields and
+    formats; GISAID's by default.
     """
 
-    def __init__(self):
+    def __init__(self, schema: FieldSchema = GISAID_SCHEMA):
         self.line_count = 1
+        self.schema = schema
 
     def transform_value(self, entry: dict) -> dict:
         entry['sequence'] = entry['sequence'].replace('\n', '')
@@ -250,25 +317,18 @@ class StandardizeData(Transformer):
 
         # Normalize all string data to Unicode Normalization Form C, for
         # consistent, predictable string comparisons.
-        str_kvs = {
-            key: unicodedata.normalize('NFC', value).strip()
-            for key, value in entry.items()
-            if isinstance(value, str)
-        }
-        entry.update(str_kvs)
+        self.schema.standardize_strings(entry)
 
         # Standardize date format to ISO 8601 date
-        date_columns = {'date', 'date_submitted', 'date_updated'}
-        date_formats = {'%Y-%m-%d', '%Y-%m-%dT%H:%M:%SZ'}
-        for column in date_columns:
-            if column in entry:
-                entry[column] = format_date(entry[column], date_formats)
+        self.schema.standardize_dates(entry)
 
         # Abbreviate strain names by removing the prefix. Strip spaces, too.
         entry['strain'] = re.sub(
             r'(^[hn]CoV-19/)|\s+', '', entry['strain'], flags=re.IGNORECASE)
 
-        entry[LINE_NUMBER_KEY] = self.line_count
+        # A record read by seeking (IndexedNdjsonDataSource) keeps its line
+        # number in the full file.
+        entry.setdefault(LINE_NUMBER_KEY, self.line_count)
         self.line_count += 1
 
         return entry
@@ -279,11 +339,12 @@ class StandardizeDataRki(Transformer):
     1. Removes newlines from the sequence and measures its length.
     2. Strip whitespace and convert to Unicode Normalization Form C for all strings.
     3. Standardize date formats.
-    4. Add a line number.
+    4. Add a line number, unless the record already has one.
     """
 
-    def __init__(self):
+    def __init__(self, schema: FieldSchema = RKI_SCHEMA):
         self.line_count = 1
+        self.schema = schema
         # RKI's hard-coded method for pango in `genome.gtrs.[].genomic_method.name`
         self.pango_method = "Pangolin Lineage"
 
@@ -306,27 +367,21 @@ class StandardizeDataRki(Transformer):
         pango_lineages.sort(key=lambda lineage: lineage["date_of_assignment"], reverse=True)
 
         if len(pango_lineages) == 0:
-            print(f"WARNING: RKI genomic_typing_results does not include the {self.pango_method!r} method, setting pango_lineage to '?'.")
+            DIAGNOSTICS.emit("missing pango lineage", f"WARNING: RKI genomic_typing_results does not include the {self.pango_method!r} method, setting pango_lineage to '?'.")
             entry['pango_lineage'] = '?'
         else:
             entry['pango_lineage'] = pango_lineages[0]["genomic_typing_result"]
 
         # Normalize all string data to Unicode Normalization Form C, for
         # consistent, predictable string comparisons.
-        str_kvs = {
-            key: unicodedata.normalize('NFC', value).strip()
-            for key, value in entry.items()
-            if isinstance(value, str)
-        }
-        entry.update(str_kvs)
+        self.schema.standardize_strings(entry)
 
         # Standardize date format to ISO 8601 date
-        date_columns = {'date', 'date_submitted'}
-        date_formats = {'%Y-%m-%d', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M:%S %z', '%Y-%m-%dT%H:%M:%S'}
-        for column in date_columns:
-            entry[column] = format_date(entry[column], date_formats)
+        self.schema.standardize_dates(entry, required=True)
 
-        entry[LINE_NUMBER_KEY] = self.line_count
+        # A record read by seeking (IndexedNdjsonDataSource) keeps its line
+        # number in the full file.
+        entry.setdefault(LINE_NUMBER_KEY, self.line_count)
         self.line_count += 1
 
         return entry
@@ -460,14 +515,12 @@ class MaskBadCollectionDate(Transformer):
     ISO 8601 date (YYYY-MM-DD).
     """
     def transform_value(self, entry: dict) -> dict:
-        expected_date_format = '%Y-%m-%d'
-        try:
-            collection_date = datetime.strptime(entry['date'], expected_date_format)
-            submission_date = datetime.strptime(entry['date_submitted'], expected_date_format)
-            if collection_date >= submission_date:
+        # Day ordinals of the dates parsed by StandardizeData, if unchanged
+        collection_date = date_ordinal(entry, 'date')
+        if collection_date is not None:
+            submission_date = date_ordinal(entry, 'date_submitted')
+            if submission_date is not None and collection_date >= submission_date:
                 entry['date'] = 'XXXX-XX-XX'
-        except ValueError:
-            pass
 
         return entry
 
@@ -504,7 +557,7 @@ class MergeUserAnnotatedMetadata(Transformer):
         annotations = self.annotations.get_user_annotations( entry[ self.idKey ] )
         for key, value in annotations:
             if key in entry and entry[key] == value :
-                print('REDUNDANT ANNOTATED METADATA :', entry[ self.idKey ] , key , value)
+                DIAGNOSTICS.emit("redundant annotation", f"REDUNDANT ANNOTATED METADATA : {entry[ self.idKey ]} {key} {value}")
 
             entry[key] = value
         return entry
@@ -524,17 +577,22 @@ class ApplyUserGeoLocationSubstitutionRules(Transformer):
 
 
 class WriteCSV(Transformer):
-    """writes the data to a CSV file."""
+    """writes the data to a CSV file (see `dict_writer`), in a background thread if `write_behind`,
+    or adds to it if `append` (e.g. when resuming a checkpointed run)."""
     def __init__(self, fileName: str ,
                  columns : List[str] ,
                  restval : str = '?' ,
                  extrasaction : str ='ignore' ,
                  delimiter : str = ',',
-                 dict_writer_kwargs : Dict[str,str] = {} ):
+                 dict_writer_kwargs : Dict[str,str] = {} ,
+                 write_behind : bool = False ,
+                 append : bool = False ):
 
-        self.OUT = open( fileName , 'wt')
+        self.OUT = open( fileName , 'at' if append else 'wt')
+        if write_behind:
+            self.OUT = WriteBehindFile(self.OUT)
 
-        self.writer = csv.DictWriter(
+        self.writer = dict_writer(
             self.OUT,
             columns,
             restval=restval,
@@ -542,11 +600,20 @@ class WriteCSV(Transformer):
             delimiter=delimiter,
             **dict_writer_kwargs
         )
-        self.writer.writeheader()
+        if not append:
+            self.writer.writeheader()
 
-    def __del__(self):
+    def flush(self):
+        flush_writer(self.writer)
+        self.OUT.flush()
+
+    def close(self):
+        flush_writer(self.writer)
         self.OUT.close()
 
+    def __del__(self):
+        self.close()
+
     def transform_value(self, entry: dict) -> dict:
         self.writer.writerow(entry)
         return entry
@@ -583,20 +650,15 @@ class StandardizeGenbankStrainNames(Transformer):
 
     If the strain name still does not have the expected format, default to the
     GenBank accession as the strain name.
-    """
-    def parse_strain_from_title(self,title: str) -> str:
-        """
-        Try to parse strain name from the given *title* using regex search.
-        Returns an empty string if not match is found in the *title*.
-        """
-        strain_name_regex = r'[-\w]*/[-\w]*/[-\w]*\s'
-        strain = re.search(strain_name_regex, title)
-        return strain.group(0) if strain else ''
 
-    def transform_value(self, entry: dict) -> dict:
-        # Compile list of regex to be used for strain name standardization
-        # Order is important here! Keep the known prefixes first!
-        regex_replacement = [
+    The standardized names of the last *cache_size* distinct strain names are
+    memoized.
+    """
+    # Regex to be used for strain name standardization
+    # Order is important here! Keep the known prefixes first!
+    REGEX_REPLACEMENT = [
+        (re.compile(regex, re.IGNORECASE), replacement)
+        for regex, replacement in [
             (r'(^SAR[S]{0,1}[-\s]{0,1}CoV[-]{0,1}2/|^2019[-\s]nCoV[-_\s/]|^BetaCoV/|^nCoV-|^hCoV-19/)',''),
             (r'(human/|homo sapien/|Homosapiens{0,1}/)',''),
             (r'^USA-', 'USA/'),
@@ -604,30 +666,52 @@ class StandardizeGenbankStrainNames(Transformer):
             (r'^USAWA-', 'USA/WA-'),
             (r'^HKG.', 'HongKong/'),
         ]
+    ]
+    WHITESPACE_REGEX = re.compile(r'\s')
+    TITLE_STRAIN_REGEX = re.compile(r'[-\w]*/[-\w]*/[-\w]*\s')
 
+    # All strain names should have structure {}/{}/{year} or {}/{}/{}/{year}
+    # with the exception of 'Wuhan-Hu-1/2019'
+    STRAIN_NAME_REGEX = re.compile(r'([\w]*/)?[\w]*/[-_\.\w]*/[\d]{4}')
 
-        # Parse strain name from title to fill in strains that are empty strings
-        entry['strain_from_title'] = self.parse_strain_from_title( entry.get('title','') )
+    def __init__(self, cache_size: int = 1 << 16):
+        self.standardize_strain = lru_cache(maxsize=cache_size)(self._standardize_strain)
 
-        if entry['strain'] == '':
-            entry['strain'] = entry['strain_from_title']
+    def parse_strain_from_title(self,title: str) -> str:
+        """
+        Try to parse strain name from the given *title* using regex search.
+        Returns an empty string if not match is found in the *title*.
+        """
+        if '/' not in title:
+            return ''
+        strain = self.TITLE_STRAIN_REGEX.search(title)
+        return strain.group(0) if strain else ''
 
+    def _standardize_strain(self, strain: str) -> Optional[str]:
+        """
+        Return *strain* standardized, or None if it still doesn't have the
+        expected format.
+        """
+        for regex, replacement in self.REGEX_REPLACEMENT:
+            strain = regex.sub(replacement, strain)
 
-        # Standardize strain names using list of regex replacements
-        for regex, replacement in regex_replacement:
+        # Strip all spaces
+        strain = self.WHITESPACE_REGEX.sub('', strain)
 
-            entry['strain'] = re.sub( regex, replacement, entry['strain'], flags=re.IGNORECASE)
+        if self.STRAIN_NAME_REGEX.match(strain) is None and strain != 'Wuhan-Hu-1/2019':
+            return None
+        return strain
 
-        # Strip all spaces
-        entry['strain'] = re.sub( r'\s', '' , entry['strain'] )
+    def transform_value(self, entry: dict) -> dict:
+        # Parse strain name from title to fill in strains that are empty strings
+        entry['strain_from_title'] = self.parse_strain_from_title( entry.get('title','') )
+
+        if entry['strain'] == '':
+            entry['strain'] = entry['strain_from_title']
 
-        # All strain names should have structure {}/{}/{year} or {}/{}/{}/{year}
-        # with the exception of 'Wuhan-Hu-1/2019'
         # If strain name still doesn't match, default to the GenBank accession
-        strain_name_regex = re.compile(  r'([\w]*/)?[\w]*/[-_\.\w]*/[\d]{4}' )
-        if (( strain_name_regex.match( entry['strain'] ) is None ) and
-            ( entry['strain'] != 'Wuhan-Hu-1/2019' )):
-            entry['strain'] = entry['genbank_accession']
+        strain = self.standardize_strain(entry['strain'])
+        entry['strain'] = entry['genbank_accession'] if strain is None else strain
 
         return entry
 
@@ -661,16 +745,29 @@ class ExtractGeographicMetadataGenbank(Transformer):
         * Expands US state codes to full names.
 
     Also removes prefixes 'Europe/' and 'Germany/' from division.
-    """
-    def __init__(self, us_state_code_file_name ):
-        # Create dict of US state codes and their full names
-        self.us_states = pd.read_csv( us_state_code_file_name , header=None, sep='\t', comment="#")
-        self.us_states = dict(zip(self.us_states[0], self.us_states[1]))
 
+    The geography of the last *cache_size* distinct `location` (and `region`)
+    values is memoized; only the division parsed from `strain` is worked out
+    per entry.
+    """
+    STRAIN_STATE_CODE_REGEX = re.compile(r'^USA/(?P<state_code>[A-Z]{2})-')
 
-    def transform_value(self, entry : dict) -> dict :
+    def __init__(self, us_state_code_file_name, cache_size: int = 1 << 16):
+        # Create dict of US state codes and their full names
+        with open(us_state_code_file_name) as us_state_codes:
+            rows = (line.split('#', 1)[0].rstrip('\r\n').split('\t') for line in us_state_codes)
+            self.us_states = {row[0]: row[1] for row in rows if len(row) >= 2}
+        self.us_state_codes_and_names = frozenset(self.us_states) | frozenset(self.us_states.values())
+        self.geography = lru_cache(maxsize=cache_size)(self._geography)
 
-        geographic_data = entry['location'].split(':')
+    def _geography(self, location_data: str, region: Optional[str]) -> Tuple[str, str, str, bool, bool]:
+        """
+        Return the country, division and location of the location string
+        *location_data*, whether its division is to be parsed from the strain
+        name instead, and whether its format is unknown.  *region* is only
+        used (and needed) for "country: ..." strings.
+        """
+        geographic_data = location_data.split(':')
 
         country = geographic_data[0].strip()
         division = ''
@@ -679,7 +776,7 @@ class ExtractGeographicMetadataGenbank(Transformer):
         if len(geographic_data) == 2 :
             # Remove potential region value in the location
             # See <https://github.com/nextstrain/ncov-ingest/pull/497#issuecomment-2779337493>
-            region = entry['region'].strip()
+            region = region.strip()
             detailed_locations = [loc.strip() for loc in geographic_data[1].split(',')]
             if region in detailed_locations:
                 detailed_locations.remove(region)
@@ -687,39 +784,50 @@ class ExtractGeographicMetadataGenbank(Transformer):
 
             division , j , location = geographic_data[1].partition(',')
 
-        elif len(geographic_data) > 2:
-            print(f"WARNING: Unable to parse division and location because of unknown format for geographic data: {entry['location']!r}")
-
-
         # Special parsing for US locations because the format varies
+        division_from_strain = False
         if country == 'USA':
             # Switch location & division if location is a US state
-            if location and any(location.strip() in s for s in self.us_states.items()):
+            if location and location.strip() in self.us_state_codes_and_names:
                 location, division = division, location
 
-            # Parse state from strain name (eg. 'USA/MA-…')
-            # See <https://github.com/nextstrain/ncov-ingest/issues/518>
-            if division == '':
-                if match := re.match(r'^USA/(?P<state_code>[A-Z]{2})-', entry['strain']):
-                    if (state_code := match.group('state_code')) in self.us_states:
-                        print(f"Inferred division={state_code!r} from strain={entry['strain']!r}.")
-                        division = state_code
-
+            division_from_strain = division == ''
+            division = self.expand_us_state(division)
 
-            # Convert US state codes to full names
-            if self.us_states.get(division.strip().upper()):
-                division = self.us_states[division.strip().upper()]
+        return (country, self.normalize_division(division),
+                location.strip().lower().title() if location else '',
+                division_from_strain, len(geographic_data) > 2)
 
+    def expand_us_state(self, division: str) -> str:
+        """Convert a US state code to its full name."""
+        return self.us_states.get(division.strip().upper()) or division
 
-        location = location.strip().lower().title() if location else ''
+    @staticmethod
+    def normalize_division(division: str) -> str:
         division = division.strip().lower().title() if division else ''
 
         # fix German divisions
         for stripstr in ['Europe/', 'Germany/']:
             if division.startswith(stripstr):
                 division = division[len(stripstr):]
+        return division
+
+    def transform_value(self, entry : dict) -> dict :
+        location_data = entry['location']
+        region = entry['region'] if location_data.count(':') == 1 else None
+        country, division, location, division_from_strain, unparsed = self.geography(location_data, region)
+
+        if unparsed:
+            DIAGNOSTICS.emit("unparsed geographic data", f"WARNING: Unable to parse division and location because of unknown format for geographic data: {entry['location']!r}")
+
+        # Parse state from strain name (eg. 'USA/MA-…')
+        # See <https://github.com/nextstrain/ncov-ingest/issues/518>
+        if division_from_strain:
+            if match := self.STRAIN_STATE_CODE_REGEX.match(entry['strain']):
+                if (state_code := match.group('state_code')) in self.us_states:
+                    DIAGNOSTICS.emit("inferred division", f"Inferred division={state_code!r} from strain={entry['strain']!r}.")
+                    division = self.normalize_division(self.expand_us_state(state_code))
 
-        #print(entry , '->' , geographic_data , country, division, location)
         entry['country']     = country
         entry['division']    = division
         entry['location']    = location
@@ -789,7 +897,7 @@ class Tracker(Transformer):
 
     def transform_value(self, entry : dict) -> dict :
         if entry[ self.interestField ] in self.interestIds:
-            print(entry)
+            DIAGNOSTICS.emit("tracked record", str(entry))
         return entry
 
 class patchUKData(Transformer):
@@ -804,45 +912,95 @@ class patchUKData(Transformer):
     ```
 
     This transformer fetches the CLIMB data, matches records via sample accession, and fills in missing metadata
+
+    The lookup maps each sample accession to its patched values joined into a
+    single string, which is much smaller than a dict per accession.  If
+    *cache_dir* is given and both inputs are local files, the lookup is pickled
+    there under a name derived from the inputs' SHA-256 digests, so later runs
+    with unchanged COG-UK inputs skip reading the CSVs.
     """
-    def __init__(self, sample_id_table, metadata_file):
-        import uuid
+    # Bump to invalidate cached lookups when the table construction changes
+    CACHE_VERSION = 1
+    CACHE_PREFIX = 'cog_uk_lookup.'
+
+    # Fields taken from the COG-UK tables, in the order they are patched in.
+    # region and country are the same for every record.
+    PATCHED_FIELDS = ('strain', 'date', 'pango_lineage', 'division', 'gisaid_epi_isl')
+    FIELD_SEPARATOR = '\x1f'
+
+    GEO_LOOKUP = {'UK-ENG':('United Kingdom', 'England'),
+                  'UK-SCT':('United Kingdom', 'Scotland'),
+                  'UK-WLS':('United Kingdom', 'Wales'),
+                  'UK-NIR':('United Kingdom', 'Northern Ireland')}
+
+    def __init__(self, sample_id_table, metadata_file, cache_dir = None):
+        cache_path = None
+        if cache_dir and os.path.isfile(sample_id_table) and os.path.isfile(metadata_file):
+            digest = hashlib.sha256(f"v{patchUKData.CACHE_VERSION}".encode())
+            for path in (sample_id_table, metadata_file):
+                digest.update(_file_sha256(path).encode())
+            cache_path = os.path.join(cache_dir, f"{patchUKData.CACHE_PREFIX}{digest.hexdigest()}.pickle")
+
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'rb') as cache_fh:
+                self.metadata_lookup = pickle.load(cache_fh)
+            return
+
+        self.metadata_lookup = self._build_lookup(sample_id_table, metadata_file)
+
+        if cache_path:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Drop lookups cached from older COG-UK inputs
+            for name in os.listdir(cache_dir):
+                if name.startswith(patchUKData.CACHE_PREFIX) and name.endswith('.pickle'):
+                    os.unlink(os.path.join(cache_dir, name))
+            tmp_path = f"{cache_path}.tmp"
+            with open(tmp_path, 'wb') as cache_fh:
+                pickle.dump(self.metadata_lookup, cache_fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+
+    @staticmethod
+    def _build_lookup(sample_id_table, metadata_file) -> Dict[str, str]:
+        import pandas as pd
+
         # load table with all sample IDs
-        samples_ids = pd.read_csv(sample_id_table, sep='\t', index_col="central_sample_id")
+        samples_ids = pd.read_csv(sample_id_table, sep='\t', index_col="central_sample_id", dtype=str)
         samples_ids = samples_ids.loc[~samples_ids.index.duplicated(keep='first')]
 
-        # function to generated sample id from sequence name
-        def get_sample_id(x):
-            try:
-                sample_id = x.split('/')[1]
-            except:
-                sample_id = f'problemsample_{str(uuid.uuid4())}'
-            return sample_id
-
-        # load metadata and produce IDs with no proper ID
-        metadata = pd.read_csv(metadata_file, sep=',')[['sequence_name', 'country', 'adm1', 'is_pillar_2', 'sample_date','epi_week', 'lineage', 'lineages_version']]
-        coguk_sample_ids = metadata.sequence_name.apply(get_sample_id)
-        metadata.index=coguk_sample_ids
+        # load metadata and derive the sample ID from the sequence name, e.g.
+        # 'England/MILK-123/2021' -> 'MILK-123'.  Names without one get a unique
+        # placeholder so they are still kept through the merge below.
+        metadata = pd.read_csv(metadata_file, sep=',', dtype=str,
+                               usecols=['sequence_name', 'adm1', 'sample_date', 'lineage'])
+        coguk_sample_ids = metadata.sequence_name.str.split('/', n=2).str[1]
+        missing_ids = coguk_sample_ids.isna()
+        coguk_sample_ids[missing_ids] = [f'problemsample_{i}' for i in metadata.index[missing_ids]]
+        metadata.index = coguk_sample_ids
         metadata = metadata.loc[~metadata.index.duplicated(keep='first')]
 
-        # merge tables and make a reduced table with unique sample accession (ena_sample.secondary_accession)
+        # merge tables, keyed by sample accession (ena_sample.secondary_accession)
         merged_meta = pd.concat([samples_ids, metadata], axis='columns', copy=False).fillna('?')
-        has_sample = merged_meta.loc[~merged_meta["ena_sample.secondary_accession"].isna()]
-        has_sample.index = has_sample["ena_sample.secondary_accession"]
-
-        self.metadata_lookup = {}
-        geo_lookup = {'UK-ENG':('United Kingdom', 'England'),
-                      'UK-SCT':('United Kingdom', 'Scotland'),
-                      'UK-WLS':('United Kingdom', 'Wales'),
-                      'UK-NIR':('United Kingdom', 'Northern Ireland')}
-        for k,v in has_sample.iterrows():
-            self.metadata_lookup[k]= {'strain':v['sequence_name'], 'date':v['sample_date'], 'pango_lineage':v['lineage'],
-                                      'region':'Europe', 'country': 'United Kingdom', 'division':geo_lookup.get(v['adm1'],('?', '?'))[1],
-                                      'gisaid_epi_isl':v['gisaid.accession']}
+        merged_meta['division'] = merged_meta['adm1'].map(
+            {code: names[1] for code, names in patchUKData.GEO_LOOKUP.items()}).fillna('?')
+
+        # Later rows win for repeated accessions, as they did when the lookup
+        # was filled row by row.
+        merged_meta = merged_meta.loc[
+            ~merged_meta["ena_sample.secondary_accession"].duplicated(keep='last')]
+
+        packed = merged_meta['sequence_name']
+        for column in ('sample_date', 'lineage', 'division', 'gisaid.accession'):
+            packed = packed + patchUKData.FIELD_SEPARATOR + merged_meta[column]
+
+        return dict(zip(merged_meta["ena_sample.secondary_accession"], packed))
 
     def transform_value(self, entry: dict) -> dict:
-        if entry["biosample_accession"] in self.metadata_lookup:
-            entry.update(self.metadata_lookup[entry["biosample_accession"]])
+        packed = self.metadata_lookup.get(entry["biosample_accession"])
+        if packed is not None:
+            strain, date, pango_lineage, division, gisaid_epi_isl = packed.split(patchUKData.FIELD_SEPARATOR)
+            entry.update({'strain': strain, 'date': date, 'pango_lineage': pango_lineage,
+                          'region': 'Europe', 'country': 'United Kingdom', 'division': division,
+                          'gisaid_epi_isl': gisaid_epi_isl})
 
         return entry
 
@@ -858,7 +1016,7 @@ class ParseBiosample(Transformer):
     def __init__(self, columns: List[str]):
         self.columns = columns
 
-    STRAIN_REGEX = r'([-\w\s]*/)?([-\w\s]*/)?[-\w\s]*/[-\w\s]*/[0-9]{4}$'
+    STRAIN_REGEX = re.compile(r'([-\w\s]*/)?([-\w\s]*/)?[-\w\s]*/[-\w\s]*/[0-9]{4}$')
 
     # Multiple BioSample attribute fields can represent the same metadata.
     # We take the first value that matches the field regex from the most
@@ -872,11 +1030,11 @@ class ParseBiosample(Transformer):
         },
         'originating_lab' : {
             'fields': ['collected_by', 'collecting institution', 'collecting institute'],
-            'regex': r'^(?!\s*$).+' # Matches any string that is not empty or just whitespace
+            'regex': re.compile(r'^(?!\s*$).+') # Matches any string that is not empty or just whitespace
         },
         'gisaid_epi_isl': {
             'fields': ['gisaid_accession', 'GISAID Accession ID', 'gisaid id', 'gisaid'],
-            'regex': r'EPI_ISL_[0-9]*'
+            'regex': re.compile(r'EPI_ISL_[0-9]*')
         }
     }
 
@@ -886,20 +1044,21 @@ class ParseBiosample(Transformer):
     LOCATION_ATTR = ['geo_loc_name', 'geographic location (region and locality)', 'region']
 
     # Potential BioSample values that represent null values
-    NULL_VALUES = ['missing', 'nan', 'none', 'not applicable', 'not collected',
-                   'not determined', 'not provided', 'restricted access', 'unknown']
+    NULL_VALUES = frozenset({'missing', 'nan', 'none', 'not applicable', 'not collected',
+                             'not determined', 'not provided', 'restricted access', 'unknown'})
 
-    def parse_first_regex_match(self, regex: str, value: str) -> str:
+    def parse_first_regex_match(self, regex: re.Pattern, value: str) -> str:
         """
         Return the first regex match found in *value*.
         Returns an empty string if there is no match.
         """
-        matches = re.search(regex, value)
+        matches = regex.search(value)
         return matches.group(0) if matches else ''
 
     def parse_location(self, potential_values: Dict[str, str]) -> str:
         """
-        Parse the location from the provided *potential_values*
+        Parse the location from the provided *potential_values*, a mapping
+        that may contain any of the LOCATION_ATTR fields.
         Returns empty string if no location data provided in *potential_values*
         """
         country = potential_values.get('geo_loc_name')
@@ -971,7 +1130,7 @@ class ParseBiosample(Transformer):
         new_entry['date'] = attributes.get('collection_date')
         new_entry['internal_id'] = attributes.get('sample_name')
 
-        new_entry['location'] = self.parse_location({ attr: attributes.get(attr) for attr in ParseBiosample.LOCATION_ATTR })
+        new_entry['location'] = self.parse_location(attributes)
 
         # Special processing of BioSample records pulled from EBI/ENA
         # The owner/submitter is "EBI" but we want to pull the original submitter to EBI
@@ -1006,8 +1165,12 @@ class MergeBiosampleMetadata(Transformer):
     empty or '?', except the special handling for the 'location' field since the
     BioSample record may contain more detailed location data than the GenBank
     record.
+
+    *biosample_metadata* maps BioSample accessions to dicts of metadata.  It
+    may be a plain dict or an on-disk lookup such as
+    :class:`utils.transformpipeline.tsvindex.TsvRowLookup`.
     """
-    def __init__(self, biosample_metadata: dict):
+    def __init__(self, biosample_metadata: Mapping[str, dict]):
         self.biosample_metadata = biosample_metadata
 
     def transform_value(self, entry: dict) -> dict:
@@ -0,0 +1,410 @@
+"""
+On-disk, memory-mapped key index over a TSV file.
+
+Loading a large TSV into a dict of dicts (e.g. ``pd.read_csv(...).to_dict()``)
+costs gigabytes of RSS and a long startup when only a fraction of its rows are
+ever looked up.  A :class:`TsvIndex` instead keeps the TSV on disk and stores a
+sidecar file of row byte offsets ordered by key, so a lookup is a binary search
+over two memory-mapped files and only the matching row is ever decoded.
+
+Keys are compared bytewise on their UTF-8 encoding, i.e. the ``LC_ALL=C sort``
+order the transforms already write.  When the TSV is sorted by its key column
+the index is built in a single streaming pass; otherwise the keys are read back
+with their offsets and sorted on disk.  Rows with duplicate keys keep file
+order, and lookups return the first.
+
+Indexes are built either by a separate scan with :func:`build_index` or, for
+free, while the TSV is written: write it with an :class:`IndexedTsvWriter` (or
+record each row in a :class:`TsvIndexBuilder`) and save the index once the file
+is closed.  :meth:`TsvIndex.offsets_of` and :meth:`TsvIndex.rows` fetch a batch
+of keys in file order, so reading them back is one forward pass.  See
+``scripts/developer_scripts/tsv-index``.
+"""
+import csv
+import io
+import mmap
+import os
+import struct
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, TextIO
+
+from .externalsort import spill_keyed_lines_to_sorted_tempfile
+from .tsvwriter import BUFFER_ROWS, TsvWriter
+
+
+INDEX_MAGIC = b"TSVIDX01"
+# magic, TSV size, TSV mtime (ns), key column index, number of rows
+_HEADER = struct.Struct("<8sQQQQ")
+
+# pandas' default `na_values`, so TsvRowLookup can mirror the
+# `pd.read_csv(..., dtype='string').fillna(...)` tables it replaces.
+PANDAS_NA_VALUES = frozenset({
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND',
+    '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+})
+
+
+def default_index_path(tsv_path: str, key_column: str) -> str:
+    return f"{tsv_path}.{key_column}.idx"
+
+
+def _split_row(row: bytes) -> List[str]:
+    text = row.decode("utf-8")
+    if '"' not in text:
+        return text.rstrip("\r\n").split("\t")
+    return next(csv.reader(io.StringIO(text, newline=""), delimiter="\t"))
+
+
+def _row_key(row: bytes, key_index: int) -> bytes:
+    if b'"' not in row:
+        fields = row.rstrip(b"\r\n").split(b"\t", key_index + 1)
+        return fields[key_index] if key_index < len(fields) else b""
+    fields = _split_row(row)
+    return fields[key_index].encode("utf-8") if key_index < len(fields) else b""
+
+
+def _iter_rows(fh) -> Iterator[tuple]:
+    """Yield ``(offset, row bytes)`` for each TSV row in the binary file
+    ``fh``, joining physical lines that fall inside a quoted field."""
+    offset = fh.tell()
+    pending = b""
+    for line in fh:
+        pending += line
+        # csv's doubled quotes keep the count even, so an odd count means the
+        # newline is inside a quoted field.
+        if pending.count(b'"') % 2:
+            continue
+        yield offset, pending
+        offset += len(pending)
+        pending = b""
+    if pending:
+        yield offset, pending
+
+
+def _tsv_stamp(tsv_path: str) -> tuple:
+    stat = os.stat(tsv_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _sorted_offsets(tsv_path: str, key_index: int, output_dir: str) -> array:
+    """The offsets of the rows of ``tsv_path`` ordered by their ``key_index``
+    column, sorted on disk in ``output_dir``.  Rows with keys containing a tab
+    or a line break are left out."""
+    def keyed_lines():
+        with open(tsv_path, "rb") as tsv_fh:
+            tsv_fh.readline()
+            for offset, row in _iter_rows(tsv_fh):
+                key = _row_key(row, key_index).decode("utf-8")
+                if "\t" not in key and "\n" not in key and "\r" not in key:
+                    yield f"{key}\t{offset}\t\n"
+
+    offsets = array("Q")
+    sorted_path = spill_keyed_lines_to_sorted_tempfile(keyed_lines(), output_dir)
+    try:
+        with open(sorted_path, "r", encoding="utf-8", newline="\n") as sorted_keys:
+            for line in sorted_keys:
+                offsets.append(int(line.split("\t", 2)[1]))
+    finally:
+        os.unlink(sorted_path)
+    return offsets
+
+
+def _write_index(index_path: str, stamp: tuple, key_index: int, offsets: array) -> None:
+    size, mtime_ns = stamp
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, "wb") as index_fh:
+        index_fh.write(_HEADER.pack(INDEX_MAGIC, size, mtime_ns, key_index, len(offsets)))
+        offsets.tofile(index_fh)
+    os.replace(tmp_path, index_path)
+
+
+def build_index(tsv_path: str, key_column: str, index_path: Optional[str] = None) -> str:
+    """Write an index of ``tsv_path`` by ``key_column`` to ``index_path``
+    (default: next to the TSV) and return its path."""
+    index_path = index_path or default_index_path(tsv_path, key_column)
+    stamp = _tsv_stamp(tsv_path)
+
+    offsets = array("Q")
+    is_sorted = True
+    previous_key = None
+    with open(tsv_path, "rb") as tsv_fh:
+        key_index = _split_row(tsv_fh.readline()).index(key_column)
+        for offset, row in _iter_rows(tsv_fh):
+            key = _row_key(row, key_index)
+            if previous_key is not None and key < previous_key:
+                is_sorted = False
+                break
+            previous_key = key
+            offsets.append(offset)
+
+    if not is_sorted:
+        offsets = _sorted_offsets(tsv_path, key_index, os.path.dirname(os.path.abspath(index_path)))
+    _write_index(index_path, stamp, key_index, offsets)
+    return index_path
+
+
+class TsvIndexBuilder:
+    """Collects the row offsets of a TSV as it is written, to save an index
+    of it by each of ``key_columns``.
+
+    The rows start at byte ``rows_start``, after the ``header``.  Columns whose
+    keys are added in order, such as the column the TSV is sorted by, are
+    indexed from the offsets alone; the others have their keys read back from
+    the TSV and sorted on disk when saving.
+    """
+    def __init__(self, header: Sequence[str], key_columns: Iterable[str], rows_start: int):
+        self.header = list(header)
+        self.key_indexes = {column: self.header.index(column) for column in key_columns}
+        self.offsets = array("Q")
+        self._end = rows_start
+        # the key columns added in order so far, with their last key
+        self._in_order = list(self.key_indexes.items())
+        self._previous = {column: "" for column in self.key_indexes}
+
+    def add_row(self, values: Sequence[str], length: int) -> None:
+        """Record the next row, the fields ``values`` written in ``length``
+        bytes including its line terminator."""
+        self.offsets.append(self._end)
+        self._end += length
+        for column, key_index in self._in_order:
+            key = values[key_index] if key_index < len(values) else ""
+            if key < self._previous[column]:
+                self._in_order = [item for item in self._in_order if item[0] != column]
+            else:
+                self._previous[column] = key
+
+    def add_line(self, line: str, encoding: str = "utf-8") -> None:
+        """Record the next row, written as ``line``."""
+        row = line.encode(encoding)
+        self.add_row(_split_row(row), len(row))
+
+    def save(self, tsv_path: str, index_paths: Optional[Dict[str, str]] = None) -> List[str]:
+        """Write the index of each key column (at ``index_paths[column]``,
+        default: next to the TSV) of ``tsv_path``, which must be closed, and
+        return their paths."""
+        stamp = _tsv_stamp(tsv_path)
+        if stamp[0] != self._end:
+            raise ValueError(f"Only {self._end} of the {stamp[0]} bytes of {tsv_path} were indexed")
+
+        in_order = {column for column, _ in self._in_order}
+        saved = []
+        for column, key_index in self.key_indexes.items():
+            index_path = (index_paths or {}).get(column) or default_index_path(tsv_path, column)
+            if column in in_order:
+                offsets = self.offsets
+            else:
+                offsets = _sorted_offsets(tsv_path, key_index, os.path.dirname(os.path.abspath(index_path)))
+            _write_index(index_path, stamp, key_index, offsets)
+            saved.append(index_path)
+        return saved
+
+
+class IndexedTsvWriter(TsvWriter):
+    """A :class:`TsvWriter` recording the rows it writes after the first, the
+    header, in a :class:`TsvIndexBuilder` by ``key_columns``.  Call
+    :meth:`save_index` once the file is closed."""
+    def __init__(self, fh: TextIO, key_columns: Iterable[str], lineterminator: str = "\r\n",
+                 buffer_rows: int = BUFFER_ROWS):
+        super().__init__(fh, lineterminator, buffer_rows)
+        self.key_columns = list(key_columns)
+        self.encoding = getattr(fh, "encoding", None) or "utf-8"
+        self.index_builder: Optional[TsvIndexBuilder] = None
+
+    def writevalues(self, values: Sequence[str]) -> None:
+        line = self.line(values)
+        length = len(line) if line.isascii() else len(line.encode(self.encoding))
+        if self.index_builder is None:
+            self.index_builder = TsvIndexBuilder(values, self.key_columns, length)
+        else:
+            self.index_builder.add_row(values, length)
+        self._buffer.append(line)
+        if len(self._buffer) >= self.buffer_rows:
+            self.flush()
+
+    writerow = writevalues
+
+    def save_index(self, tsv_path: str) -> List[str]:
+        """Write the indexes of ``tsv_path``, once closed; see
+        :meth:`TsvIndexBuilder.save`."""
+        return self.index_builder.save(tsv_path)
+
+
+class TsvIndex:
+    """A read-only view of a TSV through an index built by :func:`build_index`.
+
+    The index is (re)built on open when it is missing or was built from a
+    different version of the TSV.  If it cannot be written next to the TSV,
+    pass an ``index_path`` in a writable location.
+    """
+    def __init__(self, tsv_path: str, key_column: str, index_path: Optional[str] = None):
+        self.tsv_path = str(tsv_path)
+        self.key_column = key_column
+        self.index_path = str(index_path or default_index_path(self.tsv_path, key_column))
+
+        if not self._index_is_current():
+            build_index(self.tsv_path, key_column, self.index_path)
+
+        with open(self.tsv_path, "rb") as tsv_fh:
+            self.header = _split_row(tsv_fh.readline())
+            self._tsv = self._map(tsv_fh)
+        self.key_index = self.header.index(key_column)
+
+        with open(self.index_path, "rb") as index_fh:
+            self._index = self._map(index_fh)
+        count = _HEADER.unpack_from(self._index)[4]
+        self._offsets = memoryview(self._index)[_HEADER.size:_HEADER.size + 8 * count].cast("Q")
+
+    @staticmethod
+    def _map(fh):
+        if os.fstat(fh.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _index_is_current(self) -> bool:
+        try:
+            with open(self.index_path, "rb") as index_fh:
+                magic, size, mtime_ns, _, _ = _HEADER.unpack(index_fh.read(_HEADER.size))
+        except (OSError, struct.error):
+            return False
+        return magic == INDEX_MAGIC and (size, mtime_ns) == _tsv_stamp(self.tsv_path)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def _row_bytes(self, offset: int) -> bytes:
+        end = self._tsv.find(b"\n", offset)
+        while end != -1 and self._tsv[offset:end].count(b'"') % 2:
+            end = self._tsv.find(b"\n", end + 1)
+        return self._tsv[offset:] if end == -1 else self._tsv[offset:end + 1]
+
+    def _key_at(self, position: int) -> bytes:
+        return _row_key(self._row_bytes(self._offsets[position]), self.key_index)
+
+    def _first_position(self, target: bytes) -> int:
+        lo, hi = 0, len(self._offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, key: str) -> Optional[int]:
+        """Return the byte offset of the first row with ``key``, or None."""
+        target = key.encode("utf-8")
+        position = self._first_position(target)
+        if position < len(self._offsets) and self._key_at(position) == target:
+            return self._offsets[position]
+        return None
+
+    def find_all(self, key: str) -> List[int]:
+        """Return the byte offsets of every row with ``key``, in file order."""
+        target = key.encode("utf-8")
+        found = []
+        position = self._first_position(target)
+        while position < len(self._offsets) and self._key_at(position) == target:
+            found.append(self._offsets[position])
+            position += 1
+        return found
+
+    def offsets_of(self, keys: Iterable[str]) -> List[int]:
+        """Return the byte offsets of the rows with any of ``keys``, in file
+        order."""
+        return sorted({offset for key in keys for offset in self.find_all(key)})
+
+    def row_at(self, offset: int) -> List[str]:
+        """Return the fields of the row starting at byte ``offset``."""
+        return _split_row(self._row_bytes(offset))
+
+    def raw_row_at(self, offset: int) -> bytes:
+        """Return the row starting at byte ``offset`` as it is in the TSV,
+        with its line terminator."""
+        return self._row_bytes(offset)
+
+    def rows(self, keys: Iterable[str]) -> Iterator[List[str]]:
+        """Yield the fields of the rows with any of ``keys``, in file order."""
+        for offset in self.offsets_of(keys):
+            yield self.row_at(offset)
+
+    def offsets(self) -> Iterator[int]:
+        """Yield row offsets in key order."""
+        return iter(self._offsets)
+
+    def close(self) -> None:
+        self._offsets.release()
+        for mapped in (self._tsv, self._index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+
+class TsvRowLookup(Mapping):
+    """A read-only ``{key: {column: value}}`` mapping backed by a
+    :class:`TsvIndex`, decoding a row only when it is looked up.
+
+    Values in ``na_values`` become ``na_value`` (defaults mirror
+    ``pd.read_csv(..., dtype='string').fillna('?')``) and the key column is left
+    out of each row dict, like ``to_dict(orient='index')``.  The last
+    ``cache_size`` decoded rows are kept in an LRU cache; callers must not
+    mutate the returned dicts.
+    """
+    def __init__(
+            self,
+            index: TsvIndex,
+            na_value: str = '?',
+            na_values: frozenset = PANDAS_NA_VALUES,
+            cache_size: int = 0,
+    ):
+        self.index = index
+        self.na_value = na_value
+        self.na_values = na_values
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Optional[dict]]" = OrderedDict()
+        self._value_columns = [
+            (i, column) for i, column in enumerate(index.header) if i != index.key_index
+        ]
+
+    def _decode(self, key: str) -> Optional[dict]:
+        # pandas reads such keys as NA, which never matches a lookup
+        if key in self.na_values:
+            return None
+        offset = self.index.find(key)
+        if offset is None:
+            return None
+        fields = self.index.row_at(offset)
+        fields += [''] * (len(self.index.header) - len(fields))
+        return {
+            column: self.na_value if fields[i] in self.na_values else fields[i]
+            for i, column in self._value_columns
+        }
+
+    def _lookup(self, key: str) -> Optional[dict]:
+        if not self.cache_size:
+            return self._decode(key)
+        try:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        except KeyError:
+            pass
+        row = self._cache[key] = self._decode(key)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return row
+
+    def __getitem__(self, key: str) -> dict:
+        row = self._lookup(key) if isinstance(key, str) else None
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def __contains__(self, key) -> bool:
+        return isinstance(key, str) and self._lookup(key) is not None
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __iter__(self) -> Iterator[str]:
+        for offset in self.index.offsets():
+            yield self.index.row_at(offset)[self.index.key_index]
@@ -0,0 +1,133 @@
+"""
+Write TSV rows without going through ``csv`` for every field.
+
+``csv.DictWriter.writerow`` looks every column up in a Python-level list
+comprehension, checks every character of every field for the characters that
+need quoting, and writes each row with a call of its own.  The transforms'
+metadata outputs have fixed columns whose values almost never need quoting,
+so :class:`TsvDictWriter` instead
+
+* compiles its columns into one generated function returning a record's
+  values (the column's value, or ``restval`` if it has none);
+* joins the values of a row with tabs, and checks the joined line once for
+  the characters that would need quoting (a tab, a quote, a line break or a
+  ``lineterminator`` character) -- only such rows, and rows with values that
+  aren't strings, are written by ``csv`` itself, so the output is byte for
+  byte that of ``csv.DictWriter`` with the same columns and ``restval``,
+  ``extrasaction='ignore'``, ``delimiter='\\t'`` and ``lineterminator``;
+* buffers the lines, writing :data:`BUFFER_ROWS` of them at once.
+
+:class:`TsvWriter` does the same for rows that are already lists of values,
+in place of ``csv.writer``, and :class:`TsvDictWriter` writes them too with
+:meth:`~TsvWriter.writevalues`.  The buffered rows are only written by
+:meth:`~TsvWriter.flush`, which must be called before the file is closed.
+"""
+import csv
+import io
+from typing import Any, Callable, Iterable, List, Sequence, TextIO
+
+
+# Rows buffered before writing them.
+BUFFER_ROWS = 4096
+
+
+class TsvWriter:
+    """Writes rows of values to ``fh`` like ``csv.writer(fh, delimiter='\\t',
+    lineterminator=lineterminator)``; see the module documentation."""
+    def __init__(self, fh: TextIO, lineterminator: str = "\r\n", buffer_rows: int = BUFFER_ROWS):
+        self.fh = fh
+        self.lineterminator = lineterminator
+        self.buffer_rows = max(1, buffer_rows)
+        self._buffer: List[str] = []
+        self._special = tuple(sorted({'"', "\r", "\n", *lineterminator} - {"\t"}))
+        self._csv_line = io.StringIO()
+        self._csv = csv.writer(self._csv_line, delimiter="\t", lineterminator=lineterminator)
+
+    def writevalues(self, values: Sequence[Any]) -> None:
+        """Write a row of ``values``."""
+        self._buffer.append(self.line(values))
+        if len(self._buffer) >= self.buffer_rows:
+            self.flush()
+
+    writerow = writevalues
+
+    def writerows(self, rows: Iterable[Sequence[Any]]) -> None:
+        for values in rows:
+            self.writerow(values)
+
+    def flush(self) -> None:
+        """Write out the buffered rows."""
+        if self._buffer:
+            self.fh.write("".join(self._buffer))
+            self._buffer.clear()
+
+    def line(self, values: Sequence[Any]) -> str:
+        """The line, with its terminator, written for ``values``."""
+        try:
+            line = "\t".join(values)
+        except TypeError:
+            line = None
+        if line is None or not self._plain(line, len(values)):
+            line = self._quoted(values)
+        return line + self.lineterminator
+
+    def _plain(self, line: str, fields: int) -> bool:
+        """Whether ``line``, the ``fields`` string values joined by tabs, is
+        also the line ``csv`` would write for them."""
+        if not line or line.count("\t") != fields - 1:
+            # csv quotes a lone empty field, and values with tabs
+            return False
+        for char in self._special:
+            if char in line:
+                return False
+        return True
+
+    def _quoted(self, values: Sequence[Any]) -> str:
+        """The line ``csv`` writes for ``values``, without its terminator."""
+        self._csv_line.seek(0)
+        self._csv_line.truncate()
+        self._csv.writerow(values)
+        return self._csv_line.getvalue()[:-len(self.lineterminator) or None]
+
+
+def compile_row_values(columns: Sequence[str], restval: Any = "") -> Callable[[dict], List[Any]]:
+    """A function returning the values of ``columns`` in a record, or
+    ``restval`` for those it doesn't have, like ``csv.DictWriter`` does."""
+    getters = ", ".join(f"get({column!r}, restval)" for column in columns)
+    source = f"def row_values(entry):\n    get = entry.get\n    return [{getters}]\n"
+    namespace = {"restval": restval}
+    exec(compile(source, "<tsv row values>", "exec"), namespace)
+    return namespace["row_values"]
+
+
+class TsvDictWriter(TsvWriter):
+    """Writes the ``columns`` of records to ``fh`` like ``csv.DictWriter(fh,
+    columns, restval=restval, extrasaction='ignore', delimiter='\\t',
+    lineterminator=lineterminator)``; see the module documentation."""
+    def __init__(self, fh: TextIO, columns: Sequence[str], restval: Any = "", lineterminator: str = "\r\n",
+                 buffer_rows: int = BUFFER_ROWS):
+        super().__init__(fh, lineterminator, buffer_rows)
+        self.columns = list(columns)
+        self.row_values = compile_row_values(self.columns, restval)
+
+    def writeheader(self) -> None:
+        self.writevalues(self.columns)
+
+    def writerow(self, entry: dict) -> None:
+        self.writevalues(self.row_values(entry))
+
+
+def dict_writer(fh: TextIO, columns: Sequence[str], restval: Any = "", extrasaction: str = "raise",
+                delimiter: str = ",", **dict_writer_kwargs):
+    """A :class:`TsvDictWriter` if it writes what ``csv.DictWriter`` would
+    with these arguments, otherwise that ``csv.DictWriter``."""
+    if delimiter == "\t" and extrasaction == "ignore" and set(dict_writer_kwargs) <= {"lineterminator"}:
+        return TsvDictWriter(fh, columns, restval, **dict_writer_kwargs)
+    return csv.DictWriter(fh, columns, restval=restval, extrasaction=extrasaction, delimiter=delimiter,
+                          **dict_writer_kwargs)
+
+
+def flush_writer(writer) -> None:
+    """Write out the rows a :func:`dict_writer` buffered, if any."""
+    if isinstance(writer, TsvWriter):
+        writer.flush()
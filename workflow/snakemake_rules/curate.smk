@@ -12,14 +12,74 @@ Produces different output files for GISAID vs GenBank:
     GISAID:
         fasta = "data/gisaid/sequences.fasta"
         metadata = "data/gisaid/metadata_transformed.tsv"
+        date_ordinals = "data/gisaid/date_ordinals.tsv"
         flagged_annotations = temp("data/gisaid/flagged-annotations")
+        diagnostics_summary = "data/gisaid/diagnostics-summary.json"
         duplicate_biosample = "data/gisaid/duplicate_biosample.txt"
     GenBank:
         fasta = "data/genbank/sequences.fasta"
         metadata = "data/genbank/metadata_transformed.tsv"
+        date_ordinals = "data/genbank/date_ordinals.tsv"
         flagged_annotations = temp("data/genbank/flagged-annotations")
+        diagnostics_summary = "data/genbank/diagnostics-summary.json"
         duplicate_biosample = "data/genbank/duplicate_biosample.txt"
+        biosample_index = temp("data/genbank/biosample.biosample_accession.idx")
 """
+import shlex
+
+
+def memory_report_options(rule_name):
+    """
+    Options of a transform script's opt-in memory report, written next to the
+    rule's benchmark file when the `memory_report` config is true.  Per-phase
+    budgets come from `memory_budgets`, e.g.
+        memory_budgets:
+            transform_gisaid_data: ["16384", "dedup write=8192"]
+    and `memory_budget_action` (warn or fail) says what exceeding them does.
+    """
+    if not config.get("memory_report", False):
+        return ""
+    options = ["--memory-report", f"benchmarks/{rule_name}.memory.json"]
+    for budget in config.get("memory_budgets", {}).get(rule_name, []):
+        options += ["--memory-budget", str(budget)]
+    options += ["--memory-budget-action", config.get("memory_budget_action", "warn")]
+    return " ".join(shlex.quote(option) for option in options)
+
+
+def checkpoint_options(db):
+    """
+    Options of a transform script's opt-in checkpoints, kept in
+    `data/{db}/transform-checkpoints` when the `transform_checkpoints` config
+    is true, so that a rerun of a failed job resumes it (see --resume).
+    `transform_checkpoint_interval` sets the seconds between the checkpoints
+    of the pipeline.
+    """
+    if not config.get("transform_checkpoints", False):
+        return ""
+    options = ["--checkpoint-dir", f"data/{db}/transform-checkpoints", "--resume"]
+    if "transform_checkpoint_interval" in config:
+        options += ["--checkpoint-interval", str(config["transform_checkpoint_interval"])]
+    return " ".join(shlex.quote(option) for option in options)
+
+
+def cache_options(db):
+    """
+    Options of a transform script's opt-in caches, kept in
+    `data/{db}/transform-cache` and each written only when its config is true:
+        accessions_cache: the parsed accessions cross-reference (--accessions-cache)
+        cog_uk_cache: the COG-UK lookup table, GenBank only (--cog-uk-cache-dir)
+        ndjson_index: a byte-offset index of the input NDJSON, for
+            scripts/developer_scripts/ndjson-index (--ndjson-index)
+    """
+    cache_dir = f"data/{db}/transform-cache"
+    options = []
+    if config.get("accessions_cache", False):
+        options += ["--accessions-cache", f"{cache_dir}/all_accessions.annotations"]
+    if db == "genbank" and config.get("cog_uk_cache", False):
+        options += ["--cog-uk-cache-dir", cache_dir]
+    if config.get("ndjson_index", False):
+        options += ["--ndjson-index", f"{cache_dir}/{db}.ndjson.idx"]
+    return " ".join(shlex.quote(option) for option in options)
 
 
 rule fetch_accession_links:
@@ -60,52 +120,109 @@ rule transform_rki_data:
         "benchmarks/transform_rki_data.txt"
     params:
         subsampled=config.get("subsampled", False),
+        memory_report=memory_report_options("transform_rki_data"),
     shell:
         """
         ./bin/transform-rki \
             {input.ndjson} \
             --output-fasta {output.fasta} \
-            --output-metadata {output.metadata}
+            --output-metadata {output.metadata} \
+            {params.memory_report}
         """
 
 
-rule transform_biosample:
-    input:
-        biosample = "data/biosample.ndjson"
-    output:
-        biosample = "data/genbank/biosample.tsv"
-    benchmark:
-        "benchmarks/transform_biosample.txt"
-    shell:
-        """
-        ./bin/transform-biosample {input.biosample} \
-            --output {output.biosample}
-        """
+BIOSAMPLE_TSV = "data/genbank/biosample.tsv"
+# The BioSample transform runs as the first command of transform_genbank_data
+# (see bin/ingest), so the modules they share are imported once, unless the
+# transform checkpoints are on: Snakemake deletes the outputs of a failed job,
+# so its rerun would write the BioSample TSV anew and the GenBank transform
+# could not resume from the checkpoints made with the old one.
+CHAIN_BIOSAMPLE = not config.get("transform_checkpoints", False)
+
+
+def biosample_chain(wildcards, input, threads):
+    """
+    The transform-biosample command and `--then` run by bin/ingest before
+    transform-genbank when CHAIN_BIOSAMPLE.
+    """
+    if not CHAIN_BIOSAMPLE:
+        return ""
+    options = [
+        "transform-biosample", input.biosample_ndjson,
+        "--jobs", str(threads),
+        "--output", BIOSAMPLE_TSV,
+        "--then",
+    ]
+    return " ".join(shlex.quote(option) for option in options)
+
+
+if not CHAIN_BIOSAMPLE:
+    rule transform_biosample:
+        input:
+            biosample = "data/biosample.ndjson"
+        output:
+            biosample = BIOSAMPLE_TSV
+        threads:
+            workflow.cores * 0.5
+        benchmark:
+            "benchmarks/transform_biosample.txt"
+        shell:
+            """
+            ./bin/transform-biosample {input.biosample} \
+                --jobs {threads} \
+                --output {output.biosample}
+            """
 
 rule transform_genbank_data:
     input:
-        biosample = "data/genbank/biosample.tsv",
+        **({"biosample_ndjson": "data/biosample.ndjson"} if CHAIN_BIOSAMPLE else {"biosample": BIOSAMPLE_TSV}),
         ndjson = "data/genbank.ndjson",
         cog_uk_accessions = "data/cog_uk_accessions.tsv",
         cog_uk_metadata = "data/cog_uk_metadata.csv.gz",
         accessions = "data/all_accessions.tsv.gz",
     output:
+        # Written by the chained BioSample transform
+        **({"biosample": BIOSAMPLE_TSV} if CHAIN_BIOSAMPLE else {}),
         fasta = "data/genbank_sequences.fasta",
         metadata = "data/genbank_metadata_transformed.tsv",
+        # Day ordinals of the metadata's dates, for the clock deviation
+        date_ordinals = "data/genbank/date_ordinals.tsv",
         flagged_annotations = temp("data/genbank/flagged-annotations"),
-        duplicate_biosample = "data/genbank/duplicate_biosample.txt"
+        # Count and samples of each category of flagged-annotations messages
+        diagnostics_summary = "data/genbank/diagnostics-summary.json",
+        duplicate_biosample = "data/genbank/duplicate_biosample.txt",
+        # Index of the BioSample TSV by accession, which the transform looks rows up through
+        biosample_index = temp("data/genbank/biosample.biosample_accession.idx"),
+    params:
+        biosample_chain=biosample_chain,
+        biosample=BIOSAMPLE_TSV,
+        caches=cache_options("genbank"),
+        memory_report=memory_report_options("transform_genbank_data"),
+        # text (one line per message), jsonl or summary; see --diagnostics-format
+        diagnostics_format=config.get("diagnostics_format", "text"),
+        checkpoints=checkpoint_options("genbank"),
+    threads:
+        workflow.cores * 0.5 if CHAIN_BIOSAMPLE else 1
     benchmark:
         "benchmarks/transform_genbank_data.txt"
     shell:
         """
-        ./bin/transform-genbank {input.ndjson} \
-            --biosample {input.biosample} \
+        ./bin/ingest {params.biosample_chain} \
+            --stdout {output.flagged_annotations} transform-genbank {input.ndjson} \
+            --biosample {params.biosample} \
+            --biosample-index {output.biosample_index} \
             --duplicate-biosample {output.duplicate_biosample} \
             --cog-uk-accessions {input.cog_uk_accessions} \
             --cog-uk-metadata {input.cog_uk_metadata} \
             --accessions {input.accessions} \
             --output-metadata {output.metadata} \
-            --output-fasta {output.fasta} > {output.flagged_annotations}
+            --output-date-ordinals {output.date_ordinals} \
+            --output-fasta {output.fasta} \
+            --diagnostics-format {params.diagnostics_format:q} \
+            --diagnostics-summary {output.diagnostics_summary} \
+            {params.caches} \
+            {params.checkpoints} \
+            {params.memory_report}
         """
 
 
@@ -139,16 +256,38 @@ rule transform_gisaid_data:
     output:
         fasta = "data/gisaid/sequences.fasta",
         metadata = "data/gisaid/metadata_transformed.tsv",
+        # Day ordinals of the metadata's dates, for the clock deviation
+        date_ordinals = "data/gisaid/date_ordinals.tsv",
         flagged_annotations = temp("data/gisaid/flagged-annotations"),
+        # Count and samples of each category of flagged-annotations messages
+        diagnostics_summary = "data/gisaid/diagnostics-summary.json",
         additional_info = "data/gisaid/additional_info.tsv"
+    params:
+        caches=cache_options("gisaid"),
+        # Partitions by strain; >1 runs the partitions in parallel (see --partitions)
+        partitions=config.get("transform_gisaid_partitions", 1),
+        memory_report=memory_report_options("transform_gisaid_data"),
+        # text (one line per message), jsonl or summary; see --diagnostics-format
+        diagnostics_format=config.get("diagnostics_format", "text"),
+        # Only without partitions, which --checkpoint-dir doesn't support
+        checkpoints=checkpoint_options("gisaid") if int(config.get("transform_gisaid_partitions", 1)) <= 1 else "",
+    threads: workflow.cores * 0.5
     benchmark:
         "benchmarks/transform_gisaid_data.txt"
     shell:
         """
         ./bin/transform-gisaid {input.ndjson} \
             --accessions {input.accessions} \
+            --partitions {params.partitions} \
+            --jobs {threads} \
             --output-metadata {output.metadata} \
+            --output-date-ordinals {output.date_ordinals} \
             --output-fasta {output.fasta}  \
             --output-additional-info {output.additional_info} \
-            --output-unix-newline > {output.flagged_annotations};
+            --output-unix-newline \
+            --diagnostics-format {params.diagnostics_format:q} \
+            --diagnostics-summary {output.diagnostics_summary} \
+            {params.caches} \
+            {params.checkpoints} \
+            {params.memory_report} > {output.flagged_annotations};
         """
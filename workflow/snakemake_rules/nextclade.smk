@@ -203,15 +203,22 @@ rule run_wuhan_nextclade:
     Runs nextclade on sequences which were not in the previously cached nextclade run.
     This alignes sequences, assigns clades and calculates some of the other useful
     metrics which will ultimately end up in metadata.tsv.
+
+    Sequences are run in shards of `nextclade_shard_size` sequences,
+    `nextclade_shard_jobs` at a time. Finished shards are kept in the work dir
+    until all of them are merged, so rerunning after a failure skips them.
     """
     input:
         nextclade_path="data/nextclade",
         dataset="data/nextclade_data/sars-cov-2.zip",
         sequences=f"data/{database}/nextclade.sequences.fasta",
     params:
-        translation_arg=lambda w: (
-            f"--output-translations=data/{database}/nextclade.translation_{{cds}}.upd.fasta"
-        ),
+        # A function, so Snakemake doesn't take {cds} for a wildcard
+        translations=lambda w: f"data/{database}/nextclade.translation_{{cds}}.upd.fasta",
+        genes=GENE_LIST,
+        work_dir=f"data/{database}/nextclade_shards",
+        shard_size=config.get("nextclade_shard_size", 50000),
+        shard_jobs=config.get("nextclade_shard_jobs", 4),
     output:
         info=f"data/{database}/nextclade_new_raw.tsv",
         alignment=temp(f"data/{database}/nextclade.aligned.upd.fasta"),
@@ -225,13 +232,18 @@ rule run_wuhan_nextclade:
         f"benchmarks/run_wuhan_nextclade_{database}.txt"
     shell:
         """
-        ./{input.nextclade_path} run \
-        -j {threads} \
-        {input.sequences}\
-        --input-dataset={input.dataset} \
-        --output-tsv={output.info} \
-        {params.translation_arg} \
-        --output-fasta={output.alignment}
+        ./bin/run-nextclade-sharded \
+            {input.nextclade_path:q} \
+            {input.sequences:q} \
+            --input-dataset={input.dataset:q} \
+            --output-tsv={output.info:q} \
+            --output-translations={params.translations:q} \
+            --output-fasta={output.alignment:q} \
+            --genes {params.genes:q} \
+            --work-dir={params.work_dir:q} \
+            --shard-size={params.shard_size} \
+            --jobs={params.shard_jobs} \
+            -j {threads}
         """
 
 
@@ -339,13 +351,27 @@ rule combine_alignments:
         """
 
 
+# Columns of the final metadata that rows are looked up by
+METADATA_INDEX_COLUMNS = ["strain", "gisaid_epi_isl", "genbank_accession"]
+
+
 rule generate_metadata:
+    """
+    Joins the metadata with the Nextclade results and appends the clock_deviation
+    column in the same step, so the joined metadata is only written once.
+    Also indexes it by strain and accessions, for looking rows up by key with
+    scripts/developer_scripts/tsv-index.
+    """
     input:
         nextclade_tsv=f"data/{database}/nextclade.tsv",
         existing_metadata=f"data/{database}/metadata_transformed.tsv",
         clade_legacy_mapping="defaults/clade-legacy-mapping.yml",
+        date_ordinals=f"data/{database}/date_ordinals.tsv",
     output:
-        metadata=temp(f"data/{database}/metadata_without_clock_deviation.tsv"),
+        metadata=f"data/{database}/metadata.tsv",
+        indexes=[f"data/{database}/metadata.tsv.{column}.idx" for column in METADATA_INDEX_COLUMNS],
+    params:
+        index_columns=" ".join(f"--index-column {column}" for column in METADATA_INDEX_COLUMNS),
     benchmark:
         f"benchmarks/generate_metadata_{database}.txt"
     shell:
@@ -354,21 +380,9 @@ rule generate_metadata:
             --metadata {input.existing_metadata} \
             --nextclade-tsv {input.nextclade_tsv} \
             --clade-legacy-mapping {input.clade_legacy_mapping} \
-            -o {output.metadata}
-        """
-
-
-rule compute_clock_deviation:
-    input:
-        metadata=f"data/{database}/metadata_without_clock_deviation.tsv",
-    output:
-        metadata=f"data/{database}/metadata.tsv",
-    benchmark:
-        f"benchmarks/compute_clock_deviation_{database}.txt"
-    shell:
-        """
-        ./bin/compute-clock-deviation \
-            --metadata {input.metadata} \
+            --clock-deviation \
+            --date-ordinals {input.date_ordinals} \
+            {params.index_columns} \
             -o {output.metadata}
         """
 